@@ -0,0 +1,134 @@
+import numpy as np
+import h5py
+import pickle
+import os
+import re
+import time
+import json
+import psutil
+
+from utils.data_and_loading_functions import load_SPARTA_data, load_ptl_params, load_phys_ptl_params, find_closest_z, timed, save_tree_profile
+from utils.search_functions import build_tree, batch_search
+##################################################################################################################
+# LOAD CONFIG PARAMETERS
+import configparser
+config = configparser.ConfigParser()
+config.read(os.getcwd() + "/config.ini")
+
+curr_sparta_file = config["MISC"]["curr_sparta_file"]
+snap_path = config["PATHS"]["snap_path"]
+SPARTA_output_path = config["PATHS"]["SPARTA_output_path"]
+rand_seed = config.getint("MISC","random_seed")
+ptl_phys_f32 = config.getboolean("MISC","ptl_phys_f32")
+
+sim_cosmol = config["MISC"]["sim_cosmol"]
+snap_dir_format = config["MISC"]["snap_dir_format"]
+snap_format = config["MISC"]["snap_format"]
+
+p_red_shift = config.getfloat("SEARCH","p_red_shift")
+search_radius = config.getfloat("SEARCH","search_radius")
+tree_bench_leafsizes = json.loads(config.get("SEARCH","tree_bench_leafsizes"))
+tree_bench_num_halos = config.getint("SEARCH","tree_bench_num_halos")
+tree_bench_synth_ptls = config.getint("SEARCH","tree_bench_synth_ptls")
+##################################################################################################################
+if sim_cosmol == "planck13-nbody":
+    sim_pat = r"cpla_l(\d+)_n(\d+)"
+else:
+    sim_pat = r"cbol_l(\d+)_n(\d+)"
+match = re.search(sim_pat, curr_sparta_file)
+if match:
+    sparta_name = match.group(0)
+    sim_num_ptls = int(match.group(2))**3
+
+sparta_HDF5_path = SPARTA_output_path + sparta_name + "/" + curr_sparta_file + ".hdf5"
+snap_loc = snap_path + sparta_name + "/"
+##################################################################################################################
+def memory_usage():
+    process = psutil.Process(os.getpid())
+    return process.memory_info().rss
+
+# Build a tree with one build profile and time how long it takes to build, to unpickle, and to search around the benchmark halos
+def bench_profile(ptls_pos, box_size, halos_pos, halos_r200m, tree_profile):
+    start_mem = memory_usage()
+    t0 = time.time()
+    ptl_tree = build_tree(ptls_pos, box_size, tree_profile)
+    build_time = time.time() - t0
+    build_mem = memory_usage() - start_mem
+
+    tree_bytes = pickle.dumps(ptl_tree, protocol=pickle.HIGHEST_PROTOCOL)
+    t0 = time.time()
+    pickle.loads(tree_bytes)
+    load_time = time.time() - t0
+
+    t0 = time.time()
+    nbrs = batch_search(ptl_tree, halos_pos, search_radius * halos_r200m)
+    query_time = time.time() - t0
+
+    bench_result = {
+        "leafsize": tree_profile["leafsize"],
+        "balanced_tree": tree_profile["balanced_tree"],
+        "build_time_s": build_time,
+        "load_time_s": load_time,
+        "tree_size_GB": len(tree_bytes) / 1024**3,
+        "build_mem_GB": build_mem / 1024**3,
+        "query_time_s": query_time,
+        "halos_per_s": halos_pos.shape[0] / query_time,
+        "ptls_per_s": nbrs["indices"].shape[0] / query_time,
+    }
+    return bench_result
+
+if __name__ == "__main__":
+    with timed("Benchmark setup"):
+        p_snap, p_red_shift = find_closest_z(p_red_shift,snap_loc,snap_dir_format,snap_format)
+        with h5py.File(sparta_HDF5_path,"r") as f:
+            dic_sim = {}
+            grp_sim = f['simulation']
+            for attr in grp_sim.attrs:
+                dic_sim[attr] = grp_sim.attrs[attr]
+        p_sparta_snap = np.abs(dic_sim['snap_z'] - p_red_shift).argmin()
+        p_scale_factor = 1/(1+p_red_shift)
+        p_box_size = dic_sim["box_size"] * 10**3 * p_scale_factor # kpc/h physical
+        p_snap_path = snap_loc + "snapdir_" + snap_dir_format.format(p_snap) + "/snapshot_" + snap_format.format(p_snap)
+
+        param_paths = [["halos","position"],["halos","R200m"],["halos","status"],["halos","last_snap"]]
+        sparta_params, sparta_param_names = load_SPARTA_data(sparta_HDF5_path, param_paths, curr_sparta_file, p_snap, p_sparta_snap)
+        halos_r200m = sparta_params[sparta_param_names[1]]
+
+        # Search around a random sample of the halos that gen_ML_dsets.py searches around
+        host_idxs = np.where((sparta_params[sparta_param_names[2]] == 10) & (sparta_params[sparta_param_names[3]] >= p_sparta_snap) & (halos_r200m > 0))[0]
+        rng = np.random.default_rng(rand_seed)
+        bench_idxs = rng.choice(host_idxs, size=min(tree_bench_num_halos, host_idxs.size), replace=False)
+        bench_halos_r200m = halos_r200m[bench_idxs]
+
+        # A uniform box with the same particle density as the simulation (with the halos randomly placed in it)
+        if tree_bench_synth_ptls > 0:
+            bench_box_size = p_box_size * (tree_bench_synth_ptls / sim_num_ptls)**(1/3)
+            bench_ptls_pos = rng.random((tree_bench_synth_ptls, 3)) * bench_box_size
+            # Halos whose search sphere doesn't fit in the smaller box can't be used
+            bench_halos_r200m = bench_halos_r200m[search_radius * bench_halos_r200m < 0.5 * bench_box_size]
+            bench_halos_pos = rng.random((bench_halos_r200m.shape[0], 3)) * bench_box_size
+        else:
+            bench_box_size = p_box_size
+            if ptl_phys_f32:
+                bench_ptls_pos = load_phys_ptl_params(curr_sparta_file, str(p_snap), p_snap_path, p_scale_factor, dic_sim["box_size"])[2] # kpc/h
+            else:
+                bench_ptls_pos = load_ptl_params(curr_sparta_file, ["pos"], str(p_snap), p_snap_path)[0] * 10**3 * p_scale_factor # kpc/h
+            bench_halos_pos = sparta_params[sparta_param_names[0]][bench_idxs] * 10**3 * p_scale_factor # kpc/h
+
+    print("Benchmarking with", bench_ptls_pos.shape[0], "particles and", bench_halos_pos.shape[0], "halos")
+
+    bench_results = []
+    for leafsize in tree_bench_leafsizes:
+        for balanced_tree in [False, True]:
+            with timed("Tree leafsize=" + str(leafsize) + " balanced_tree=" + str(balanced_tree)):
+                bench_results.append(bench_profile(bench_ptls_pos, bench_box_size, bench_halos_pos, bench_halos_r200m, {"leafsize": leafsize, "balanced_tree": balanced_tree}))
+            print(bench_results[-1])
+
+    # The profile used is the one with the least total time to build the tree and search around every host halo of the simulation
+    for bench_result in bench_results:
+        bench_result["est_total_time_s"] = bench_result["build_time_s"] + bench_result["query_time_s"] * host_idxs.size / bench_halos_pos.shape[0]
+    best_result = min(bench_results, key=lambda bench_result: bench_result["est_total_time_s"])
+    tree_profile = {"leafsize": best_result["leafsize"], "balanced_tree": best_result["balanced_tree"]}
+
+    save_tree_profile(sparta_name, tree_profile, bench_results)
+    print("Saved tree build profile for", sparta_name + ":", tree_profile)
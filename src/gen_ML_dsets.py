@@ -1,20 +1,25 @@
 import numexpr as ne
 import numpy as np
-from scipy.spatial import cKDTree
 from colossus.cosmology import cosmology
 import h5py
 import pickle
 import os
+import sys
+import shutil
+import subprocess
 import multiprocessing as mp
 from itertools import repeat
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import re
 import pandas as pd
 import psutil
 import json
-from sparta_tools import sparta 
+import hashlib
 
-from utils.data_and_loading_functions import load_SPARTA_data, load_ptl_param, conv_halo_id_spid, get_comp_snap, create_directory, find_closest_z, timed, clean_dir
-from utils.calculation_functions import calc_radius, calc_pec_vel, calc_rad_vel, calc_tang_vel, calc_t_dyn
+from utils.data_and_loading_functions import load_SPARTA_data, load_sparta_tracers, load_ptl_params, load_phys_ptl_params, get_comp_snap, create_directory, find_closest_z, find_closest_snap, timed, clean_dir, create_pid_lookup, lookup_pid_rows, load_orb_label_table, lookup_orb_labels, prefetch_iter, share_arrays, attach_shared_arrays, free_shared_arrays, load_tree_profile, load_region_ptls, load_cell_store, load_snap_index, merge_domain_dsets, get_src_fingerprint, get_snap_fingerprint
+from utils.calculation_functions import calc_radius, calc_pec_vel, calc_rad_vel, calc_tang_vel, calc_t_dyn, calc_orb_assn, calc_split_orb_assn, calc_split_params, check_numba_kernel
+from utils.search_functions import calc_cell_idxs, build_tree, build_cell_list, nbr_search, nbr_count, count_in_radius, subset_nbrs, filter_nbrs, nbrs_from_lists, compact_nbrs, gather_nbrs, save_nbrs, load_nbrs, calc_morton_order
 ##################################################################################################################
 # LOAD CONFIG PARAMETERS
 import configparser
@@ -27,6 +32,7 @@ SPARTA_output_path = config["PATHS"]["SPARTA_output_path"]
 pickled_path = config["PATHS"]["pickled_path"]
 ML_dset_path = config["PATHS"]["ML_dset_path"]
 debug_mem = config.getboolean("MISC","debug_mem")
+ptl_phys_f32 = config.getboolean("MISC","ptl_phys_f32")
 
 sim_cosmol = config["MISC"]["sim_cosmol"]
 snap_dir_format = config["MISC"]["snap_dir_format"]
@@ -37,6 +43,21 @@ prim_snap_only = config.getboolean("SEARCH","prim_snap_only")
 t_dyn_step = config.getfloat("SEARCH","t_dyn_step")
 p_red_shift = config.getfloat("SEARCH","p_red_shift")
 search_radius = config.getfloat("SEARCH","search_radius")
+match_by_pid = config.getboolean("SEARCH","match_by_pid")
+pipeline_startup = config.getboolean("SEARCH","pipeline_startup")
+orb_label_table = config.getboolean("SEARCH","orb_label_table")
+sparta_prefetch_depth = config.getint("SEARCH","sparta_prefetch_depth")
+search_engine = config["SEARCH"]["search_engine"]
+# A cell list can only be searched in batches
+batch_tree_search = config.getboolean("SEARCH","batch_tree_search") or search_engine == "cell_list"
+reuse_full_search = config.getboolean("SEARCH","reuse_full_search")
+shared_ptl_arrays = config.getboolean("SEARCH","shared_ptl_arrays")
+save_nbr_cache = config.getboolean("SEARCH","save_nbr_cache")
+morton_order = config.getboolean("SEARCH","morton_order")
+batch_ptl_calc = config.getboolean("SEARCH","batch_ptl_calc")
+use_numba = config.getboolean("SEARCH","use_numba")
+n_domains = config.getint("SEARCH","n_domains")
+run_domains = config.getboolean("SEARCH","run_domains")
 total_num_snaps = config.getint("SEARCH","total_num_snaps")
 curr_chunk_size = config.getint("SEARCH","chunk_size")
 save_mem_size = config.getfloat("SEARCH","save_mem_size")
@@ -60,6 +81,10 @@ sparta_HDF5_path = SPARTA_output_path + sparta_name + "/" + curr_sparta_file + "
 snap_loc = snap_path + sparta_name + "/"
 
 num_processes = mp.cpu_count()
+# With n_domains > 1 each domain is run as its own job with: python gen_ML_dsets.py <domain>
+run_domain = int(sys.argv[1]) if len(sys.argv) > 1 else None
+# How the particle trees are built (benchmarked per simulation by bench_kdtree.py)
+tree_profile = load_tree_profile(sparta_name)
 ##################################################################################################################
 def memory_usage():
     process = psutil.Process(os.getpid())
@@ -118,7 +143,7 @@ def init_search(halo_positions, halo_r200m, search_rad, comp_snap = False, find_
             all_ptl_indices = indices
     else:
         num_new_particles = 0
-        all_ptl_indices = np.empty(1)
+        all_ptl_indices = np.empty(0, dtype=np.int64)
     
     if find_mass == False and find_ptl_indices == False:
         return num_new_particles
@@ -130,8 +155,8 @@ def init_search(halo_positions, halo_r200m, search_rad, comp_snap = False, find_
         return num_new_particles, halo_mass, all_ptl_indices
     
 def search_halos(comp_snap, snap_dict, curr_halo_idx, curr_ptl_pids, curr_ptl_pos, curr_ptl_vel, 
-                 halo_pos, halo_vel, halo_r200m, sparta_last_pericenter_snap=None, sparta_n_pericenter=None, sparta_tracer_ids=None,
-                 sparta_n_is_lower_limit=None, dens_prf_all=None, dens_prf_1halo=None, curr_halo_num=None, bins=None, create_dens_prf=False):
+                 halo_pos, halo_vel, halo_r200m, ptl_orb_assn=None, sparta_last_pericenter_snap=None, sparta_n_pericenter=None, sparta_tracer_ids=None,
+                 sparta_n_is_lower_limit=None, dens_prf_all=None, dens_prf_1halo=None, curr_halo_num=None, bins=None, create_dens_prf=False, sort_by_rad=True):
     # Doing this this way as otherwise will have to generate super large arrays for input from multiprocessing
     snap = snap_dict["snap"]
     red_shift = snap_dict["red_shift"]
@@ -140,29 +165,20 @@ def search_halos(comp_snap, snap_dict, curr_halo_idx, curr_ptl_pids, curr_ptl_po
     box_size = snap_dict["box_size"] 
     little_h = snap_dict["h"]   
     
-    halo_pos = halo_pos * 10**3 * scale_factor
-    
     num_new_ptls = curr_ptl_pids.shape[0]
 
     curr_ptl_pids = curr_ptl_pids.astype(np.int64) # otherwise ne.evaluate doesn't work
     fnd_HIPIDs = ne.evaluate("0.5 * (curr_ptl_pids + curr_halo_idx) * (curr_ptl_pids + curr_halo_idx + 1) + curr_halo_idx")
     
-    #calculate the radii of each particle based on the distance formula
+    #calculate the radii of each particle based on the distance formula (halo_pos is in physical kpc/h like the particles)
     ptl_rad, coord_dist = calc_radius(halo_pos[0], halo_pos[1], halo_pos[2], curr_ptl_pos[:,0], curr_ptl_pos[:,1], curr_ptl_pos[:,2], num_new_ptls, box_size)         
     
-    if comp_snap == False:         
-        compare_sparta_assn = np.zeros((sparta_tracer_ids.shape[0]))
+    # If the labels were already looked up from the orbit label table they are used as is
+    if comp_snap == False and ptl_orb_assn is not None:
+        curr_orb_assn = ptl_orb_assn
+    elif comp_snap == False:         
+        compare_sparta_assn = calc_orb_assn(sparta_last_pericenter_snap, sparta_n_pericenter, sparta_n_is_lower_limit, snap)
         curr_orb_assn = np.zeros((num_new_ptls))
-         # Anywhere sparta_last_pericenter is greater than the current snap then that is in the future so set to 0
-        future_peri = np.where(sparta_last_pericenter_snap > snap)[0]
-        adj_sparta_n_pericenter = sparta_n_pericenter
-        adj_sparta_n_pericenter[future_peri] = 0
-        adj_sparta_n_is_lower_limit = sparta_n_is_lower_limit
-        adj_sparta_n_is_lower_limit[future_peri] = 0
-        # If a particle has a pericenter or if the lower limit is 1 then it is orbiting
-
-        compare_sparta_assn[np.where((adj_sparta_n_pericenter >= 1) | (adj_sparta_n_is_lower_limit == 1))[0]] = 1
-        # compare_sparta_assn[np.where(adj_sparta_n_pericenter >= 1)] = 1
         
         # Compare the ids between SPARTA and the found prtl ids and match the SPARTA results
         matched_ids = np.intersect1d(curr_ptl_pids, sparta_tracer_ids, return_indices = True)
@@ -178,61 +194,122 @@ def search_halos(comp_snap, snap_dict, curr_halo_idx, curr_ptl_pids, curr_ptl_po
     scaled_radii = ptl_rad / halo_r200m
     scaled_phys_vel = phys_vel / curr_v200m
     
-    scaled_radii_inds = scaled_radii.argsort()
-    scaled_radii = scaled_radii[scaled_radii_inds]
-    fnd_HIPIDs = fnd_HIPIDs[scaled_radii_inds]
-    scaled_rad_vel = scaled_rad_vel[scaled_radii_inds]
-    scaled_tang_vel = scaled_tang_vel[scaled_radii_inds]
-    scaled_phys_vel = scaled_phys_vel[scaled_radii_inds]
+    # If not sorting by radius the particles are returned in the order they were inputted
+    if sort_by_rad:
+        scaled_radii_inds = scaled_radii.argsort()
+        scaled_radii = scaled_radii[scaled_radii_inds]
+        fnd_HIPIDs = fnd_HIPIDs[scaled_radii_inds]
+        scaled_rad_vel = scaled_rad_vel[scaled_radii_inds]
+        scaled_tang_vel = scaled_tang_vel[scaled_radii_inds]
+        scaled_phys_vel = scaled_phys_vel[scaled_radii_inds]
 
-    if comp_snap == False:
-        curr_orb_assn = curr_orb_assn[scaled_radii_inds]
+        if comp_snap == False:
+            curr_orb_assn = curr_orb_assn[scaled_radii_inds]
 
     if comp_snap == False:
         return fnd_HIPIDs, curr_orb_assn, scaled_rad_vel, scaled_tang_vel, scaled_radii, scaled_phys_vel
     else:
         return fnd_HIPIDs, scaled_rad_vel, scaled_tang_vel, scaled_radii
 
-def halo_loop(halo_idx,ptl_idx,curr_iter,num_iter,rst_pnt, indices, halo_splits, dst_name, tot_num_ptls, p_halo_ids, p_dict, p_ptls_pid, p_ptls_pos, p_ptls_vel, c_dict, c_ptls_pid, c_ptls_pos, c_ptls_vel):
+# Set in every pool worker by init_worker
+worker_arrays = {}
+worker_shms = []
+
+# Initializer of every pool. The workers attach to the particle arrays (and the split's found particles) through shared memory or
+# the memmap store so tasks only carry the halo's information and where its particles are. The trees are only loaded from their
+# saved pickles if the worker wasn't forked from the main process (with spawn they aren't inherited)
+def init_worker(shared_specs, tree_paths, ptl_mass):
+    global worker_arrays, worker_shms, mass
+    worker_arrays, worker_shms = attach_shared_arrays(shared_specs)
+    mass = ptl_mass
+    for tree_name, tree_path in tree_paths.items():
+        if tree_name not in globals():
+            with open(tree_path, "rb") as pickle_file:
+                globals()[tree_name] = pickle.load(pickle_file)
+
+def make_pool(split_specs = {}):
+    return mp.Pool(processes=num_processes, initializer=init_worker, initargs=({**ptl_specs, **split_specs}, tree_paths, mass))
+
+# search_halos for a halo whose particles are rows ptl_first:ptl_last of the split's shared particle rows. If the split's orbit labels
+# are shared they are used in place of the first of the other arguments (ptl_orb_assn)
+def search_shared_halo(comp_snap, snap_dict, curr_halo_idx, ptl_first, ptl_last, halo_pos, halo_vel, halo_r200m, *args, **kwargs):
+    snap_name = "c_" if comp_snap else "p_"
+    ptl_rows = worker_arrays[snap_name + "ptl_rows"][ptl_first:ptl_last]
+    if comp_snap == False and "p_orb_assn" in worker_arrays:
+        args = (worker_arrays["p_orb_assn"][ptl_first:ptl_last],) + args[1:]
+    
+    return search_halos(comp_snap, snap_dict, curr_halo_idx, worker_arrays[snap_name + "ptls_pid"][ptl_rows], worker_arrays[snap_name + "ptls_pos"][ptl_rows], 
+                        worker_arrays[snap_name + "ptls_vel"][ptl_rows], halo_pos, halo_vel, halo_r200m, *args, **kwargs)
+
+# The order a split's halos are searched and calculated in. With morton_order halos that are close to each other are done one after another
+def get_task_order(halos_pos, box_size):
+    if morton_order:
+        return calc_morton_order(halos_pos, box_size)
+    return np.arange(halos_pos.shape[0])
+
+# starmap over tasks given in task_order with the results put back into the halos' order
+def ordered_starmap(pool, func, task_args, task_order):
+    results = pool.starmap(func, task_args, chunksize=curr_chunk_size)
+    return [results[k] for k in np.argsort(task_order)]
+
+# Get the indices corresponding to where we are in the number of iterations (0:num_halo_persplit) -> (num_halo_persplit:2*num_halo_persplit) etc
+def get_split_indices(indices, halo_splits, curr_iter):
+    if curr_iter < (len(halo_splits) - 1):
+        return indices[halo_splits[curr_iter]:halo_splits[curr_iter+1]]
+    else:
+        return indices[halo_splits[curr_iter]:]
+
+# Everything a split needs from the SPARTA file. Only the tracer results are needed (and only if there is no orbit label table)
+# as all the halo information was loaded at startup. This is what is prefetched for the next splits
+def load_split_sparta(use_indices):
+    split_sparta = {
+        "use_indices": use_indices,
+        "tracers": None,
+    }
+    if not orb_label_table:
+        split_sparta["tracers"] = load_sparta_tracers(sparta_HDF5_path, use_indices)
+    return split_sparta
+
+def halo_loop(halo_idx,ptl_idx,curr_iter,num_iter,rst_pnt, indices, halo_splits, dst_name, tot_num_ptls, p_halo_ids, p_dict, p_ptls_pid, p_ptls_pos, p_ptls_vel, c_dict, c_ptls_pid, c_ptls_pos, c_ptls_vel, split_sparta=None):
         if debug_mem == 1:
             print(f"Initial memory usage: {memory_usage() / 1024**3:.2f} GB")
         with timed("Split "+str(curr_iter+1)+"/"+str(num_iter)):
-            # Get the indices corresponding to where we are in the number of iterations (0:num_halo_persplit) -> (num_halo_persplit:2*num_halo_persplit) etc
-            if curr_iter < (num_iter - 1):
-                use_indices = indices[halo_splits[curr_iter]:halo_splits[curr_iter+1]]
-            else:
-                use_indices = indices[halo_splits[curr_iter]:]
-            
-            use_halo_ids = p_halo_ids[use_indices]
-            
-            # Load the halo information for the ids within this range
-            sparta_output = sparta.load(filename = sparta_HDF5_path, halo_ids=use_halo_ids, log_level=0)
-
-            global c_sparta_snap
-            c_sparta_snap = np.abs(dic_sim["snap_z"][:] - c_red_shift).argmin()
+            # The split's SPARTA data is normally already loaded in the background by prefetch_iter
+            if split_sparta is None:
+                split_sparta = load_split_sparta(get_split_indices(indices, halo_splits, curr_iter))
+            use_indices = split_sparta["use_indices"]
             
-            new_idxs = conv_halo_id_spid(use_halo_ids, sparta_output, p_sparta_snap) # If the order changed by sparta re-sort the indices
-            use_halo_idxs = use_indices[new_idxs]
+            # The halo information was already loaded for both snapshots at startup and the indices are indices into SPARTA's halos
+            use_halo_idxs = use_indices
 
             # Search around these halos and get the number of particles and the corresponding ptl indices for them
-            p_use_halos_pos = sparta_output['halos']['position'][:,p_sparta_snap] * 10**3 * p_scale_factor 
-            p_use_halos_r200m = sparta_output['halos']['R200m'][:,p_sparta_snap]
+            p_use_halos_pos = p_halos_pos[use_halo_idxs]
+            p_use_halos_r200m = p_halos_r200m[use_halo_idxs]
 
-            
-            with mp.Pool(processes=num_processes) as p:
-                # halo position, halo r200m, if comparison snap, want mass?, want indices?
-                p_use_num_ptls, p_curr_ptl_indices = zip(*p.starmap(init_search, zip(p_use_halos_pos, p_use_halos_r200m, repeat(search_radius), repeat(False), repeat(False), repeat(True)), chunksize=curr_chunk_size))
-            p.close()
-            p.join() 
+            p_search_order = get_task_order(p_use_halos_pos, p_dict["box_size"])
+
+            # The particles are taken from the neighbour lists made at startup if there are any
+            if p_nbr_cache is not None:
+                p_nbrs = get_cached_nbrs(p_nbr_cache, use_halo_idxs, search_radius * p_use_halos_r200m)
+            # All of the split's halos are searched at once with the tree's own threads
+            elif batch_tree_search:
+                p_nbrs = nbr_search(p_ptl_tree, p_use_halos_pos, search_radius * p_use_halos_r200m, order = p_search_order)
+            else:
+                with make_pool() as p:
+                    # halo position, halo r200m, if comparison snap, want mass?, want indices?
+                    p_use_num_ptls, p_curr_ptl_indices = zip(*ordered_starmap(p, init_search, zip(p_use_halos_pos[p_search_order], p_use_halos_r200m[p_search_order], repeat(search_radius), repeat(False), repeat(False), repeat(True)), p_search_order))
+                p.close()
+                p.join() 
+                p_nbrs = nbrs_from_lists(p_curr_ptl_indices)
             
             # Remove halos with 0 ptls around them
-            p_use_num_ptls = np.array(p_use_num_ptls)
-            p_curr_ptl_indices = np.array(p_curr_ptl_indices, dtype=object)
-            has_ptls = np.where(p_use_num_ptls > 0)
+            p_use_num_ptls = np.diff(p_nbrs["offsets"])
+            has_ptls = np.where(p_use_num_ptls > 0)[0]
+            p_nbrs = compact_nbrs(subset_nbrs(p_nbrs, has_ptls), p_ptls_pid.shape[0])
             p_use_num_ptls = p_use_num_ptls[has_ptls]
-            p_curr_ptl_indices = p_curr_ptl_indices[has_ptls]
             p_use_halo_idxs = use_halo_idxs[has_ptls]
-            p_curr_num_halos = p_curr_ptl_indices.shape[0]
+            p_curr_num_halos = has_ptls.shape[0]
+            p_task_order = get_task_order(p_halos_pos[p_use_halo_idxs], p_dict["box_size"])
 
             # We need to correct for having previous halos being searched so the final halo_first quantity is for all halos
             # First obtain the halo_first values for this batch and then adjust to where the hdf5 file currently is
@@ -242,40 +319,81 @@ def halo_loop(halo_idx,ptl_idx,curr_iter,num_iter,rst_pnt, indices, halo_splits,
             p_start_num_ptls += ptl_idx # scale to where we are in the hdf5 file
             
             p_tot_num_use_ptls = int(np.sum(p_use_num_ptls))
+            
+            # The found particles of every halo one after another (halo m's are p_ptl_rows[p_ptl_offsets[m]:p_ptl_offsets[m+1]])
+            p_ptl_rows = p_nbrs["indices"]
+            p_ptl_offsets = p_nbrs["offsets"]
+            p_split_arrays = {"p_ptl_rows": p_ptl_rows}
 
-            halo_first = sparta_output['halos']['ptl_oct_first'][:]
-            halo_n = sparta_output['halos']['ptl_oct_n'][:]
+            # Get the orbit labels of every particle found in this split with one lookup into the orbit label table
+            # otherwise use the SPARTA tracer results of these halos and match them per halo
+            if orb_label_table:
+                p_split_arrays["p_orb_assn"] = lookup_orb_labels(p_orb_table, np.repeat(p_use_halo_idxs, p_use_num_ptls), gather_nbrs(p_nbrs, p_ptls_pid))
+                orb_args = [repeat(None), repeat(None), repeat(None), repeat(None), repeat(None)]
+            # When the whole split is calculated at once the tracer results are matched for every halo at once
+            elif batch_ptl_calc:
+                tracers = split_sparta["tracers"]
+                tcr_first = tracers["offsets"][has_ptls]
+                tcr_n = tracers["offsets"][1:][has_ptls] - tcr_first
+                tcr_rows = np.repeat(tcr_first - np.cumsum(tcr_n) + tcr_n, tcr_n) + np.arange(np.sum(tcr_n))
+                tcr_assn = calc_orb_assn(tracers['last_pericenter_snap'][tcr_rows], tracers['n_pericenter'][tcr_rows], tracers['n_is_lower_limit'][tcr_rows], p_dict["snap"])
+                p_split_arrays["p_orb_assn"] = calc_split_orb_assn(np.repeat(np.arange(p_curr_num_halos), p_use_num_ptls), gather_nbrs(p_nbrs, p_ptls_pid), 
+                                                                   np.repeat(np.arange(p_curr_num_halos), tcr_n), tracers['tracer_id'][tcr_rows], tcr_assn)
+            else:
+                # The tracers were read for all of the split's halos so only use the ones of halos with particles
+                tracers = split_sparta["tracers"]
+                tcr_first = tracers["offsets"][has_ptls]
+                tcr_last = tracers["offsets"][1:][has_ptls]
+                orb_args = [repeat(None),
+                            (tracers['last_pericenter_snap'][tcr_first[m]:tcr_last[m]] for m in p_task_order),
+                            (tracers['n_pericenter'][tcr_first[m]:tcr_last[m]] for m in p_task_order),
+                            (tracers['tracer_id'][tcr_first[m]:tcr_last[m]] for m in p_task_order),
+                            (tracers['n_is_lower_limit'][tcr_first[m]:tcr_last[m]] for m in p_task_order)]
             
-            # Use multiprocessing to search multiple halos at the same time and add information to shared array
+            # When matching by pid the comparison snapshot's particles are in the same order as the primary snapshot's
+            # so both are left unsorted and then sorted by the primary radii together afterwards
+            if match_by_pid and prim_snap_only == False:
+                use_search_halos = partial(search_shared_halo, sort_by_rad=False)
+            else:
+                use_search_halos = search_shared_halo
             
-            with mp.Pool(processes=num_processes) as p:
-                p_all_HIPIDs, p_all_orb_assn, p_all_rad_vel, p_all_tang_vel, p_all_scal_rad, p_phys_vel = zip(*p.starmap(search_halos, 
-                                            zip(repeat(False), repeat(p_dict), p_use_halo_idxs,
-                                            (p_ptls_pid[p_curr_ptl_indices[i]] for i in range(p_curr_num_halos)), 
-                                            (p_ptls_pos[p_curr_ptl_indices[j]] for j in range(p_curr_num_halos)),
-                                            (p_ptls_vel[p_curr_ptl_indices[k]] for k in range(p_curr_num_halos)),
-                                            (sparta_output['halos']['position'][l,p_sparta_snap,:] for l in range(p_curr_num_halos)),
-                                            (sparta_output['halos']['velocity'][l,p_sparta_snap,:] for l in range(p_curr_num_halos)),
-                                            (sparta_output['halos']['R200m'][l,p_sparta_snap] for l in range(p_curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['last_pericenter_snap'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(p_curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['n_pericenter'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(p_curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['tracer_id'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(p_curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['n_is_lower_limit'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(p_curr_num_halos)),
-                                            (sparta_output['anl_prf']['M_all'][l,p_sparta_snap,:] for l in range(p_curr_num_halos)),
-                                            (sparta_output['anl_prf']['M_1halo'][l,p_sparta_snap,:] for l in range(p_curr_num_halos)),
-                                            np.arange(0,p_curr_num_halos)+halo_idx,
-                                            # Uncomment below to create dens profiles
-                                            # repeat(sparta_output["config"]['anl_prf']["r_bins_lin"]),repeat(True) 
-                                            ),chunksize=curr_chunk_size))
-            p.close()
-            p.join()
+            # The halos are given to the workers in p_task_order and the results are put back into the split's order
+            p_task_halo_idxs = p_use_halo_idxs[p_task_order]
             
-            p_all_HIPIDs = np.concatenate(p_all_HIPIDs, axis = 0)
-            p_all_orb_assn = np.concatenate(p_all_orb_assn, axis = 0)
-            p_all_rad_vel = np.concatenate(p_all_rad_vel, axis = 0)
-            p_all_tang_vel = np.concatenate(p_all_tang_vel, axis = 0)
-            p_all_scal_rad = np.concatenate(p_all_scal_rad, axis = 0)
-            p_phys_vel = np.concatenate(p_phys_vel, axis=0)
+            # Calculate every particle of the split in one vectorized pass
+            if batch_ptl_calc:
+                p_all_HIPIDs, p_all_orb_assn, p_all_rad_vel, p_all_tang_vel, p_all_scal_rad, p_phys_vel = calc_split_params(False, p_dict, p_use_halo_idxs, p_ptl_offsets,
+                                            gather_nbrs(p_nbrs, p_ptls_pid), gather_nbrs(p_nbrs, p_ptls_pos), gather_nbrs(p_nbrs, p_ptls_vel),
+                                            p_halos_pos[p_use_halo_idxs], p_halos_vel[p_use_halo_idxs], p_halos_r200m[p_use_halo_idxs],
+                                            ptl_orb_assn=p_split_arrays["p_orb_assn"], sort_by_rad=not (match_by_pid and prim_snap_only == False), use_numba=use_numba)
+            else:
+                # Use multiprocessing to search multiple halos at the same time. The workers get the split's particles through shared memory
+                p_split_shms, p_split_specs = share_arrays(p_split_arrays, shared_ptl_arrays)
+                with make_pool(p_split_specs) as p:
+                    p_all_HIPIDs, p_all_orb_assn, p_all_rad_vel, p_all_tang_vel, p_all_scal_rad, p_phys_vel = zip(*ordered_starmap(p, use_search_halos, 
+                                                zip(repeat(False), repeat(p_dict), p_task_halo_idxs,
+                                                p_ptl_offsets[:-1][p_task_order], 
+                                                p_ptl_offsets[1:][p_task_order],
+                                                p_halos_pos[p_task_halo_idxs],
+                                                p_halos_vel[p_task_halo_idxs],
+                                                p_halos_r200m[p_task_halo_idxs],
+                                                *orb_args,
+                                                repeat(None), # mass profiles are only needed when creating density profiles
+                                                repeat(None),
+                                                p_task_order+halo_idx,
+                                                # Uncomment below to create dens profiles
+                                                # repeat(sparta_output["config"]['anl_prf']["r_bins_lin"]),repeat(True) 
+                                                ),p_task_order))
+                p.close()
+                p.join()
+                free_shared_arrays(p_split_shms)
+            
+                p_all_HIPIDs = np.concatenate(p_all_HIPIDs, axis = 0)
+                p_all_orb_assn = np.concatenate(p_all_orb_assn, axis = 0)
+                p_all_rad_vel = np.concatenate(p_all_rad_vel, axis = 0)
+                p_all_tang_vel = np.concatenate(p_all_tang_vel, axis = 0)
+                p_all_scal_rad = np.concatenate(p_all_scal_rad, axis = 0)
+                p_phys_vel = np.concatenate(p_phys_vel, axis=0)
             
             p_all_HIPIDs = p_all_HIPIDs.astype(np.float64)
             p_all_orb_assn = p_all_orb_assn.astype(np.int8)
@@ -286,43 +404,122 @@ def halo_loop(halo_idx,ptl_idx,curr_iter,num_iter,rst_pnt, indices, halo_splits,
             
             num_bins = 30
         
+            # If matching by pid take the particles found around each halo in the primary snap and get the same particles in the comparison snap
+            if prim_snap_only == False and match_by_pid:
+                # The comparison snap rows of the primary snap's particles (-1 if it isn't there) so each halo uses the same offsets as in the primary snap
+                c_ptl_rows = lookup_pid_rows(c_pid_lookup, gather_nbrs(p_nbrs, p_ptls_pid))
+                
+                if batch_ptl_calc:
+                    c_all_HIPIDs, c_all_rad_vel, c_all_tang_vel, c_all_scal_rad = calc_split_params(True, c_dict, p_use_halo_idxs, p_ptl_offsets,
+                                                c_ptls_pid[c_ptl_rows], c_ptls_pos[c_ptl_rows], c_ptls_vel[c_ptl_rows],
+                                                c_halos_pos[p_use_halo_idxs], c_halos_vel[p_use_halo_idxs], c_halos_r200m[p_use_halo_idxs], sort_by_rad=False, use_numba=use_numba)
+                else:
+                    c_split_shms, c_split_specs = share_arrays({"c_ptl_rows": c_ptl_rows}, shared_ptl_arrays)
+                    with make_pool(c_split_specs) as p:
+                        c_all_HIPIDs, c_all_rad_vel, c_all_tang_vel, c_all_scal_rad = zip(*ordered_starmap(p, use_search_halos, 
+                                                    zip(repeat(True), repeat(c_dict), p_task_halo_idxs,
+                                                        p_ptl_offsets[:-1][p_task_order], 
+                                                        p_ptl_offsets[1:][p_task_order],
+                                                        c_halos_pos[p_task_halo_idxs],
+                                                        c_halos_vel[p_task_halo_idxs],
+                                                        c_halos_r200m[p_task_halo_idxs],
+                                                        ),p_task_order))
+                    p.close()
+                    p.join()
+                    free_shared_arrays(c_split_shms)
+                    
+                    c_all_rad_vel = np.concatenate(c_all_rad_vel, axis = 0)
+                    c_all_tang_vel = np.concatenate(c_all_tang_vel, axis = 0)
+                    c_all_scal_rad = np.concatenate(c_all_scal_rad, axis = 0)
+                
+                c_all_rad_vel = c_all_rad_vel.astype(np.float32)
+                c_all_tang_vel = c_all_tang_vel.astype(np.float32)
+                c_all_scal_rad = c_all_scal_rad.astype(np.float32)
+                
+                # Only keep the particles that exist in the comparison snap and are within the search radius of a halo that exists there
+                c_ptl_r200m = np.repeat(c_halos_r200m[p_use_halo_idxs], p_use_num_ptls)
+                c_matched = (c_ptl_rows >= 0) & (c_ptl_r200m > 0) & (c_all_scal_rad <= search_radius)
+                
+                # Sort the particles in each halo by their primary snap radii
+                halo_ptl_num = np.repeat(np.arange(p_curr_num_halos), p_use_num_ptls)
+                scaled_radii_inds = np.lexsort((p_all_scal_rad, halo_ptl_num))
+                p_all_HIPIDs = p_all_HIPIDs[scaled_radii_inds]
+                p_all_orb_assn = p_all_orb_assn[scaled_radii_inds]
+                p_all_rad_vel = p_all_rad_vel[scaled_radii_inds]
+                p_all_tang_vel = p_all_tang_vel[scaled_radii_inds]
+                p_all_scal_rad = p_all_scal_rad[scaled_radii_inds]
+                p_phys_vel = p_phys_vel[scaled_radii_inds]
+                c_matched = c_matched[scaled_radii_inds]
+                
+                use_max_shape = (tot_num_ptls,2)                  
+                save_scale_radii = np.zeros((p_tot_num_use_ptls,2), dtype = np.float32)
+                save_rad_vel = np.zeros((p_tot_num_use_ptls,2), dtype = np.float32)
+                save_tang_vel = np.zeros((p_tot_num_use_ptls,2), dtype = np.float32)
+                
+                # Particles without a match are set to np.nan for xgboost
+                save_scale_radii[:,0] = p_all_scal_rad
+                save_scale_radii[:,1] = np.where(c_matched, c_all_scal_rad[scaled_radii_inds], np.nan)
+                save_rad_vel[:,0] = p_all_rad_vel
+                save_rad_vel[:,1] = np.where(c_matched, c_all_rad_vel[scaled_radii_inds], np.nan)
+                save_tang_vel[:,0] = p_all_tang_vel
+                save_tang_vel[:,1] = np.where(c_matched, c_all_tang_vel[scaled_radii_inds], np.nan)
+                
+                save_scale_radii[save_scale_radii[:,1] == 0, 1] = np.nan
+                save_rad_vel[save_rad_vel[:,1] == 0, 1] = np.nan
+                save_tang_vel[save_tang_vel[:,1] == 0, 1] = np.nan
+            
             # If multiple snaps also search the comparison snaps in the same manner as with the primary snap
-            if prim_snap_only == False:
-                c_use_halos_pos = sparta_output['halos']['position'][:,c_sparta_snap] * 10**3 * c_scale_factor
-                c_use_halos_r200m = sparta_output['halos']['R200m'][:,c_sparta_snap] 
+            elif prim_snap_only == False:
+                c_use_halos_pos = c_halos_pos[use_halo_idxs]
+                c_use_halos_r200m = c_halos_r200m[use_halo_idxs]
+                c_search_order = get_task_order(c_use_halos_pos, c_dict["box_size"])
 
-                with mp.Pool(processes=num_processes) as p:
-                    # halo position, halo r200m, if comparison snap, if train dataset, want mass?, want indices?
-                    c_use_num_ptls, c_curr_ptl_indices = zip(*p.starmap(init_search, zip(c_use_halos_pos, c_use_halos_r200m, repeat(search_radius), repeat(True), repeat(False), repeat(True)), chunksize=curr_chunk_size))
-                p.close()
-                p.join() 
+                if c_nbr_cache is not None:
+                    c_nbrs = get_cached_nbrs(c_nbr_cache, use_halo_idxs, search_radius * c_use_halos_r200m)
+                elif batch_tree_search:
+                    c_nbrs = nbr_search(c_ptl_tree, c_use_halos_pos, search_radius * c_use_halos_r200m, order = c_search_order)
+                else:
+                    with make_pool() as p:
+                        # halo position, halo r200m, if comparison snap, if train dataset, want mass?, want indices?
+                        c_use_num_ptls, c_curr_ptl_indices = zip(*ordered_starmap(p, init_search, zip(c_use_halos_pos[c_search_order], c_use_halos_r200m[c_search_order], repeat(search_radius), repeat(True), repeat(False), repeat(True)), c_search_order))
+                    p.close()
+                    p.join() 
+                    c_nbrs = nbrs_from_lists(c_curr_ptl_indices)
 
-                c_use_num_ptls = np.array(c_use_num_ptls)
-                c_curr_ptl_indices = np.array(c_curr_ptl_indices, dtype=object)
+                c_use_num_ptls = np.diff(c_nbrs["offsets"])
                 has_ptls = np.where(c_use_num_ptls > 0)[0]
+                c_nbrs = compact_nbrs(subset_nbrs(c_nbrs, has_ptls), c_ptls_pid.shape[0])
                 c_use_num_ptls = c_use_num_ptls[has_ptls]
-                c_curr_ptl_indices = c_curr_ptl_indices[has_ptls]
                 c_use_halo_idxs = use_halo_idxs[has_ptls]
                 c_tot_num_use_ptls = int(np.sum(c_use_num_ptls))
-                c_curr_num_halos = c_curr_ptl_indices.shape[0]
-
-                with mp.Pool(processes=num_processes) as p:
-                    c_all_HIPIDs, c_all_rad_vel, c_all_tang_vel, c_all_scal_rad = zip(*p.starmap(search_halos, 
-                                                zip(repeat(True), repeat(c_dict),c_use_halo_idxs,
-                                                    (c_ptls_pid[c_curr_ptl_indices[i]] for i in range(c_curr_num_halos)), 
-                                                    (c_ptls_pos[c_curr_ptl_indices[j]] for j in range(c_curr_num_halos)),
-                                                    (c_ptls_vel[c_curr_ptl_indices[k]] for k in range(c_curr_num_halos)),
-                                                    (sparta_output['halos']['position'][l,c_sparta_snap,:] for l in range(c_curr_num_halos)),
-                                                    (sparta_output['halos']['velocity'][l,c_sparta_snap,:] for l in range(c_curr_num_halos)),
-                                                    (sparta_output['halos']['R200m'][l,c_sparta_snap] for l in range(c_curr_num_halos)),
-                                                    ),chunksize=curr_chunk_size))
-                p.close()
-                p.join()
-                
-                c_all_HIPIDs = np.concatenate(c_all_HIPIDs, axis = 0)
-                c_all_rad_vel = np.concatenate(c_all_rad_vel, axis = 0)
-                c_all_tang_vel = np.concatenate(c_all_tang_vel, axis = 0)
-                c_all_scal_rad = np.concatenate(c_all_scal_rad, axis = 0)
+                c_curr_num_halos = has_ptls.shape[0]
+                c_ptl_offsets = c_nbrs["offsets"]
+                c_task_order = get_task_order(c_halos_pos[c_use_halo_idxs], c_dict["box_size"])
+                c_task_halo_idxs = c_use_halo_idxs[c_task_order]
+
+                if batch_ptl_calc:
+                    c_all_HIPIDs, c_all_rad_vel, c_all_tang_vel, c_all_scal_rad = calc_split_params(True, c_dict, c_use_halo_idxs, c_ptl_offsets,
+                                                gather_nbrs(c_nbrs, c_ptls_pid), gather_nbrs(c_nbrs, c_ptls_pos), gather_nbrs(c_nbrs, c_ptls_vel),
+                                                c_halos_pos[c_use_halo_idxs], c_halos_vel[c_use_halo_idxs], c_halos_r200m[c_use_halo_idxs], use_numba=use_numba)
+                else:
+                    c_split_shms, c_split_specs = share_arrays({"c_ptl_rows": c_nbrs["indices"]}, shared_ptl_arrays)
+                    with make_pool(c_split_specs) as p:
+                        c_all_HIPIDs, c_all_rad_vel, c_all_tang_vel, c_all_scal_rad = zip(*ordered_starmap(p, search_shared_halo, 
+                                                    zip(repeat(True), repeat(c_dict),c_task_halo_idxs,
+                                                        c_ptl_offsets[:-1][c_task_order], 
+                                                        c_ptl_offsets[1:][c_task_order],
+                                                        c_halos_pos[c_task_halo_idxs],
+                                                        c_halos_vel[c_task_halo_idxs],
+                                                        c_halos_r200m[c_task_halo_idxs],
+                                                        ),c_task_order))
+                    p.close()
+                    p.join()
+                    free_shared_arrays(c_split_shms)
+                    
+                    c_all_HIPIDs = np.concatenate(c_all_HIPIDs, axis = 0)
+                    c_all_rad_vel = np.concatenate(c_all_rad_vel, axis = 0)
+                    c_all_tang_vel = np.concatenate(c_all_tang_vel, axis = 0)
+                    c_all_scal_rad = np.concatenate(c_all_scal_rad, axis = 0)
                 
                 
                 c_all_HIPIDs = c_all_HIPIDs.astype(np.float64)
@@ -382,127 +579,457 @@ def halo_loop(halo_idx,ptl_idx,curr_iter,num_iter,rst_pnt, indices, halo_splits,
 
             ptl_idx += p_tot_num_use_ptls
             halo_idx += p_start_num_ptls.shape[0]
-            del sparta_output   
         if debug_mem == 1:
             print(f"Final memory usage: {memory_usage() / 1024**3:.2f} GB")
         return halo_idx, ptl_idx
-                
-with timed("Startup"):
-    if sim_cosmol == "planck13-nbody":
-        cosmol = cosmology.setCosmology('planck13-nbody',{'flat': True, 'H0': 67.0, 'Om0': 0.32, 'Ob0': 0.0491, 'sigma8': 0.834, 'ns': 0.9624, 'relspecies': False})
+
+# Load a pickled search tree if one exists (and was built with the simulation's current build profile) otherwise build it and pickle it for next time
+# The profile a tree was built with is saved next to it
+def load_or_build_tree(tree_path, ptls_pos, box_size):
+    saved_profile = None
+    if os.path.isfile(tree_path + ".profile.json"):
+        with open(tree_path + ".profile.json", "r") as file:
+            saved_profile = json.load(file)
+    
+    if os.path.isfile(tree_path) and reset_lvl < 2 and saved_profile == tree_profile:
+        with open(tree_path, "rb") as pickle_file:
+            ptl_tree = pickle.load(pickle_file)
     else:
-        cosmol = cosmology.setCosmology(sim_cosmol) 
-
-    with timed("p_snap information load"):
-        p_snap, p_red_shift = find_closest_z(p_red_shift,snap_loc,snap_dir_format,snap_format)
-        print("Snapshot number found:", p_snap, "Closest redshift found:", p_red_shift)
-        with h5py.File(sparta_HDF5_path,"r") as f:
-            dic_sim = {}
-            grp_sim = f['simulation']
-            for f in grp_sim.attrs:
-                dic_sim[f] = grp_sim.attrs[f]
-            
-        all_red_shifts = dic_sim['snap_z']
-        p_sparta_snap = np.abs(all_red_shifts - p_red_shift).argmin()
-        print("corresponding SPARTA snap num:", p_sparta_snap)
-        print("check sparta redshift:",all_red_shifts[p_sparta_snap])   
-
-        # Set constants
-        p_snap_path = snap_loc + "snapdir_" + snap_dir_format.format(p_snap) + "/snapshot_" + snap_format.format(p_snap)
-
-        p_scale_factor = 1/(1+p_red_shift)
-        p_rho_m = cosmol.rho_m(p_red_shift)
-        p_hubble_constant = cosmol.Hz(p_red_shift) * 0.001 # convert to units km/s/kpc
-        sim_box_size = dic_sim["box_size"] #units Mpc/h comoving
-        p_box_size = sim_box_size * 10**3 * p_scale_factor #convert to Kpc/h physical
-        little_h = dic_sim["h"]
-
-        p_snap_dict = {
-            "snap":p_snap,
-            "red_shift":p_red_shift,
-            "scale_factor": p_scale_factor,
-            "hubble_const": p_hubble_constant,
-            "box_size": p_box_size,
-            "h":little_h
-        }
+        ptl_tree = build_tree(ptls_pos, box_size, tree_profile)
+        with open(tree_path, "wb") as pickle_file:
+            pickle.dump(ptl_tree, pickle_file)
+        with open(tree_path + ".profile.json", "w") as file:
+            json.dump(tree_profile, file)
+    return ptl_tree
 
-    if reset_lvl == 3:
-        clean_dir(pickled_path + str(p_snap) + "_" + curr_sparta_file + "/")
+# A cell list's cells are about the size of the typical search sphere of the host halos (but there are never more cells than particles)
+def calc_search_ncells(box_size, halos_r200m, halos_status, num_ptls):
+    typ_search_rad = search_radius * np.median(halos_r200m[(halos_status == 10) & (halos_r200m > 0)])
+    return int(max(1, min(np.floor(box_size / typ_search_rad), np.floor(num_ptls**(1/3)))))
 
-    # load all information needed for the primary snap
-    with timed("p_snap ptl load"):
-        p_ptls_pid = load_ptl_param(curr_sparta_file, "pid", str(p_snap), p_snap_path) 
-        p_ptls_vel = load_ptl_param(curr_sparta_file, "vel", str(p_snap), p_snap_path) # km/s
-        p_ptls_pos = load_ptl_param(curr_sparta_file, "pos", str(p_snap), p_snap_path) * 10**3 * p_scale_factor # kpc/h
+# Load a saved (memory mapped) cell list if there is one with the same number of cells otherwise build it and save it for next time
+def load_or_build_cell_list(cell_path, ptls_pos, box_size, n_cells):
+    cell_names = ["pos", "order", "offsets"]
+    if reset_lvl < 2 and all(os.path.isfile(cell_path + cell_name + ".npy") for cell_name in cell_names):
+        cell_list = {cell_name: np.load(cell_path + cell_name + ".npy", mmap_mode="r") for cell_name in cell_names}
+        if cell_list["offsets"].shape[0] == n_cells**3 + 1 and cell_list["order"].shape[0] == ptls_pos.shape[0]:
+            cell_list["n_cells"] = n_cells
+            cell_list["box_size"] = box_size
+            return cell_list
     
-    with timed("p_snap SPARTA load"):
-        param_paths = [["halos","position"],["halos","R200m"],["halos","id"],["halos","status"],["halos","last_snap"],["simulation","particle_mass"]]
-            
-        p_sparta_params, p_sparta_param_names = load_SPARTA_data(sparta_HDF5_path, param_paths, curr_sparta_file, p_snap)
-
-        p_halos_pos = p_sparta_params[p_sparta_param_names[0]][:,p_sparta_snap,:] * 10**3 * p_scale_factor # convert to kpc/h
-        p_halos_r200m = p_sparta_params[p_sparta_param_names[1]][:,p_sparta_snap]
-        p_halos_ids = p_sparta_params[p_sparta_param_names[2]][:,p_sparta_snap]
-        p_halos_status = p_sparta_params[p_sparta_param_names[3]][:,p_sparta_snap]
-        p_halos_last_snap = p_sparta_params[p_sparta_param_names[4]][:]
-        mass = p_sparta_params[p_sparta_param_names[5]]
+    cell_list = build_cell_list(ptls_pos, box_size, n_cells)
+    for cell_name in cell_names:
+        np.save(cell_path + cell_name + ".npy.tmp.npy", cell_list[cell_name])
+        os.replace(cell_path + cell_name + ".npy.tmp.npy", cell_path + cell_name + ".npy")
+    return cell_list
+
+# What a snapshot is searched with: a tree or, with search_engine=cell_list, a cell list. snap_name is p or c
+def load_or_build_search(snap_name, ptls_pos, box_size, halos_r200m, halos_status):
+    if search_engine == "cell_list":
+        return load_or_build_cell_list(save_location + snap_name + "_cell_list_", ptls_pos, box_size, calc_search_ncells(box_size, halos_r200m, halos_status, ptls_pos.shape[0]))
+    return load_or_build_tree(save_location + snap_name + "_ptl_tree.pickle", ptls_pos, box_size)
+
+# The neighbour lists (with distances) of every halo that is used are saved next to the trees, keyed by the snapshot, the halo indices and
+# the search radius. Later runs that only change what is calculated from the found particles (reset=1) take them from here instead of
+# searching again. Returns the cache (memory mapped) as a dict with the sorted halo indices it has, their neighbour lists and the search radius.
+# Neighbour lists that were already searched (with nbrs_radius times R200m) can be given to be saved instead of searching
+# What a neighbour cache was searched from: the snapshot's files (the fingerprint the particle store's manifest is checked against), the
+# SPARTA file the halos' positions and radii are from and the halos themselves
+def get_nbr_cache_key(snap, halo_idxs):
+    snap_path = snap_loc + "snapdir_" + snap_dir_format.format(snap) + "/snapshot_" + snap_format.format(snap)
+    return {
+        "source": get_snap_fingerprint(snap_path),
+        "sparta": get_src_fingerprint([sparta_HDF5_path]),
+        "halo_idxs": hashlib.blake2b(np.ascontiguousarray(halo_idxs, dtype=np.int64).tobytes(), digest_size=16).hexdigest(),
+    }
+
+def load_or_save_nbr_cache(snap_name, snap, searcher, halo_idxs, halos_pos, halos_r200m, num_ptls, nbrs = None, nbrs_radius = search_radius):
+    cache_path = save_location + snap_name + "_nbrs_"
+    cache_key = get_nbr_cache_key(snap, halo_idxs)
+    try:
+        # Caches from before the squared distances were stored are searched again
+        if reset_lvl >= 2 or not os.path.isfile(cache_path + "info.json") or not os.path.isfile(cache_path + "sq_dists.npy"):
+            raise FileNotFoundError
+        with open(cache_path + "info.json", "r") as file:
+            cache_info = json.load(file)
+        if cache_info["snap"] != int(snap) or cache_info["num_ptls"] != int(num_ptls) or cache_info["search_radius"] < search_radius or cache_info.get("key") != cache_key:
+            raise FileNotFoundError
+        cache_halo_idxs = np.load(cache_path + "halo_idxs.npy")
+    except FileNotFoundError:
+        # halo_idxs are sorted so they can be found in the cache with searchsorted
+        if nbrs is None:
+            nbrs_radius = search_radius
+            with timed(snap_name + "_snap neighbour cache search"):
+                nbrs = compact_nbrs(nbr_search(searcher, halos_pos[halo_idxs], search_radius * halos_r200m[halo_idxs], return_dists = True), num_ptls)
+        # The info file is written last so a partially written cache is never used
+        if os.path.isfile(cache_path + "info.json"):
+            os.remove(cache_path + "info.json")
+        np.save(cache_path + "halo_idxs.npy", halo_idxs)
+        save_nbrs(nbrs, cache_path)
+        cache_info = {"snap": int(snap), "num_ptls": int(num_ptls), "search_radius": nbrs_radius, "key": cache_key}
+        with open(cache_path + "info.json", "w") as file:
+            json.dump(cache_info, file)
+        cache_halo_idxs = halo_idxs
         
-    with timed("c_snap load"):
-        t_dyn = calc_t_dyn(p_halos_r200m[np.where(p_halos_r200m > 0)[0][0]], p_red_shift)
-        c_snap, c_sparta_snap, c_rho_m, c_red_shift, c_scale_factor, c_hubble_constant, c_ptls_pid, c_ptls_vel, c_ptls_pos, c_halos_pos, c_halos_r200m, c_halos_id, c_halos_status, c_halos_last_snap = get_comp_snap(t_dyn=t_dyn, t_dyn_step=t_dyn_step, snapshot_list=[p_snap], cosmol = cosmol, p_red_shift=p_red_shift, all_red_shifts=all_red_shifts,snap_dir_format=snap_dir_format,snap_format=snap_format,snap_loc=snap_loc,sparta_HDF5_path=sparta_HDF5_path)
-        c_box_size = sim_box_size * 10**3 * c_scale_factor #convert to Kpc/h physical
-
-    c_snap_dict = {
-        "snap":c_snap,
-        "red_shift":c_red_shift,
-        "scale_factor": c_scale_factor,
-        "hubble_const": c_hubble_constant,
-        "box_size": c_box_size,
-        "h":little_h
+    nbr_cache = {
+        "halo_idxs": cache_halo_idxs,
+        "nbrs": load_nbrs(cache_path),
+        "search_radius": cache_info["search_radius"],
     }
+    return nbr_cache
 
-    snapshot_list = [p_snap, c_snap]
+# The neighbour lists of some halos from a neighbour cache. If the cache was searched with a larger radius only the particles within
+# radii are kept (by their stored distances)
+def get_cached_nbrs(nbr_cache, halo_idxs, radii):
+    nbrs = subset_nbrs(nbr_cache["nbrs"], np.searchsorted(nbr_cache["halo_idxs"], halo_idxs))
+    if nbr_cache["search_radius"] > search_radius:
+        nbrs = filter_nbrs(nbrs, radii)
+    return nbrs
 
-    if prim_snap_only:
-        save_location =  ML_dset_path + curr_sparta_file + "_" + str(snapshot_list[0]) + "/"
-    else:
-        save_location =  ML_dset_path + curr_sparta_file + "_" + str(snapshot_list[0]) + "to" + str(snapshot_list[1]) + "/"
+# Where a domain's datasets (and its trees, neighbour caches, ...) are saved
+def get_domain_location(domain):
+    return save_location + "domain_" + str(domain) + "/"
+
+# Split the box into n_domains^3 cubes and give every halo to the domain its centre is in at the primary snap. Each domain only loads the
+# particles in its cube and in a ghost shell around it (wrapping around the box) as wide as the largest search sphere of its halos. For the
+# comparison snap the shell is also widened by how far the domain's halos moved between the snaps. The halos were already cut by their number
+# of particles and split into train and test halos for the whole box. Regions are in comoving Mpc/h (see load_region_ptls)
+def make_domain_plan(halo_idxs, train_mask, p_halos_pos, p_halos_r200m, c_halos_pos, c_halos_r200m, p_scale_factor, c_scale_factor):
+    domain_width = sim_box_size / n_domains
+    p_com_pos = p_halos_pos[halo_idxs] / (10**3 * p_scale_factor)
+    c_com_pos = c_halos_pos[halo_idxs] / (10**3 * c_scale_factor)
+    # The number of particles in R200m is also counted in the primary snap
+    p_com_search = max(search_radius, 1.0) * p_halos_r200m[halo_idxs] / (10**3 * p_scale_factor)
+    c_com_search = search_radius * c_halos_r200m[halo_idxs] / (10**3 * c_scale_factor)
+    halo_shift = c_com_pos - p_com_pos
+    halo_shift = np.max(np.abs(halo_shift - sim_box_size * np.round(halo_shift / sim_box_size)), axis=1)
+    halo_domains = calc_cell_idxs(p_com_pos, sim_box_size, n_domains)
+    
+    domain_plan = {
+        "n_domains": n_domains,
+        "train_idxs": [],
+        "test_idxs": [],
+        "p_regions": [],
+        "c_regions": [],
+    }
+    for domain in range(n_domains**3):
+        in_domain = halo_domains == domain
+        domain_lo = np.array(np.unravel_index(domain, (n_domains, n_domains, n_domains))) * domain_width
+        p_ghost = np.max(p_com_search[in_domain], initial=0)
+        c_ghost = np.max(c_com_search[in_domain] + halo_shift[in_domain], initial=0)
+        domain_plan["train_idxs"].append(halo_idxs[in_domain & train_mask])
+        domain_plan["test_idxs"].append(halo_idxs[in_domain & ~train_mask])
+        domain_plan["p_regions"].append({"lo": domain_lo - p_ghost, "hi": domain_lo + domain_width + p_ghost, "box_size": sim_box_size})
+        domain_plan["c_regions"].append({"lo": domain_lo - c_ghost, "hi": domain_lo + domain_width + c_ghost, "box_size": sim_box_size})
+    return domain_plan
 
-    if os.path.exists(save_location) != True:
-        os.makedirs(save_location)
+# The number of particles within R200m of every halo of halo_idxs (for the 200 particle cut). It is counted one domain at a time from the
+# particles in the domain's region of the primary snap so the whole box is never loaded at once
+def count_domain_ptls(halo_idxs, domain_plan, p_halos_pos, p_halos_r200m, p_scale_factor, p_box_size):
+    num_ptls = np.zeros(halo_idxs.shape[0], dtype=np.int64)
+    for domain in range(len(domain_plan["p_regions"])):
+        domain_halo_idxs = np.sort(np.concatenate((domain_plan["train_idxs"][domain], domain_plan["test_idxs"][domain])))
+        if domain_halo_idxs.size == 0:
+            continue
+        ptls_pid, ptls_vel, ptls_pos = load_region_ptls(curr_sparta_file, str(p_snap), p_snap_path, p_scale_factor, domain_plan["p_regions"][domain])
+        ptl_tree = build_tree(ptls_pos, p_box_size, tree_profile)
+        num_ptls[np.searchsorted(halo_idxs, domain_halo_idxs)] = nbr_count(ptl_tree, p_halos_pos[domain_halo_idxs], 1.0 * p_halos_r200m[domain_halo_idxs])
+        del ptls_pid, ptls_vel, ptls_pos, ptl_tree
+    return num_ptls
 
-    if os.path.isfile(save_location + "p_ptl_tree.pickle") and reset_lvl < 2:
-            with open(save_location + "p_ptl_tree.pickle", "rb") as pickle_file:
-                p_ptl_tree = pickle.load(pickle_file)
+# What a domain's outputs are made from: the domain plan and the config. A domain is only finished if its domain_done.json is for the same ones
+def get_domain_key(domain_plan):
+    with open(os.getcwd() + "/config.ini", "rb") as file:
+        return hashlib.blake2b(pickle.dumps(domain_plan) + file.read(), digest_size=16).hexdigest()
+
+def is_domain_done(domain, domain_key):
+    if not os.path.isfile(get_domain_location(domain) + "domain_done.json"):
+        return False
+    with open(get_domain_location(domain) + "domain_done.json", "r") as file:
+        return json.load(file).get("domain_key") == domain_key
+
+# With run_domains every domain (with halos) that isn't finished is run as its own process one after another. Otherwise the domains are left 
+# to be run as separate jobs (python gen_ML_dsets.py <domain>) and this is run again afterwards. Once every domain is finished they are merged
+def run_and_merge_domains(domain_plan):
+    num_domains = len(domain_plan["train_idxs"])
+    domain_key = get_domain_key(domain_plan)
+    domains_left = []
+    for domain in range(num_domains):
+        if domain_plan["train_idxs"][domain].size + domain_plan["test_idxs"][domain].size == 0:
+            continue
+        if run_domains and not is_domain_done(domain, domain_key):
+            with timed("Domain " + str(domain+1) + "/" + str(num_domains)):
+                subprocess.run([sys.executable, os.path.abspath(__file__), str(domain)], check=True)
+        if not is_domain_done(domain, domain_key):
+            domains_left.append(domain)
+    
+    if len(domains_left) > 0:
+        print("Domains left to run:", ", ".join(map(str, domains_left)))
     else:
-        p_ptl_tree = cKDTree(data = p_ptls_pos, leafsize = 3, balanced_tree = False, boxsize = p_box_size) # construct search trees for primary snap
-        with open(save_location + "p_ptl_tree.pickle", "wb") as pickle_file:
-            pickle.dump(p_ptl_tree, pickle_file)
+        with timed("Merge domains"):
+            merge_domain_dsets(save_location, [get_domain_location(domain) for domain in range(num_domains)])
+
+# Load the comparison snap's particles and SPARTA data then build what is used to search it
+# When matching by pid the comparison snap is never searched so instead of a tree only a sorted pid lookup is needed
+# A domain only loads the particles of its region
+def load_comp_snap_and_tree(t_dyn):
+    c_ptl_region = None
+    if run_domain is not None:
+        c_ptl_region = domain_plan["c_regions"][run_domain]
+    c_snap_info = get_comp_snap(t_dyn=t_dyn, t_dyn_step=t_dyn_step, snapshot_list=[p_snap], cosmol = cosmol, p_red_shift=p_red_shift, all_red_shifts=all_red_shifts,snap_dir_format=snap_dir_format,snap_format=snap_format,snap_loc=snap_loc,sparta_HDF5_path=sparta_HDF5_path,box_size=sim_box_size,ptl_region=c_ptl_region)
+    c_scale_factor = c_snap_info[4]
+    c_ptls_pid = c_snap_info[6]
+    c_ptls_pos = c_snap_info[8]
+    c_box_size = sim_box_size * 10**3 * c_scale_factor #convert to Kpc/h physical
+    
+    with timed("c_snap tree load"):
+        if match_by_pid:
+            c_search = create_pid_lookup(c_ptls_pid)
+        else:
+            c_search = load_or_build_search("c", c_ptls_pos, c_box_size, c_snap_info[10], c_snap_info[12])
+    
+    return c_snap_info, c_box_size, c_search
+                
+# Everything below only runs in the main process so that pool workers started with spawn (which import this file) only get the functions above
+if __name__ == "__main__":
+    with timed("Startup"):
+        if sim_cosmol == "planck13-nbody":
+            cosmol = cosmology.setCosmology('planck13-nbody',{'flat': True, 'H0': 67.0, 'Om0': 0.32, 'Ob0': 0.0491, 'sigma8': 0.834, 'ns': 0.9624, 'relspecies': False})
+        else:
+            cosmol = cosmology.setCosmology(sim_cosmol) 
+
+        with timed("p_snap information load"):
+            p_snap, p_red_shift = find_closest_z(p_red_shift,snap_loc,snap_dir_format,snap_format)
+            print("Snapshot number found:", p_snap, "Closest redshift found:", p_red_shift)
+            with h5py.File(sparta_HDF5_path,"r") as f:
+                dic_sim = {}
+                grp_sim = f['simulation']
+                for f in grp_sim.attrs:
+                    dic_sim[f] = grp_sim.attrs[f]
             
-    if os.path.isfile(save_location + "c_ptl_tree.pickle") and reset_lvl < 2:
-            with open(save_location + "c_ptl_tree.pickle", "rb") as pickle_file:
-                c_ptl_tree = pickle.load(pickle_file)
-    else:
-        c_ptl_tree = cKDTree(data = c_ptls_pos, leafsize = 3, balanced_tree = False, boxsize = c_box_size)
-        with open(save_location + "c_ptl_tree.pickle", "wb") as pickle_file:
-            pickle.dump(c_ptl_tree, pickle_file)
+            all_red_shifts = dic_sim['snap_z']
+            p_sparta_snap = np.abs(all_red_shifts - p_red_shift).argmin()
+            print("corresponding SPARTA snap num:", p_sparta_snap)
+            print("check sparta redshift:",all_red_shifts[p_sparta_snap])   
 
+            # Set constants
+            p_snap_path = snap_loc + "snapdir_" + snap_dir_format.format(p_snap) + "/snapshot_" + snap_format.format(p_snap)
+
+            p_scale_factor = 1/(1+p_red_shift)
+            p_rho_m = cosmol.rho_m(p_red_shift)
+            p_hubble_constant = cosmol.Hz(p_red_shift) * 0.001 # convert to units km/s/kpc
+            sim_box_size = dic_sim["box_size"] #units Mpc/h comoving
+            p_box_size = sim_box_size * 10**3 * p_scale_factor #convert to Kpc/h physical
+            little_h = dic_sim["h"]
+
+            p_snap_dict = {
+                "snap":p_snap,
+                "red_shift":p_red_shift,
+                "scale_factor": p_scale_factor,
+                "hubble_const": p_hubble_constant,
+                "box_size": p_box_size,
+                "h":little_h
+            }
+
+        with timed("p_snap SPARTA load"):
+            param_paths = [["halos","position"],["halos","R200m"],["halos","id"],["halos","status"],["halos","last_snap"],["simulation","particle_mass"],["halos","velocity"]]
+            
+            p_sparta_params, p_sparta_param_names = load_SPARTA_data(sparta_HDF5_path, param_paths, curr_sparta_file, p_snap, p_sparta_snap)
+
+            p_halos_pos = p_sparta_params[p_sparta_param_names[0]] * 10**3 * p_scale_factor # convert to kpc/h
+            p_halos_r200m = p_sparta_params[p_sparta_param_names[1]]
+            p_halos_ids = p_sparta_params[p_sparta_param_names[2]]
+            p_halos_status = p_sparta_params[p_sparta_param_names[3]]
+            p_halos_last_snap = p_sparta_params[p_sparta_param_names[4]][:]
+            mass = p_sparta_params[p_sparta_param_names[5]]
+            p_halos_vel = p_sparta_params[p_sparta_param_names[6]]
+
+        # The comparison snap only depends on the dynamical time so it (and where everything is saved) is known before any particles are loaded
+        t_dyn = calc_t_dyn(p_halos_r200m[np.where(p_halos_r200m > 0)[0][0]], p_red_shift)
+        c_snap = find_closest_snap(cosmol.age(p_red_shift) - (t_dyn_step * t_dyn), cosmol, snap_loc, snap_dir_format, snap_format)
+        snapshot_list = [p_snap, c_snap]
 
-    if os.path.isfile(save_location + "num_ptls.pickle") and os.path.isfile(save_location + "match_halo_idxs.pickle") and reset_lvl < 2:
-        with open(save_location + "num_ptls.pickle", "rb") as pickle_file:
-            num_ptls = pickle.load(pickle_file)
-        with open(save_location + "match_halo_idxs.pickle", "rb") as pickle_file:
-            match_halo_idxs = pickle.load(pickle_file)
-    else:
-        # only take halos that are hosts in primary snap and exist past the p_snap and exist in some form at the comparison snap
         if prim_snap_only:
-            match_halo_idxs = np.where((p_halos_status == 10) & (p_halos_last_snap >= p_sparta_snap))[0]
+            save_location =  ML_dset_path + curr_sparta_file + "_" + str(snapshot_list[0]) + "/"
         else:
-            match_halo_idxs = np.where((p_halos_status == 10) & (p_halos_last_snap >= p_sparta_snap) & (c_halos_status > 0) & (c_halos_last_snap >= c_sparta_snap))[0]
-        with mp.Pool(processes=num_processes) as p:           
-            # halo position, halo r200m, if comparison snap, want mass?, want indices?
-            num_ptls = p.starmap(init_search, zip(p_halos_pos[match_halo_idxs], p_halos_r200m[match_halo_idxs], repeat(1.0), repeat(False), repeat(False), repeat(False)), chunksize=curr_chunk_size)
+            save_location =  ML_dset_path + curr_sparta_file + "_" + str(snapshot_list[0]) + "to" + str(snapshot_list[1]) + "/"
+
+        if os.path.exists(save_location) != True:
+            os.makedirs(save_location)
+
+        # A domain reads the cell stores in the pickled data so only the run that made the domains can remove it
+        if reset_lvl == 3 and run_domain is None:
+            clean_dir(pickled_path + str(p_snap) + "_" + curr_sparta_file + "/")
+
+        # With n_domains > 1 this run only splits the halos between the domains, runs them (or leaves them to be run) and merges their datasets
+        if n_domains > 1 and run_domain is None:
+            # The domains read their particles from the snapshots' cell stores (and the halos' particles are counted from them) so they are made first
+            with timed("Cell stores"):
+                c_snap_path = snap_loc + "snapdir_" + snap_dir_format.format(c_snap) + "/snapshot_" + snap_format.format(c_snap)
+                load_cell_store(curr_sparta_file, str(p_snap), p_snap_path, sim_box_size)
+                load_cell_store(curr_sparta_file, str(c_snap), c_snap_path, sim_box_size)
+            
+            with timed("Domain plan"):
+                c_red_shift = load_snap_index(snap_loc, snap_dir_format, snap_format)["red_shift"][c_snap]
+                c_sparta_snap = np.abs(all_red_shifts - c_red_shift).argmin()
+                c_scale_factor = 1/(1+c_red_shift)
+                param_paths = [["halos","position"],["halos","R200m"],["halos","status"],["halos","last_snap"]]
+                c_sparta_params, c_sparta_param_names = load_SPARTA_data(sparta_HDF5_path, param_paths, curr_sparta_file, c_snap, c_sparta_snap)
+                c_halos_pos = c_sparta_params[c_sparta_param_names[0]] * 10**3 * c_scale_factor # convert to kpc/h
+                c_halos_r200m = c_sparta_params[c_sparta_param_names[1]]
+                c_halos_status = c_sparta_params[c_sparta_param_names[2]]
+                c_halos_last_snap = c_sparta_params[c_sparta_param_names[3]][:]
+                
+                # The same halos as a single run uses
+                if prim_snap_only:
+                    match_halo_idxs = np.where((p_halos_status == 10) & (p_halos_last_snap >= p_sparta_snap))[0]
+                else:
+                    match_halo_idxs = np.where((p_halos_status == 10) & (p_halos_last_snap >= p_sparta_snap) & (c_halos_status > 0) & (c_halos_last_snap >= c_sparta_snap))[0]
+                
+                # The halos with less than 200 particles are removed (counted domain by domain for every halo) before they are split into train
+                # and test halos so the split is the same as a single run's
+                domain_num_ptls = None
+                if os.path.isfile(save_location + "domain_num_ptls.pickle") and reset_lvl < 2:
+                    with open(save_location + "domain_num_ptls.pickle", "rb") as pickle_file:
+                        domain_num_ptls = pickle.load(pickle_file)
+                if domain_num_ptls is None or not np.array_equal(domain_num_ptls["halo_idxs"], match_halo_idxs):
+                    with timed("Domain particle counts"):
+                        count_plan = make_domain_plan(match_halo_idxs, np.ones(match_halo_idxs.shape[0], dtype=bool), p_halos_pos, p_halos_r200m, c_halos_pos, c_halos_r200m, p_scale_factor, c_scale_factor)
+                        domain_num_ptls = {"halo_idxs": match_halo_idxs, "num_ptls": count_domain_ptls(match_halo_idxs, count_plan, p_halos_pos, p_halos_r200m, p_scale_factor, p_box_size)}
+                    with open(save_location + "domain_num_ptls.pickle", "wb") as pickle_file:
+                        pickle.dump(domain_num_ptls, pickle_file)
+                res_mask = np.where(domain_num_ptls["num_ptls"] >= 200)[0]
+                if res_mask.size > 0:
+                    match_halo_idxs = match_halo_idxs[res_mask]
+                
+                train_mask = np.arange(match_halo_idxs.shape[0]) < int((1-test_halos_ratio) * match_halo_idxs.shape[0])
+                domain_plan = make_domain_plan(match_halo_idxs, train_mask, p_halos_pos, p_halos_r200m, c_halos_pos, c_halos_r200m, p_scale_factor, c_scale_factor)
+                
+                # Anything the domains saved is for the old plan if it changed. Only the folders made by a domain's job (with a domain_info.json)
+                # are removed
+                saved_plan = None
+                if os.path.isfile(save_location + "domain_plan.pickle"):
+                    with open(save_location + "domain_plan.pickle", "rb") as pickle_file:
+                        saved_plan = pickle.load(pickle_file)
+                if saved_plan is None or pickle.dumps(saved_plan) != pickle.dumps(domain_plan):
+                    for domain in range(max(n_domains, saved_plan["n_domains"] if saved_plan is not None else 0)**3):
+                        if os.path.isfile(get_domain_location(domain) + "domain_info.json"):
+                            shutil.rmtree(get_domain_location(domain))
+                    with open(save_location + "domain_plan.pickle", "wb") as pickle_file:
+                        pickle.dump(domain_plan, pickle_file)
             
+            run_and_merge_domains(domain_plan)
+            sys.exit()
+        
+        # A domain's job saves everything in the domain's own folder
+        if run_domain is not None:
+            with open(save_location + "domain_plan.pickle", "rb") as pickle_file:
+                domain_plan = pickle.load(pickle_file)
+            save_location = get_domain_location(run_domain)
+            if not os.path.isdir(save_location):
+                create_directory(save_location)
+                with open(save_location + "domain_info.json", "w") as file:
+                    json.dump({"domain": run_domain}, file)
+            if os.path.isfile(save_location + "domain_done.json"):
+                os.remove(save_location + "domain_done.json")
+
+        # With a pipelined startup the comparison snap is loaded (and its tree built) on a background thread while the primary snap is loaded
+        if pipeline_startup:
+            c_executor = ThreadPoolExecutor(max_workers=1)
+            c_future = c_executor.submit(load_comp_snap_and_tree, t_dyn)
+
+        # load all information needed for the primary snap
+        with timed("p_snap ptl load"):
+            if run_domain is not None:
+                p_ptls_pid, p_ptls_vel, p_ptls_pos = load_region_ptls(curr_sparta_file, str(p_snap), p_snap_path, p_scale_factor, domain_plan["p_regions"][run_domain]) # km/s, kpc/h
+            elif ptl_phys_f32:
+                p_ptls_pid, p_ptls_vel, p_ptls_pos = load_phys_ptl_params(curr_sparta_file, str(p_snap), p_snap_path, p_scale_factor, sim_box_size) # km/s, kpc/h
+            else:
+                p_ptls_pid, p_ptls_vel, p_ptls_pos = load_ptl_params(curr_sparta_file, ["pid", "vel", "pos"], str(p_snap), p_snap_path) # vel: km/s
+                p_ptls_pos = p_ptls_pos * 10**3 * p_scale_factor # kpc/h
+
+        with timed("p_snap tree load"):
+            # With search_engine=cell_list this (and c_ptl_tree) is a cell list instead of a tree
+            p_ptl_tree = load_or_build_search("p", p_ptls_pos, p_box_size, p_halos_r200m, p_halos_status)
+
+        with timed("c_snap load"):
+            if pipeline_startup:
+                c_snap_info, c_box_size, c_search = c_future.result()
+                c_executor.shutdown()
+            else:
+                c_snap_info, c_box_size, c_search = load_comp_snap_and_tree(t_dyn)
+            c_snap, c_sparta_snap, c_rho_m, c_red_shift, c_scale_factor, c_hubble_constant, c_ptls_pid, c_ptls_vel, c_ptls_pos, c_halos_pos, c_halos_r200m, c_halos_id, c_halos_status, c_halos_last_snap, c_halos_vel = c_snap_info
+        
+            if match_by_pid:
+                c_pid_lookup = c_search
+            else:
+                c_ptl_tree = c_search
+
+        # The particle arrays are shared with the pool workers instead of being sent with every halo. The arrays used here are swapped for the
+        # shared ones so the particles aren't held twice
+        with timed("Share particle arrays"):
+            ptl_shms, ptl_specs = share_arrays({"p_ptls_pid": p_ptls_pid, "p_ptls_pos": p_ptls_pos, "p_ptls_vel": p_ptls_vel, "c_ptls_pid": c_ptls_pid, "c_ptls_pos": c_ptls_pos, "c_ptls_vel": c_ptls_vel}, shared_ptl_arrays)
+            del c_snap_info
+            if pipeline_startup:
+                del c_future
+            shared_ptls, ptl_attached_shms = attach_shared_arrays(ptl_specs)
+            p_ptls_pid, p_ptls_pos, p_ptls_vel = shared_ptls["p_ptls_pid"], shared_ptls["p_ptls_pos"], shared_ptls["p_ptls_vel"]
+            c_ptls_pid, c_ptls_pos, c_ptls_vel = shared_ptls["c_ptls_pid"], shared_ptls["c_ptls_pos"], shared_ptls["c_ptls_vel"]
+        
+        # Where the pool workers load the trees from if they weren't forked from this process
+        tree_paths = {}
+        if search_engine == "kdtree":
+            tree_paths["p_ptl_tree"] = save_location + "p_ptl_tree.pickle"
+        if search_engine == "kdtree" and not match_by_pid:
+            tree_paths["c_ptl_tree"] = save_location + "c_ptl_tree.pickle"
+
+        c_snap_dict = {
+            "snap":c_snap,
+            "red_shift":c_red_shift,
+            "scale_factor": c_scale_factor,
+            "hubble_const": c_hubble_constant,
+            "box_size": c_box_size,
+            "h":little_h
+        }
+
+        # The numba kernel is only used if it is installed and matches the per halo calculation at both snapshots
+        if batch_ptl_calc and use_numba and not (check_numba_kernel(p_snap_dict) and check_numba_kernel(c_snap_dict)):
+            print("numba isn't installed or its particle kernel doesn't match calc_halo_params so NumPy is used instead")
+            use_numba = False
+
+
+        # Only filled in when the full search radius query is done at startup
+        p_full_nbrs = None
+        # It also has to reach R200m for the particle count (the splits only keep the particles within search_radius)
+        full_search_radius = max(search_radius, 1.0)
+        if os.path.isfile(save_location + "num_ptls.pickle") and os.path.isfile(save_location + "match_halo_idxs.pickle") and reset_lvl < 2:
+            with open(save_location + "num_ptls.pickle", "rb") as pickle_file:
+                num_ptls = pickle.load(pickle_file)
+            with open(save_location + "match_halo_idxs.pickle", "rb") as pickle_file:
+                match_halo_idxs = pickle.load(pickle_file)
+        else:
+            # only take halos that are hosts in primary snap and exist past the p_snap and exist in some form at the comparison snap
+            # A domain takes the ones that were given to it
+            if run_domain is not None:
+                match_halo_idxs = np.sort(np.concatenate((domain_plan["train_idxs"][run_domain], domain_plan["test_idxs"][run_domain])))
+            elif prim_snap_only:
+                match_halo_idxs = np.where((p_halos_status == 10) & (p_halos_last_snap >= p_sparta_snap))[0]
+            else:
+                match_halo_idxs = np.where((p_halos_status == 10) & (p_halos_last_snap >= p_sparta_snap) & (c_halos_status > 0) & (c_halos_last_snap >= c_sparta_snap))[0]
+            if batch_tree_search and reuse_full_search:
+                # Do the full search radius query once and get the number of particles within R200m from its distances
+                with timed("Full radius search"):
+                    p_full_nbrs = compact_nbrs(nbr_search(p_ptl_tree, p_halos_pos[match_halo_idxs], full_search_radius * p_halos_r200m[match_halo_idxs], return_dists = True), p_ptls_pid.shape[0])
+                    num_ptls = count_in_radius(p_full_nbrs, 1.0 * p_halos_r200m[match_halo_idxs])
+            elif batch_tree_search:
+                num_ptls = nbr_count(p_ptl_tree, p_halos_pos[match_halo_idxs], 1.0 * p_halos_r200m[match_halo_idxs])
+            else:
+                with make_pool() as p:           
+                    # halo position, halo r200m, if comparison snap, want mass?, want indices?
+                    num_ptls = p.starmap(init_search, zip(p_halos_pos[match_halo_idxs], p_halos_r200m[match_halo_idxs], repeat(1.0), repeat(False), repeat(False), repeat(False)), chunksize=curr_chunk_size)
+                p.close()
+                p.join()
+
             # We want to remove any halos that have less than 200 particles as they are too noisy
             num_ptls = np.array(num_ptls)
             res_mask = np.where(num_ptls >= 200)[0]
@@ -510,105 +1037,142 @@ with timed("Startup"):
             if res_mask.size > 0:
                 num_ptls = num_ptls[res_mask]
                 match_halo_idxs = match_halo_idxs[res_mask]
-            
+                if p_full_nbrs is not None:
+                    p_full_nbrs = subset_nbrs(p_full_nbrs, res_mask)
+        
             with open(save_location + "num_ptls.pickle", "wb") as pickle_file:
                 pickle.dump(num_ptls, pickle_file)
             with open(save_location + "match_halo_idxs.pickle", "wb") as pickle_file:
                 pickle.dump(match_halo_idxs, pickle_file)
-        p.close()
-        p.join() 
-    tot_num_ptls = np.sum(num_ptls)
+        tot_num_ptls = np.sum(num_ptls)
+    
+        total_num_halos = match_halo_idxs.shape[0]
+        
+        # Neighbour lists the splits take their particles from instead of searching. Either the saved ones (save_nbr_cache) or the full
+        # search radius query done above (reuse_full_search)
+        p_nbr_cache = None
+        c_nbr_cache = None
+        if save_nbr_cache:
+            p_nbr_cache = load_or_save_nbr_cache("p", p_snap, p_ptl_tree, match_halo_idxs, p_halos_pos, p_halos_r200m, p_ptls_pid.shape[0], p_full_nbrs, full_search_radius)
+            if prim_snap_only == False and not match_by_pid:
+                c_nbr_cache = load_or_save_nbr_cache("c", c_snap, c_ptl_tree, match_halo_idxs, c_halos_pos, c_halos_r200m, c_ptls_pid.shape[0])
+        elif p_full_nbrs is not None:
+            p_nbr_cache = {"halo_idxs": match_halo_idxs, "nbrs": p_full_nbrs, "search_radius": full_search_radius}
+        del p_full_nbrs
     
-    total_num_halos = match_halo_idxs.shape[0]
+        # Evaluate SPARTA's orbiting/infalling labels once for all the host halos (the same table is used by the plotting scripts)
+        if orb_label_table:
+            with timed("Orbit label table"):
+                p_orb_table = load_orb_label_table(sparta_HDF5_path, curr_sparta_file, p_snap, np.where((p_halos_status == 10) & (p_halos_last_snap >= p_sparta_snap))[0])
     
-    # split all indices into train and test groups
-    split_pnt = int((1-test_halos_ratio) * total_num_halos)
-    train_idxs = match_halo_idxs[:split_pnt]
-    test_idxs = match_halo_idxs[split_pnt:]
-    train_num_ptls = num_ptls[:split_pnt]
-    test_num_ptls = num_ptls[split_pnt:]
-
-    # need to sort indices otherwise sparta.load breaks...
-    train_idxs_inds = train_idxs.argsort()
-    train_idxs = train_idxs[train_idxs_inds]
-    train_num_ptls = train_num_ptls[train_idxs_inds]
+        # split all indices into train and test groups (a domain's halos were split for the whole box in its plan)
+        if run_domain is not None:
+            train_mask = np.isin(match_halo_idxs, domain_plan["train_idxs"][run_domain])
+        else:
+            train_mask = np.arange(total_num_halos) < int((1-test_halos_ratio) * total_num_halos)
+        train_idxs = match_halo_idxs[train_mask]
+        test_idxs = match_halo_idxs[~train_mask]
+        train_num_ptls = num_ptls[train_mask]
+        test_num_ptls = num_ptls[~train_mask]
+
+        # sort the indices so the SPARTA tracer results of each split are read in as few contiguous chunks as possible
+        train_idxs_inds = train_idxs.argsort()
+        train_idxs = train_idxs[train_idxs_inds]
+        train_num_ptls = train_num_ptls[train_idxs_inds]
     
-    test_idxs_inds = test_idxs.argsort()
-    test_idxs = test_idxs[test_idxs_inds]
-    test_num_ptls = test_num_ptls[test_idxs_inds]
+        test_idxs_inds = test_idxs.argsort()
+        test_idxs = test_idxs[test_idxs_inds]
+        test_num_ptls = test_num_ptls[test_idxs_inds]
     
-    train_halo_mem = calc_halo_mem(train_num_ptls)
-    test_halo_mem = calc_halo_mem(test_num_ptls)
+        train_halo_mem = calc_halo_mem(train_num_ptls)
+        test_halo_mem = calc_halo_mem(test_num_ptls)
 
-    train_halo_splits = det_halo_splits(train_halo_mem, save_mem_size)
-    test_halo_splits = det_halo_splits(test_halo_mem, save_mem_size)
+        train_halo_splits = det_halo_splits(train_halo_mem, save_mem_size)
+        test_halo_splits = det_halo_splits(test_halo_mem, save_mem_size)
+        # A domain can have only train or only test halos
+        if train_idxs.size == 0:
+            train_halo_splits = []
+        if test_idxs.size == 0:
+            test_halo_splits = []
         
-    print(f"Total num halos: {total_num_halos:.3e}")
-    print(f"Total num ptls: {tot_num_ptls:.3e}")
-
-    #TODO add functionality to check if all the params are the same and then restart (and throw warning) or maybe just reload them if restart=0
-    config_params = {
-        "sparta_file": curr_sparta_file,
-        "snap_dir_format":snap_dir_format,
-        "snap_format": snap_format,
-        "prim_only": prim_snap_only,
-        "t_dyn_step": t_dyn_step,
-        "p_red_shift":p_red_shift,
-        "search_rad": search_radius,
-        "total_num_snaps": total_num_snaps,
-        "test_halos_ratio": test_halos_ratio,
-        "chunk_size": curr_chunk_size,
-        "HDF5 Mem Size": save_mem_size,
-        "p_snap_info": p_snap_dict,
-        "c_snap_info": c_snap_dict,
-    }
+        print(f"Total num halos: {total_num_halos:.3e}")
+        print(f"Total num ptls: {tot_num_ptls:.3e}")
+
+        #TODO add functionality to check if all the params are the same and then restart (and throw warning) or maybe just reload them if restart=0
+        config_params = {
+            "sparta_file": curr_sparta_file,
+            "snap_dir_format":snap_dir_format,
+            "snap_format": snap_format,
+            "prim_only": prim_snap_only,
+            "t_dyn_step": t_dyn_step,
+            "p_red_shift":p_red_shift,
+            "search_rad": search_radius,
+            "match_by_pid": match_by_pid,
+            "total_num_snaps": total_num_snaps,
+            "test_halos_ratio": test_halos_ratio,
+            "chunk_size": curr_chunk_size,
+            "HDF5 Mem Size": save_mem_size,
+            "p_snap_info": p_snap_dict,
+            "c_snap_info": c_snap_dict,
+        }
 
-    with open((save_location + "config.pickle"), 'wb') as f:
-        pickle.dump(config_params,f)
+        with open((save_location + "config.pickle"), 'wb') as f:
+            pickle.dump(config_params,f)
         
-    create_directory(save_location + "Train/halo_info/")
-    create_directory(save_location + "Train/ptl_info/")
-    create_directory(save_location + "Test/halo_info/")
-    create_directory(save_location + "Test/ptl_info/")
-    if reset_lvl > 0: # At any level of reset we delete the calculated info for particles
-        clean_dir(save_location + "Train/halo_info/")
-        clean_dir(save_location + "Train/ptl_info/")
-        clean_dir(save_location + "Test/halo_info/")
-        clean_dir(save_location + "Test/ptl_info/")
-        train_start_pnt=0
-        test_start_pnt=0
-
-    else: #Otherwise check to see where we were and then continue the calculations from there.
-        train_start_pnt = find_start_pnt(save_location + "Train/ptl_info/")
-        test_start_pnt = find_start_pnt(save_location + "Test/ptl_info/")
-        train_halo_splits = train_halo_splits[train_start_pnt:]
-        test_halo_splits = test_halo_splits[test_start_pnt:]
+        create_directory(save_location + "Train/halo_info/")
+        create_directory(save_location + "Train/ptl_info/")
+        create_directory(save_location + "Test/halo_info/")
+        create_directory(save_location + "Test/ptl_info/")
+        if reset_lvl > 0: # At any level of reset we delete the calculated info for particles
+            clean_dir(save_location + "Train/halo_info/")
+            clean_dir(save_location + "Train/ptl_info/")
+            clean_dir(save_location + "Test/halo_info/")
+            clean_dir(save_location + "Test/ptl_info/")
+            train_start_pnt=0
+            test_start_pnt=0
+
+        else: #Otherwise check to see where we were and then continue the calculations from there.
+            train_start_pnt = find_start_pnt(save_location + "Train/ptl_info/")
+            test_start_pnt = find_start_pnt(save_location + "Test/ptl_info/")
+            train_halo_splits = train_halo_splits[train_start_pnt:]
+            test_halo_splits = test_halo_splits[test_start_pnt:]
         
-    prnt_halo_splits = train_halo_splits.copy()
-    prnt_halo_splits.append(len(train_idxs))        
+        prnt_halo_splits = train_halo_splits.copy()
+        prnt_halo_splits.append(len(train_idxs))        
     
-    for i in range(len(prnt_halo_splits)):
-        if i < len(prnt_halo_splits) - 1:
-            print(((np.sum(train_halo_mem[prnt_halo_splits[i]:prnt_halo_splits[i+1]])) + 128 )*1e-9,"GB")
+        for i in range(len(prnt_halo_splits)):
+            if i < len(prnt_halo_splits) - 1:
+                print(((np.sum(train_halo_mem[prnt_halo_splits[i]:prnt_halo_splits[i+1]])) + 128 )*1e-9,"GB")
         
-with timed("Finished Calc"):   
-    train_num_iter = len(train_halo_splits)
-    train_prnt_halo_splits = train_halo_splits.copy()
-    train_prnt_halo_splits.append(train_idxs.size)
-    print("Train Splits")
-    print("Num halos in each split:", ", ".join(map(str, np.diff(prnt_halo_splits))) + ".", train_num_iter, "splits")
-    ptl_idx = 0
-    halo_idx = 0
+    with timed("Finished Calc"):   
+        train_num_iter = len(train_halo_splits)
+        train_prnt_halo_splits = train_halo_splits.copy()
+        train_prnt_halo_splits.append(train_idxs.size)
+        print("Train Splits")
+        print("Num halos in each split:", ", ".join(map(str, np.diff(prnt_halo_splits))) + ".", train_num_iter, "splits")
+        ptl_idx = 0
+        halo_idx = 0
     
-    for i in range(train_num_iter):
-        halo_idx, ptl_idx = halo_loop(halo_idx=halo_idx,ptl_idx=ptl_idx,curr_iter=i,num_iter=train_num_iter,rst_pnt=train_start_pnt,indices=train_idxs, halo_splits=train_halo_splits, dst_name="Train", tot_num_ptls=tot_num_ptls, p_halo_ids=p_halos_ids, p_dict=p_snap_dict, p_ptls_pid=p_ptls_pid, p_ptls_pos=p_ptls_pos, p_ptls_vel=p_ptls_vel, c_dict=c_snap_dict, c_ptls_pid=c_ptls_pid, c_ptls_pos=c_ptls_pos, c_ptls_vel=c_ptls_vel)
+        # The SPARTA data of the next splits is loaded in the background while the current split is calculated
+        train_split_sparta = prefetch_iter(load_split_sparta, (get_split_indices(train_idxs, train_halo_splits, i) for i in range(train_num_iter)), depth = sparta_prefetch_depth)
+        for i, split_sparta in enumerate(train_split_sparta):
+            halo_idx, ptl_idx = halo_loop(halo_idx=halo_idx,ptl_idx=ptl_idx,curr_iter=i,num_iter=train_num_iter,rst_pnt=train_start_pnt,indices=train_idxs, halo_splits=train_halo_splits, dst_name="Train", tot_num_ptls=tot_num_ptls, p_halo_ids=p_halos_ids, p_dict=p_snap_dict, p_ptls_pid=p_ptls_pid, p_ptls_pos=p_ptls_pos, p_ptls_vel=p_ptls_vel, c_dict=c_snap_dict, c_ptls_pid=c_ptls_pid, c_ptls_pos=c_ptls_pos, c_ptls_vel=c_ptls_vel, split_sparta=split_sparta)
+    
+        test_num_iter = len(test_halo_splits)
+        test_prnt_halo_splits = test_halo_splits.copy()
+        test_prnt_halo_splits.append(test_idxs.size)
+        print("Test Splits")
+        print("Num halos in each split:", ", ".join(map(str, np.diff(prnt_halo_splits))) + ".", test_num_iter, "splits")
+        ptl_idx = 0
+        halo_idx = 0
+        test_split_sparta = prefetch_iter(load_split_sparta, (get_split_indices(test_idxs, test_halo_splits, i) for i in range(test_num_iter)), depth = sparta_prefetch_depth)
+        for i, split_sparta in enumerate(test_split_sparta):
+            halo_idx, ptl_idx = halo_loop(halo_idx=halo_idx,ptl_idx=ptl_idx,curr_iter=i,num_iter=test_num_iter,rst_pnt=test_start_pnt,indices=test_idxs, halo_splits=test_halo_splits, dst_name="Test", tot_num_ptls=tot_num_ptls, p_halo_ids=p_halos_ids, p_dict=p_snap_dict, p_ptls_pid=p_ptls_pid, p_ptls_pos=p_ptls_pos, p_ptls_vel=p_ptls_vel, c_dict=c_snap_dict, c_ptls_pid=c_ptls_pid, c_ptls_pos=c_ptls_pos, c_ptls_vel=c_ptls_vel, split_sparta=split_sparta)
+
+    # Every split is done so the shared particle arrays can be removed
+    free_shared_arrays(ptl_shms)
     
-    test_num_iter = len(test_halo_splits)
-    test_prnt_halo_splits = test_halo_splits.copy()
-    test_prnt_halo_splits.append(test_idxs.size)
-    print("Test Splits")
-    print("Num halos in each split:", ", ".join(map(str, np.diff(prnt_halo_splits))) + ".", test_num_iter, "splits")
-    ptl_idx = 0
-    halo_idx = 0
-    for i in range(test_num_iter):
-        halo_idx, ptl_idx = halo_loop(halo_idx=halo_idx,ptl_idx=ptl_idx,curr_iter=i,num_iter=test_num_iter,rst_pnt=test_start_pnt,indices=test_idxs, halo_splits=test_halo_splits, dst_name="Test", tot_num_ptls=tot_num_ptls, p_halo_ids=p_halos_ids, p_dict=p_snap_dict, p_ptls_pid=p_ptls_pid, p_ptls_pos=p_ptls_pos, p_ptls_vel=p_ptls_vel, c_dict=c_snap_dict, c_ptls_pid=c_ptls_pid, c_ptls_pos=c_ptls_pos, c_ptls_vel=c_ptls_vel)
+    # The merge only uses domains that finished
+    if run_domain is not None:
+        with open(save_location + "domain_done.json", "w") as file:
+            json.dump({"domain": run_domain, "domain_key": get_domain_key(domain_plan), "train_halos": int(train_idxs.size), "test_halos": int(test_idxs.size)}, file)
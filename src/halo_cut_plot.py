@@ -6,11 +6,10 @@ import re
 import configparser
 import h5py
 import numpy as np
-from sparta_tools import sparta
 
 from utils.ML_support import get_combined_name,reform_dataset_dfs,split_calc_name
 from utils.update_vis_fxns import plot_halo_slice
-from utils.data_and_loading_functions import parse_ranges,create_nu_string,create_directory,find_closest_z,load_SPARTA_data,timed,load_ptl_param
+from utils.data_and_loading_functions import parse_ranges,create_nu_string,create_directory,find_closest_z,load_SPARTA_data,timed,load_cell_store,load_ptls_in_spheres,load_halo_orb_labels
 
 config = configparser.ConfigParser()
 config.read(os.getcwd() + "/config.ini")
@@ -34,6 +33,7 @@ if match:
 SPARTA_hdf5_path = SPARTA_output_path + sparta_name + "/" + curr_sparta_file + ".hdf5"
 
 search_radius = config.getfloat("SEARCH","search_radius")
+orb_label_table = config.getboolean("SEARCH","orb_label_table")
 test_sims = json.loads(config.get("XGBOOST","test_sims"))
 model_sims = json.loads(config.get("XGBOOST","model_sims"))
 model_type = config["XGBOOST"]["model_type"]
@@ -58,9 +58,6 @@ create_directory(plot_loc)
 halo_ddf = reform_dataset_dfs(ML_dset_path + sim + "/" + "Test" + "/halo_info/")
 all_idxs = halo_ddf["Halo_indices"].values
 
-with open(ML_dset_path + sim + "/p_ptl_tree.pickle", "rb") as pickle_file:
-    tree = pickle.load(pickle_file)
-        
 sparta_name, sparta_search_name = split_calc_name(sim)
 # find the snapshots for this simulation
 snap_pat = r"(\d+)to(\d+)"
@@ -93,21 +90,20 @@ p_sparta_snap = np.abs(all_red_shifts - curr_z).argmin()
 
 
 param_paths = [["halos","position"],["halos","R200m"],["halos","id"],["halos","status"],["halos","last_snap"],["simulation","particle_mass"]]
-sparta_params, sparta_param_names = load_SPARTA_data(curr_sparta_HDF5_path, param_paths, curr_sparta_file, p_snap)
+sparta_params, sparta_param_names = load_SPARTA_data(curr_sparta_HDF5_path, param_paths, curr_sparta_file, p_snap, p_sparta_snap)
 
-halos_pos = sparta_params[sparta_param_names[0]][:,p_sparta_snap,:] * 10**3 * p_scale_factor # convert to kpc/h
-halos_r200m = sparta_params[sparta_param_names[1]][:,p_sparta_snap]
-halos_ids = sparta_params[sparta_param_names[2]][:,p_sparta_snap]
-halos_status = sparta_params[sparta_param_names[3]][:,p_sparta_snap]
+halos_pos = sparta_params[sparta_param_names[0]] * 10**3 * p_scale_factor # convert to kpc/h
+halos_r200m = sparta_params[sparta_param_names[1]]
+halos_ids = sparta_params[sparta_param_names[2]]
+halos_status = sparta_params[sparta_param_names[3]]
 halos_last_snap = sparta_params[sparta_param_names[4]][:]
 ptl_mass = sparta_params[sparta_param_names[5]]
 
 snap_loc = snap_path + sparta_name + "/"
 p_snap_path = snap_loc + "snapdir_" + snap_dir_format.format(p_snap) + "/snapshot_" + snap_format.format(p_snap)
 
-ptls_pid = load_ptl_param(curr_sparta_file, "pid", str(p_snap), p_snap_path) 
-ptls_vel = load_ptl_param(curr_sparta_file, "vel", str(p_snap), p_snap_path) # km/s
-ptls_pos = load_ptl_param(curr_sparta_file, "pos", str(p_snap), p_snap_path) * 10**3 * p_scale_factor # kpc/h
+# Only the particles around the plotted halos are loaded from a cell sorted copy of the snapshot
+cell_store = load_cell_store(curr_sparta_file, str(p_snap), p_snap_path, dic_sim["box_size"])
 
 random.seed(365)
 used_numbers = set()
@@ -121,11 +117,10 @@ while len(used_numbers) < 25:
         use_halo_r200m = halos_r200m[use_idx]
         use_halo_id = halos_ids[use_idx]
 
-        ptl_indices = tree.query_ball_point(use_halo_pos, r = search_radius * 1.5 * use_halo_r200m)
-        ptl_indices = np.array(ptl_indices)
-
-        curr_ptl_pos = ptls_pos[ptl_indices]
-        curr_ptl_pids = ptls_pid[ptl_indices]
+        # The cell store is in comoving Mpc/h so convert the search sphere and then the found positions back to kpc/h
+        roi_pids, roi_pos, roi_vel = load_ptls_in_spheres(cell_store, [use_halo_pos / (10**3 * p_scale_factor)], [search_radius * 1.5 * use_halo_r200m / (10**3 * p_scale_factor)])
+        curr_ptl_pos = roi_pos[0] * 10**3 * p_scale_factor # kpc/h
+        curr_ptl_pids = roi_pids[0]
 
         num_new_ptls = curr_ptl_pos.shape[0]
         
@@ -134,28 +129,7 @@ while len(used_numbers) < 25:
         else:
             continue
 
-        sparta_output = sparta.load(filename = SPARTA_hdf5_path, halo_ids=use_halo_id, log_level=0)
-
-        sparta_last_pericenter_snap = sparta_output['tcr_ptl']['res_oct']['last_pericenter_snap']
-        sparta_n_pericenter = sparta_output['tcr_ptl']['res_oct']['n_pericenter']
-        sparta_tracer_ids = sparta_output['tcr_ptl']['res_oct']['tracer_id']
-        sparta_n_is_lower_limit = sparta_output['tcr_ptl']['res_oct']['n_is_lower_limit']
-
-        compare_sparta_assn = np.zeros((sparta_tracer_ids.shape[0]))
-        curr_orb_assn = np.zeros((num_new_ptls))
-            # Anywhere sparta_last_pericenter is greater than the current snap then that is in the future so set to 0
-        future_peri = np.where(sparta_last_pericenter_snap > p_snap)[0]
-        adj_sparta_n_pericenter = sparta_n_pericenter
-        adj_sparta_n_pericenter[future_peri] = 0
-        adj_sparta_n_is_lower_limit = sparta_n_is_lower_limit
-        adj_sparta_n_is_lower_limit[future_peri] = 0
-        # If a particle has a pericenter or if the lower limit is 1 then it is orbiting
-
-        compare_sparta_assn[np.where((adj_sparta_n_pericenter >= 1) | (adj_sparta_n_is_lower_limit == 1))[0]] = 1
-        # compare_sparta_assn[np.where(adj_sparta_n_pericenter >= 1)] = 1
-
-        # Compare the ids between SPARTA and the found prtl ids and match the SPARTA results
-        matched_ids = np.intersect1d(curr_ptl_pids, sparta_tracer_ids, return_indices = True)
-        curr_orb_assn[matched_ids[1]] = compare_sparta_assn[matched_ids[2]]
+        # SPARTA's orbit labels for the found particles of only the plotted halo
+        curr_orb_assn = load_halo_orb_labels(curr_sparta_HDF5_path, curr_sparta_file, p_snap, use_idx, curr_ptl_pids, orb_label_table)
 
         plot_halo_slice(curr_ptl_pos,curr_orb_assn,use_halo_pos,use_halo_r200m,plot_loc,search_rad=4,title=str(num)+"_")
\ No newline at end of file
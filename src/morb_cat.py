@@ -10,8 +10,9 @@ import os
 import multiprocessing as mp
 from itertools import repeat
 import configparser
-from utils.data_and_loading_functions import load_SPARTA_data, load_ptl_param, save_to_hdf5, conv_halo_id_spid, save_pickle, create_directory, find_closest_z
+from utils.data_and_loading_functions import load_SPARTA_data, load_ptl_param, save_to_hdf5, conv_halo_id_spid, save_pickle, create_directory, find_closest_z, load_orb_label_table, lookup_orb_labels
 from utils.calculation_functions import *
+from utils.search_functions import nbrs_from_lists, subset_nbrs, compact_nbrs, gather_nbrs
 ##################################################################################################################
 # LOAD CONFIG PARAMETERS
 config = configparser.ConfigParser()
@@ -32,6 +33,7 @@ per_n_halo_per_split = config.getfloat("SEARCH","per_n_halo_per_split")
 num_processes = mp.cpu_count()
 curr_chunk_size = config.getint("SEARCH","chunk_size")
 num_save_ptl_params = config.getint("SEARCH","num_save_ptl_params")
+orb_label_table = config.getboolean("SEARCH","orb_label_table")
 ##################################################################################################################
 from sparta_tools import sparta
 ##################################################################################################################
@@ -59,7 +61,7 @@ def initial_search(halo_positions, halo_r200m, find_mass = False, find_ptl_indic
             all_ptl_indices = indices
     else:
         num_new_particles = 0
-        all_ptl_indices = np.empty(1)
+        all_ptl_indices = np.empty(0, dtype=np.int64)
     
     if find_mass == False and find_ptl_indices == False:
         return num_new_particles
@@ -71,7 +73,7 @@ def initial_search(halo_positions, halo_r200m, find_mass = False, find_ptl_indic
         return num_new_particles, halo_mass, all_ptl_indices
     
 def search_halos(snap_dict, curr_halo_idx, curr_sparta_idx, curr_ptl_pids, curr_ptl_pos, curr_ptl_vel, 
-                 halo_pos, halo_vel, halo_r200m, sparta_last_pericenter_snap=None, sparta_n_pericenter=None, sparta_tracer_ids=None,
+                 halo_pos, halo_vel, halo_r200m, ptl_orb_assn=None, sparta_last_pericenter_snap=None, sparta_n_pericenter=None, sparta_tracer_ids=None,
                  sparta_n_is_lower_limit=None, find_subhalos=False, dens_prf_all=None, dens_prf_1halo=None, bins=None, create_dens_prf=False):
     # Doing this this way as otherwise will have to generate super large arrays for input from multiprocessing
     snap = snap_dict["snap"]
@@ -84,22 +86,16 @@ def search_halos(snap_dict, curr_halo_idx, curr_sparta_idx, curr_ptl_pids, curr_
 
     curr_ptl_pids = curr_ptl_pids.astype(np.int64) # otherwise ne.evaluate doesn't work
     
-    compare_sparta_assn = np.zeros((sparta_tracer_ids.shape[0]))
-    curr_orb_assn = np.zeros((num_new_ptls))
-        # Anywhere sparta_last_pericenter is greater than the current snap then that is in the future so set to 0
-    future_peri = np.where(sparta_last_pericenter_snap > snap)[0]
-    adj_sparta_n_pericenter = sparta_n_pericenter
-    adj_sparta_n_pericenter[future_peri] = 0
-    adj_sparta_n_is_lower_limit = sparta_n_is_lower_limit
-    adj_sparta_n_is_lower_limit[future_peri] = 0
-    # If a particle has a pericenter of the lower limit is 1 then it is orbiting
-    if (total_num_snaps - snap) <= 3:
-        compare_sparta_assn[np.where((adj_sparta_n_pericenter >= 1) | (adj_sparta_n_is_lower_limit == 1))[0]] = 1
-    else: 
-        compare_sparta_assn[np.where(adj_sparta_n_pericenter >= 1)] = 1
-    # Compare the ids between SPARTA and the found prtl ids and match the SPARTA results
-    matched_ids = np.intersect1d(curr_ptl_pids, sparta_tracer_ids, return_indices = True)
-    curr_orb_assn[matched_ids[1]] = compare_sparta_assn[matched_ids[2]]
+    # If the labels were already looked up from the orbit label table they are used as is
+    if ptl_orb_assn is not None:
+        curr_orb_assn = ptl_orb_assn
+    else:
+        # The lower limit of the number of pericenters is only trusted for the last few snapshots
+        compare_sparta_assn = calc_orb_assn(sparta_last_pericenter_snap, sparta_n_pericenter, sparta_n_is_lower_limit, snap, use_lower_lim = (total_num_snaps - snap) <= 3)
+        curr_orb_assn = np.zeros((num_new_ptls))
+        # Compare the ids between SPARTA and the found prtl ids and match the SPARTA results
+        matched_ids = np.intersect1d(curr_ptl_pids, sparta_tracer_ids, return_indices = True)
+        curr_orb_assn[matched_ids[1]] = compare_sparta_assn[matched_ids[2]]
     
     m_orb = np.where(curr_orb_assn == 1)[0].shape[0] * mass  
     
@@ -118,6 +114,10 @@ def search_halos(snap_dict, curr_halo_idx, curr_sparta_idx, curr_ptl_pids, curr_
 def halo_loop(indices, p_halo_ids, p_dict, p_ptls_pid, p_ptls_pos, p_ptls_vel, find_subhalos=True):
     num_iter = int(np.ceil(indices.shape[0] / num_halo_per_split))
     print("Num halo per", num_iter, "splits:", num_halo_per_split)
+    
+    # Evaluate SPARTA's orbit labels for all these halos at once
+    if orb_label_table:
+        orb_table = load_orb_label_table(path_to_hdf5_file, curr_sparta_file, p_dict["snap"], indices, use_lower_lim = (total_num_snaps - p_dict["snap"]) <= 3)
     hdf5_ptl_idx = 0
     hdf5_halo_idx = 0
     
@@ -137,7 +137,9 @@ def halo_loop(indices, p_halo_ids, p_dict, p_ptls_pid, p_ptls_pos, p_ptls_vel, f
         sparta_output = sparta.load(filename=path_to_hdf5_file, halo_ids=use_halo_ids, log_level=0)
 
         new_idxs = conv_halo_id_spid(use_halo_ids, sparta_output, p_sparta_snap) # If the order changed by sparta re-sort the indices
-        use_halo_idxs = use_indices[new_idxs]
+        # new_idxs gives the SPARTA row of each of our halos so invert it to get the halo index of each SPARTA row
+        use_halo_idxs = np.empty_like(use_indices)
+        use_halo_idxs[new_idxs] = use_indices
 
         # Search around these halos and get the number of particles and the corresponding ptl indices for them
         p_use_halos_pos = sparta_output['halos']['position'][:,p_sparta_snap] * 10**3 * p_scale_factor 
@@ -150,12 +152,18 @@ def halo_loop(indices, p_halo_ids, p_dict, p_ptls_pid, p_ptls_pos, p_ptls_vel, f
         p.join() 
 
         # Remove halos with 0 ptls around them
-        p_use_num_ptls = np.array(p_use_num_ptls)
-        p_curr_ptl_indices = np.array(p_curr_ptl_indices, dtype=object)
-        has_ptls = np.where(p_use_num_ptls > 0)
+        p_nbrs = nbrs_from_lists(p_curr_ptl_indices)
+        p_use_num_ptls = np.diff(p_nbrs["offsets"])
+        has_ptls = np.where(p_use_num_ptls > 0)[0]
+        p_nbrs = compact_nbrs(subset_nbrs(p_nbrs, has_ptls), p_ptls_pid.shape[0])
         p_use_num_ptls = p_use_num_ptls[has_ptls]
-        p_curr_ptl_indices = p_curr_ptl_indices[has_ptls]
         p_use_halo_idxs = use_halo_idxs[has_ptls]
+        ptl_offsets = p_nbrs["offsets"]
+        
+        # The pids, positions and velocities of all of the split's found particles gathered at once
+        p_split_pid = gather_nbrs(p_nbrs, p_ptls_pid)
+        p_split_pos = gather_nbrs(p_nbrs, p_ptls_pos)
+        p_split_vel = gather_nbrs(p_nbrs, p_ptls_vel)
        
         p_start_num_ptls = [np.sum(p_use_num_ptls[0:i+1]) for i in range(p_use_num_ptls.shape[0])]
         p_start_num_ptls = np.insert(p_start_num_ptls, 0, 0)
@@ -164,24 +172,32 @@ def halo_loop(indices, p_halo_ids, p_dict, p_ptls_pid, p_ptls_pos, p_ptls_vel, f
         
         p_tot_num_use_ptls = int(np.sum(p_use_num_ptls))
 
-        halo_first = sparta_output['halos']['ptl_oct_first'][:]
-        halo_n = sparta_output['halos']['ptl_oct_n'][:]
+        if orb_label_table:
+            # Get the orbit labels of every particle found in this split with one lookup
+            all_orb_labels = lookup_orb_labels(orb_table, np.repeat(p_use_halo_idxs, p_use_num_ptls), p_split_pid)
+            orb_args = ((all_orb_labels[ptl_offsets[m]:ptl_offsets[m+1]] for m in range(curr_num_halos)), repeat(None), repeat(None), repeat(None), repeat(None))
+        else:
+            # Otherwise each halo's SPARTA tracers are matched to its particles
+            halo_first = sparta_output['halos']['ptl_oct_first'][has_ptls]
+            halo_n = sparta_output['halos']['ptl_oct_n'][has_ptls]
+            orb_args = (repeat(None),
+                        (sparta_output['tcr_ptl']['res_oct']['last_pericenter_snap'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
+                        (sparta_output['tcr_ptl']['res_oct']['n_pericenter'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
+                        (sparta_output['tcr_ptl']['res_oct']['tracer_id'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
+                        (sparta_output['tcr_ptl']['res_oct']['n_is_lower_limit'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)))
         
         # Use multiprocessing to search multiple halos at the same time and add information to shared arrays
         with mp.Pool(processes=num_processes) as p:
             if find_subhalos:
                 all_halo_id, all_halo_pos, all_halo_vel, all_m_orb, all_halo_m200m, all_halo_r200m, all_orb_pid, all_subhalo_id = zip(*p.starmap(search_halos, 
                                             zip(repeat(p_dict), p_use_halo_idxs, np.arange(curr_num_halos),
-                                            (p_ptls_pid[p_curr_ptl_indices[i]] for i in range(curr_num_halos)), 
-                                            (p_ptls_pos[p_curr_ptl_indices[j]] for j in range(curr_num_halos)),
-                                            (p_ptls_vel[p_curr_ptl_indices[k]] for k in range(curr_num_halos)),
-                                            (sparta_output['halos']['position'][l,p_sparta_snap,:] for l in range(curr_num_halos)),
-                                            (sparta_output['halos']['velocity'][l,p_sparta_snap,:] for l in range(curr_num_halos)),
-                                            (sparta_output['halos']['R200m'][l,p_sparta_snap] for l in range(curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['last_pericenter_snap'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['n_pericenter'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['tracer_id'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['n_is_lower_limit'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
+                                            (p_split_pid[ptl_offsets[i]:ptl_offsets[i+1]] for i in range(curr_num_halos)), 
+                                            (p_split_pos[ptl_offsets[j]:ptl_offsets[j+1]] for j in range(curr_num_halos)),
+                                            (p_split_vel[ptl_offsets[k]:ptl_offsets[k+1]] for k in range(curr_num_halos)),
+                                            (sparta_output['halos']['position'][has_ptls[l],p_sparta_snap,:] for l in range(curr_num_halos)),
+                                            (sparta_output['halos']['velocity'][has_ptls[l],p_sparta_snap,:] for l in range(curr_num_halos)),
+                                            (sparta_output['halos']['R200m'][has_ptls[l],p_sparta_snap] for l in range(curr_num_halos)),
+                                            *orb_args,
                                             repeat(find_subhalos),
                                             # Uncomment below to create dens profiles
                                             #(sparta_output['anl_prf']['M_all'][l,p_sparta_snap,:] for l in range(curr_num_halos)),
@@ -191,16 +207,13 @@ def halo_loop(indices, p_halo_ids, p_dict, p_ptls_pid, p_ptls_pos, p_ptls_vel, f
             else:
                 all_halo_id, all_halo_pos, all_halo_vel, all_m_orb, all_halo_m200m, all_halo_r200m, all_orb_pid = zip(*p.starmap(search_halos, 
                                             zip(repeat(p_dict), p_use_halo_idxs, np.arange(curr_num_halos),
-                                            (p_ptls_pid[p_curr_ptl_indices[i]] for i in range(curr_num_halos)), 
-                                            (p_ptls_pos[p_curr_ptl_indices[j]] for j in range(curr_num_halos)),
-                                            (p_ptls_vel[p_curr_ptl_indices[k]] for k in range(curr_num_halos)),
-                                            (sparta_output['halos']['position'][l,p_sparta_snap,:] for l in range(curr_num_halos)),
-                                            (sparta_output['halos']['velocity'][l,p_sparta_snap,:] for l in range(curr_num_halos)),
-                                            (sparta_output['halos']['R200m'][l,p_sparta_snap] for l in range(curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['last_pericenter_snap'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['n_pericenter'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['tracer_id'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
-                                            (sparta_output['tcr_ptl']['res_oct']['n_is_lower_limit'][halo_first[m]:halo_first[m]+halo_n[m]] for m in range(curr_num_halos)),
+                                            (p_split_pid[ptl_offsets[i]:ptl_offsets[i+1]] for i in range(curr_num_halos)), 
+                                            (p_split_pos[ptl_offsets[j]:ptl_offsets[j+1]] for j in range(curr_num_halos)),
+                                            (p_split_vel[ptl_offsets[k]:ptl_offsets[k+1]] for k in range(curr_num_halos)),
+                                            (sparta_output['halos']['position'][has_ptls[l],p_sparta_snap,:] for l in range(curr_num_halos)),
+                                            (sparta_output['halos']['velocity'][has_ptls[l],p_sparta_snap,:] for l in range(curr_num_halos)),
+                                            (sparta_output['halos']['R200m'][has_ptls[l],p_sparta_snap] for l in range(curr_num_halos)),
+                                            *orb_args,
                                             repeat(find_subhalos),
                                             # Uncomment below to create dens profiles
                                             #(sparta_output['anl_prf']['M_all'][l,p_sparta_snap,:] for l in range(curr_num_halos)),
@@ -9,6 +9,7 @@ import numpy as np
 import os
 import pickle
 import json
+import hashlib
 import h5py
 import re
 import pandas as pd
@@ -21,7 +22,7 @@ from skopt.space import Real
 from sklearn.metrics import accuracy_score
 from functools import partial
 
-from .data_and_loading_functions import load_SPARTA_data, find_closest_z, conv_halo_id_spid, timed, split_data_by_halo, parse_ranges, create_nu_string
+from .data_and_loading_functions import load_SPARTA_data, find_closest_z, conv_halo_id_spid, timed, split_data_by_halo, parse_ranges, create_nu_string, create_directory, get_src_fingerprint, check_store_source, save_ptl_store, load_ptl_store
 from .update_vis_fxns import plot_full_ptl_dist, plot_miss_class_dist, compare_prfs_nu, compare_prfs, inf_orb_frac
 from .calculation_functions import create_mass_prf, create_stack_mass_prf, filter_prf, calculate_density
 from sparta_tools import sparta 
@@ -420,6 +421,76 @@ def load_data(client, sims, dset_name, bin_edges = None, limit_files = False, sc
     else:
         return all_dask_dfs,act_scale_pos_weight
 
+mass_prf_names = ["M_all", "M_1halo", "R200m", "bins", "particle_mass"]
+# Part of the mass profile cache's key so caches saved before R200m was put in the order of use_idxs are rebuilt
+mass_prf_version = 2
+
+# Load SPARTA's mass profiles, R200m, the profile bins, and the particle mass for a set of halos of a sim. They are saved once as memory 
+# mapped .npy files keyed by the SPARTA file, the snapshot, and the halo indices so repeated evaluations (and every HPO iteration) 
+# don't touch SPARTA again. The saved files are rebuilt if the SPARTA file changes
+def load_sim_mass_prf(sim, use_idxs):
+    sparta_name, sparta_search_name = split_calc_name(sim)
+    # find the snapshots for this simulation
+    snap_pat = r"(\d+)to(\d+)"
+    match = re.search(snap_pat, sim)
+    if match:
+        curr_snap_list = [match.group(1), match.group(2)] 
+    curr_sparta_HDF5_path = SPARTA_output_path + sparta_name + "/" + sparta_search_name + ".hdf5"
+    
+    with open(ML_dset_path + sim + "/config.pickle", "rb") as file:
+        config_dict = pickle.load(file)
+    curr_z = config_dict["p_snap_info"]["red_shift"][()]
+    
+    use_idxs = np.ascontiguousarray(use_idxs, dtype=np.int64)
+    prf_hash = hashlib.blake2b(use_idxs.tobytes() + str(curr_z).encode() + str(mass_prf_version).encode(), digest_size=8).hexdigest()
+    store_path = pickled_path + "mass_prf_" + sparta_search_name + "/" + curr_snap_list[0] + "_" + prf_hash + "/"
+    create_directory(store_path)
+    check_store_source(store_path, get_src_fingerprint([curr_sparta_HDF5_path]))
+    
+    try:
+        return {name: load_ptl_store(store_path, name, curr_snap_list[0]) for name in mass_prf_names}
+    except FileNotFoundError:
+        pass
+    
+    curr_snap_dir_format = config_dict["snap_dir_format"]
+    curr_snap_format = config_dict["snap_format"]
+    new_p_snap, curr_z = find_closest_z(curr_z,snap_path + sparta_name + "/",curr_snap_dir_format,curr_snap_format)
+    
+    with h5py.File(curr_sparta_HDF5_path,"r") as f:
+        dic_sim = {}
+        grp_sim = f['simulation']
+
+        for attr in grp_sim.attrs:
+            dic_sim[attr] = grp_sim.attrs[attr]
+    
+    all_red_shifts = dic_sim['snap_z']
+    p_sparta_snap = np.abs(all_red_shifts - curr_z).argmin()
+    
+    param_paths = [["halos","id"],["simulation","particle_mass"]]
+    sparta_params, sparta_param_names = load_SPARTA_data(curr_sparta_HDF5_path, param_paths, sparta_search_name, curr_snap_list[0], p_sparta_snap)
+    halos_ids = sparta_params[sparta_param_names[0]]
+    ptl_mass = sparta_params[sparta_param_names[1]]
+
+    use_halo_ids = halos_ids[use_idxs]
+    
+    sparta_output = sparta.load(filename=curr_sparta_HDF5_path, halo_ids=use_halo_ids, log_level=0)
+    new_idxs = conv_halo_id_spid(use_halo_ids, sparta_output, p_sparta_snap) # If the order changed by sparta re-sort the indices
+    
+    bins = sparta_output["config"]['anl_prf']["r_bins_lin"]
+    bins = np.insert(bins, 0, 0)
+    
+    mass_prf = {
+        "M_all": sparta_output['anl_prf']['M_all'][new_idxs,p_sparta_snap,:],
+        "M_1halo": sparta_output['anl_prf']['M_1halo'][new_idxs,p_sparta_snap,:],
+        "R200m": sparta_output['halos']['R200m'][new_idxs,p_sparta_snap],
+        "bins": bins,
+        "particle_mass": np.array([ptl_mass]),
+    }
+    for name in mass_prf_names:
+        save_ptl_store(store_path, name, curr_snap_list[0], np.ascontiguousarray(mass_prf[name]))
+    
+    return {name: load_ptl_store(store_path, name, curr_snap_list[0]) for name in mass_prf_names}
+
 # Reconstruct SPARTA's mass profiles and stack them together for a list of sims
 def load_sprta_mass_prf(sim_splits,all_idxs,use_sims,ret_r200m=False):                
     mass_prf_all_list = []
@@ -434,59 +505,18 @@ def load_sprta_mass_prf(sim_splits,all_idxs,use_sims,ret_r200m=False):
         else:
             use_idxs = all_idxs[sim_splits[i]:]
         
+        mass_prf = load_sim_mass_prf(sim, use_idxs)
         
-        sparta_name, sparta_search_name = split_calc_name(sim)
-        # find the snapshots for this simulation
-        snap_pat = r"(\d+)to(\d+)"
-        match = re.search(snap_pat, sim)
-        if match:
-            curr_snap_list = [match.group(1), match.group(2)] 
-        
-        with open(ML_dset_path + sim + "/config.pickle", "rb") as file:
-            config_dict = pickle.load(file)
-            
-            curr_z = config_dict["p_snap_info"]["red_shift"][()]
-            curr_snap_dir_format = config_dict["snap_dir_format"]
-            curr_snap_format = config_dict["snap_format"]
-            new_p_snap, curr_z = find_closest_z(curr_z,snap_path + sparta_name + "/",curr_snap_dir_format,curr_snap_format)
-            p_scale_factor = 1/(1+curr_z)
-        
-        curr_sparta_HDF5_path = SPARTA_output_path + sparta_name + "/" + sparta_search_name + ".hdf5"
-        
-        with h5py.File(curr_sparta_HDF5_path,"r") as f:
-            dic_sim = {}
-            grp_sim = f['simulation']
-
-            for attr in grp_sim.attrs:
-                dic_sim[attr] = grp_sim.attrs[attr]
-        
-        all_red_shifts = dic_sim['snap_z']
-        p_sparta_snap = np.abs(all_red_shifts - curr_z).argmin()
-        
-        
-        param_paths = [["halos","id"],["simulation","particle_mass"]]
-        sparta_params, sparta_param_names = load_SPARTA_data(curr_sparta_HDF5_path, param_paths, sparta_search_name, curr_snap_list[0])
-        halos_ids = sparta_params[sparta_param_names[0]][:,p_sparta_snap]
-        ptl_mass = sparta_params[sparta_param_names[1]]
- 
-        use_halo_ids = halos_ids[use_idxs]
-        
-        sparta_output = sparta.load(filename=curr_sparta_HDF5_path, halo_ids=use_halo_ids, log_level=0)
-        new_idxs = conv_halo_id_spid(use_halo_ids, sparta_output, p_sparta_snap) # If the order changed by sparta re-sort the indices
-        
-        mass_prf_all_list.append(sparta_output['anl_prf']['M_all'][new_idxs,p_sparta_snap,:])
-        mass_prf_1halo_list.append(sparta_output['anl_prf']['M_1halo'][new_idxs,p_sparta_snap,:])
-
-        all_r200m_list.append(sparta_output['halos']['R200m'][:,p_sparta_snap])
-
-        all_masses.append(ptl_mass)
+        mass_prf_all_list.append(mass_prf["M_all"])
+        mass_prf_1halo_list.append(mass_prf["M_1halo"])
+        all_r200m_list.append(mass_prf["R200m"])
+        all_masses.append(mass_prf["particle_mass"][0])
 
     mass_prf_all = np.vstack(mass_prf_all_list)
     mass_prf_1halo = np.vstack(mass_prf_1halo_list)
     all_r200m = np.concatenate(all_r200m_list)
     
-    bins = sparta_output["config"]['anl_prf']["r_bins_lin"]
-    bins = np.insert(bins, 0, 0)
+    bins = np.array(mass_prf["bins"])
 
     if ret_r200m:
         return mass_prf_all,mass_prf_1halo,all_masses,bins,all_r200m
@@ -7,6 +7,12 @@ import numexpr as ne
 from colossus.lss.peaks import peakHeight
 from colossus.halo.mass_so import M_to_R
 
+# numba is optional and only used for the compiled particle kernel (calc_split_vels_numba)
+try:
+    import numba
+except ImportError:
+    numba = None
+
 G = constants.G # kpc km^2 / M_⊙ / s^2
 
 # How much memory a halo takes up. Needs to be adjusted if outputted parameters are changed
@@ -152,6 +158,15 @@ def calc_t_dyn(halo_r200m, red_shift):
 
     return t_dyn
 
+# SPARTA's orbiting(1)/infalling(0) classification of tracers at a snapshot. Anywhere the last pericenter is after the snapshot it is in
+# the future so the pericenter counts are ignored. A tracer is orbiting if it has had a pericenter or (if use_lower_lim) its count is a lower limit
+def calc_orb_assn(last_pericenter_snap, n_pericenter, n_is_lower_limit, snap, use_lower_lim = True):
+    past_peri = last_pericenter_snap <= snap
+    orb_assn = past_peri & (n_pericenter >= 1)
+    if use_lower_lim:
+        orb_assn |= past_peri & (n_is_lower_limit == 1)
+    return orb_assn.astype(np.int8)
+
 # Get the difference in the number of particles present in a mass profile and a dataset
 # This can be useful to create a simple plot of which bins in a generated density profile do not match
 def diff_n_prf(diff_n_ptl, radii, idx, start_bin, end_bin, mass, act_prf):
@@ -312,7 +327,7 @@ def create_stack_mass_prf(splits, radii, halo_first, halo_n, mass, orbit_assn, p
 
 # For a halo calculate the radius, radial velocity, tangential velocity for each particle, determine the particle's classification and assigne each particle a unique particle id-halo index id (HIPID)
 def calc_halo_params(comp_snap, snap_dict, curr_halo_idx, curr_ptl_pids, curr_ptl_pos, curr_ptl_vel, 
-                 halo_pos, halo_vel, halo_r200m, sparta_last_pericenter_snap=None, sparta_n_pericenter=None, sparta_tracer_ids=None,
+                 halo_pos, halo_vel, halo_r200m, ptl_orb_assn=None, sparta_last_pericenter_snap=None, sparta_n_pericenter=None, sparta_tracer_ids=None,
                  sparta_n_is_lower_limit=None):
     snap = snap_dict["snap"]
     red_shift = snap_dict["red_shift"]
@@ -332,21 +347,14 @@ def calc_halo_params(comp_snap, snap_dict, curr_halo_idx, curr_ptl_pids, curr_pt
     # Calculate the radii of each particle based on the distance formula
     ptl_rad, coord_dist = calc_radius(halo_pos[0], halo_pos[1], halo_pos[2], curr_ptl_pos[:,0], curr_ptl_pos[:,1], curr_ptl_pos[:,2], num_new_ptls, box_size)         
     
-    # Only find orbiting(1)/infalling(0) classification for the primary snapshot
-    if comp_snap == False:         
-        compare_sparta_assn = np.zeros((sparta_tracer_ids.shape[0]))
+    # Only find orbiting(1)/infalling(0) classification for the primary snapshot. If the labels were already looked up
+    # from an orbit label table they are used as is
+    if comp_snap == False and ptl_orb_assn is not None:
+        curr_orb_assn = ptl_orb_assn
+    elif comp_snap == False:
+        compare_sparta_assn = calc_orb_assn(sparta_last_pericenter_snap, sparta_n_pericenter, sparta_n_is_lower_limit, snap)
         curr_orb_assn = np.zeros((num_new_ptls))
         
-        # Anywhere sparta_last_pericenter is greater than the current snap then that is in the future so set to 0
-        future_peri = np.where(sparta_last_pericenter_snap > snap)[0]
-        adj_sparta_n_pericenter = sparta_n_pericenter
-        adj_sparta_n_pericenter[future_peri] = 0
-        adj_sparta_n_is_lower_limit = sparta_n_is_lower_limit
-        adj_sparta_n_is_lower_limit[future_peri] = 0
-        
-        # If a particle has a pericenter or if the lower limit is 1 then it is orbiting
-        compare_sparta_assn[np.where((adj_sparta_n_pericenter >= 1) | (adj_sparta_n_is_lower_limit == 1))[0]] = 1
-        
         # Compare the ids between SPARTA and the found particle ids and match the SPARTA results
         matched_ids = np.intersect1d(curr_ptl_pids, sparta_tracer_ids, return_indices = True)
         curr_orb_assn[matched_ids[1]] = compare_sparta_assn[matched_ids[2]]
@@ -377,3 +385,159 @@ def calc_halo_params(comp_snap, snap_dict, curr_halo_idx, curr_ptl_pids, curr_pt
         return fnd_HIPIDs, curr_orb_assn, scaled_rad_vel, scaled_tang_vel, scaled_radii, scaled_phys_vel
     else:
         return fnd_HIPIDs, scaled_rad_vel, scaled_tang_vel, scaled_radii
+
+# SPARTA's orbiting(1)/infalling(0) label of every particle of a split from the split's tracer results. ptl_halos and tcr_halos are which of
+# the split's halos each particle and tracer belong to. Particles that aren't tracers of their halo are infalling (0)
+def calc_split_orb_assn(ptl_halos, ptl_pids, tcr_halos, tcr_ids, tcr_assn):
+    curr_orb_assn = np.zeros(ptl_pids.shape[0])
+    if tcr_ids.shape[0] == 0:
+        return curr_orb_assn
+    # One key per (halo, particle id) pair so every particle is matched with one binary search
+    num_ids = np.uint64(max(np.max(ptl_pids, initial=0), np.max(tcr_ids)) + 1)
+    tcr_keys = tcr_halos.astype(np.uint64) * num_ids + tcr_ids.astype(np.uint64)
+    ptl_keys = ptl_halos.astype(np.uint64) * num_ids + ptl_pids.astype(np.uint64)
+    tcr_sort = np.argsort(tcr_keys, kind="stable")
+    tcr_keys = tcr_keys[tcr_sort]
+    
+    locs = np.minimum(np.searchsorted(tcr_keys, ptl_keys), tcr_keys.shape[0] - 1)
+    matched = tcr_keys[locs] == ptl_keys
+    curr_orb_assn[matched] = tcr_assn[tcr_sort[locs[matched]]]
+    return curr_orb_assn
+
+# The scaled radius and radial, tangential and physical velocities of every particle of a split (ptl_halos is which of the split's halos each
+# particle belongs to). Positions are physical kpc/h and hubble is H * h so the hubble flow of a particle is hubble * its separation
+def calc_split_vels(ptl_halos, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, halos_v200m, box_size, hubble):
+    # Separation from the nearest periodic image of the halo
+    coord_diff = ptl_pos - halos_pos[ptl_halos]
+    coord_diff -= box_size * np.round(coord_diff / box_size)
+    dx, dy, dz = coord_diff[:,0], coord_diff[:,1], coord_diff[:,2]
+    ptl_rad = ne.evaluate("sqrt(dx**2 + dy**2 + dz**2)")
+    
+    pec_vel = ptl_vel - halos_vel[ptl_halos]
+    pvx, pvy, pvz = pec_vel[:,0], pec_vel[:,1], pec_vel[:,2]
+    phys_vx = ne.evaluate("pvx + hubble * dx")
+    phys_vy = ne.evaluate("pvy + hubble * dy")
+    phys_vz = ne.evaluate("pvz + hubble * dz")
+    del coord_diff, pec_vel, pvx, pvy, pvz
+    
+    fnd_rad_vel = ne.evaluate("(phys_vx * dx + phys_vy * dy + phys_vz * dz) / ptl_rad")
+    phys_vel = ne.evaluate("sqrt(phys_vx**2 + phys_vy**2 + phys_vz**2)")
+    # At r=0 the direction to the particle (and so its hubble flow) isn't defined so like calc_halo_params its physical velocity is nan
+    phys_vel[ptl_rad == 0] = np.nan
+    fnd_tang_vel = ne.evaluate("sqrt((phys_vx - fnd_rad_vel * dx / ptl_rad)**2 + (phys_vy - fnd_rad_vel * dy / ptl_rad)**2 + (phys_vz - fnd_rad_vel * dz / ptl_rad)**2)")
+    
+    # Scale radius by R200m, and velocities by V200m
+    ptl_v200m = halos_v200m[ptl_halos]
+    scaled_radii = ptl_rad / halos_r200m[ptl_halos]
+    scaled_rad_vel = fnd_rad_vel / ptl_v200m
+    scaled_tang_vel = fnd_tang_vel / ptl_v200m
+    scaled_phys_vel = phys_vel / ptl_v200m
+    return scaled_radii, scaled_rad_vel, scaled_tang_vel, scaled_phys_vel
+
+# The same as calc_split_vels but compiled with numba. Each particle is done in one pass of a parallel loop without any temporary arrays
+# (division by 0 gives nan/inf like NumPy instead of raising)
+if numba is not None:
+    @numba.njit(error_model="numpy", cache=True)
+    def nearest_image(coord_diff, box_size):
+        return coord_diff - box_size * np.round(coord_diff / box_size)
+    
+    @numba.njit(parallel=True, error_model="numpy", cache=True)
+    def calc_split_vels_numba(ptl_halos, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, halos_v200m, box_size, hubble):
+        num_ptls = ptl_halos.shape[0]
+        scaled_radii = np.empty(num_ptls)
+        scaled_rad_vel = np.empty(num_ptls)
+        scaled_tang_vel = np.empty(num_ptls)
+        scaled_phys_vel = np.empty(num_ptls)
+        
+        for i in numba.prange(num_ptls):
+            halo = ptl_halos[i]
+            # Separation from the nearest periodic image of the halo
+            dx = nearest_image(ptl_pos[i,0] - halos_pos[halo,0], box_size)
+            dy = nearest_image(ptl_pos[i,1] - halos_pos[halo,1], box_size)
+            dz = nearest_image(ptl_pos[i,2] - halos_pos[halo,2], box_size)
+            ptl_rad = np.sqrt(dx**2 + dy**2 + dz**2)
+            
+            phys_vx = ptl_vel[i,0] - halos_vel[halo,0] + hubble * dx
+            phys_vy = ptl_vel[i,1] - halos_vel[halo,1] + hubble * dy
+            phys_vz = ptl_vel[i,2] - halos_vel[halo,2] + hubble * dz
+            rad_vel = (phys_vx * dx + phys_vy * dy + phys_vz * dz) / ptl_rad
+            phys_vel = np.sqrt(phys_vx**2 + phys_vy**2 + phys_vz**2)
+            if ptl_rad == 0:
+                phys_vel = np.nan
+            tang_vel = np.sqrt((phys_vx - rad_vel * dx / ptl_rad)**2 + (phys_vy - rad_vel * dy / ptl_rad)**2 + (phys_vz - rad_vel * dz / ptl_rad)**2)
+            
+            scaled_radii[i] = ptl_rad / halos_r200m[halo]
+            scaled_rad_vel[i] = rad_vel / halos_v200m[halo]
+            scaled_tang_vel[i] = tang_vel / halos_v200m[halo]
+            scaled_phys_vel[i] = phys_vel / halos_v200m[halo]
+        return scaled_radii, scaled_rad_vel, scaled_tang_vel, scaled_phys_vel
+
+# Whether the numba kernel is installed and gives the same results as calc_halo_params (the per halo calculation) for a snapshot. It is checked
+# on a fixed set of particles around two halos, some across the periodic box edge from their halo and one at its halo's centre (r=0)
+def check_numba_kernel(snap_dict):
+    if numba is None:
+        return False
+    box_size = snap_dict["box_size"]
+    scale_factor = snap_dict["scale_factor"]
+    
+    halos_r200m = np.array([800.0, 400.0])
+    halos_pos = np.array([[0.1 * halos_r200m[0], 0.5 * box_size, box_size - 0.1 * halos_r200m[0]], [0.5 * box_size, box_size - 0.2 * halos_r200m[1], 0.25 * box_size]])
+    halos_vel = np.array([[120.0, -50.0, 20.0], [-30.0, 10.0, 60.0]])
+    ptl_offsets = np.array([0, 6, 10])
+    ptl_halos = np.repeat(np.arange(2), np.diff(ptl_offsets))
+    ptl_sep = np.array([[0.0, 0.0, 0.0], [-0.3, 0.1, 0.2], [0.5, -0.7, 0.05], [1.2, 0.3, -0.4], [-0.05, -0.9, 0.6], [0.8, 0.6, 0.45],
+                        [0.1, 0.35, -0.2], [-0.6, 0.4, 0.3], [0.25, -1.1, 0.7], [0.9, 0.5, -0.15]])
+    ptl_pos = (halos_pos[ptl_halos] + ptl_sep * halos_r200m[ptl_halos,np.newaxis]) % box_size
+    ptl_vel = np.array([[10.0, 20.0, -30.0], [-150.0, 80.0, 40.0], [200.0, -10.0, 90.0], [-60.0, -120.0, 15.0], [35.0, 45.0, -250.0],
+                        [5.0, -75.0, 130.0], [90.0, 160.0, -20.0], [-45.0, 30.0, 70.0], [110.0, -95.0, -140.0], [-15.0, 55.0, 25.0]])
+    ptl_pids = np.arange(ptl_halos.shape[0])
+    halo_idxs = np.array([3, 7])
+    
+    numba_res = calc_split_params(False, snap_dict, halo_idxs, ptl_offsets, ptl_pids, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m,
+                                  ptl_orb_assn=np.zeros(ptl_pids.shape[0]), use_numba=True)
+    halo_res = [calc_halo_params(False, snap_dict, halo_idxs[i], ptl_pids[ptl_offsets[i]:ptl_offsets[i+1]], ptl_pos[ptl_offsets[i]:ptl_offsets[i+1]].copy(), 
+                                 ptl_vel[ptl_offsets[i]:ptl_offsets[i+1]], halos_pos[i] / (10**3 * scale_factor), halos_vel[i], halos_r200m[i], 
+                                 ptl_orb_assn=np.zeros(ptl_offsets[i+1] - ptl_offsets[i])) for i in range(halo_idxs.shape[0])]
+    return all(np.allclose(numba_param, np.concatenate(halo_param), rtol=1e-5, atol=1e-6, equal_nan=True) for numba_param, halo_param in zip(numba_res, zip(*halo_res)))
+
+# The same as calculating each halo's particles with calc_halo_params (or search_halos in gen_ML_dsets.py) but for every halo of a split at
+# once. The particles of halo i are ptl_offsets[i]:ptl_offsets[i+1] of the inputted (already gathered) particle arrays and the halo positions are
+# physical kpc/h like the particles. Each particle gets its halo's parameters with np.repeat and everything is calculated in one vectorized pass
+# (the physical velocity is the peculiar velocity plus the hubble flow H * h * the separation, so rhat is never made). If sort_by_rad is set the
+# particles of each halo are sorted by radius. With use_numba (and numba installed) the compiled kernel is used instead of NumPy. The outputs
+# are one array each for the whole split
+def calc_split_params(comp_snap, snap_dict, halo_idxs, ptl_offsets, ptl_pids, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, ptl_orb_assn=None, sort_by_rad=True, use_numba=False):
+    red_shift = snap_dict["red_shift"]
+    hubble_const = snap_dict["hubble_const"]
+    box_size = snap_dict["box_size"]
+    little_h = snap_dict["h"]
+    
+    num_ptls = np.diff(ptl_offsets)
+    ptl_halos = np.repeat(np.arange(num_ptls.shape[0]), num_ptls)
+    
+    ptl_pids = ptl_pids.astype(np.int64) # otherwise ne.evaluate doesn't work
+    ptl_halo_idxs = np.repeat(np.asarray(halo_idxs, dtype=np.int64), num_ptls)
+    fnd_HIPIDs = ne.evaluate("0.5 * (ptl_pids + ptl_halo_idxs) * (ptl_pids + ptl_halo_idxs + 1) + ptl_halo_idxs")
+    
+    halos_v200m = calc_v200m(mass_so.R_to_M(halos_r200m, red_shift, "200m"), halos_r200m)
+    hubble = hubble_const * little_h
+    if use_numba and numba is not None:
+        scaled_radii, scaled_rad_vel, scaled_tang_vel, scaled_phys_vel = calc_split_vels_numba(ptl_halos, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, halos_v200m, box_size, hubble)
+    else:
+        scaled_radii, scaled_rad_vel, scaled_tang_vel, scaled_phys_vel = calc_split_vels(ptl_halos, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, halos_v200m, box_size, hubble)
+    
+    # Sort each halo's particles from the smallest to largest radius
+    if sort_by_rad:
+        scaled_radii_inds = np.lexsort((scaled_radii, ptl_halos))
+        scaled_radii = scaled_radii[scaled_radii_inds]
+        fnd_HIPIDs = fnd_HIPIDs[scaled_radii_inds]
+        scaled_rad_vel = scaled_rad_vel[scaled_radii_inds]
+        scaled_tang_vel = scaled_tang_vel[scaled_radii_inds]
+        scaled_phys_vel = scaled_phys_vel[scaled_radii_inds]
+        if comp_snap == False:
+            ptl_orb_assn = ptl_orb_assn[scaled_radii_inds]
+
+    if comp_snap == False:
+        return fnd_HIPIDs, ptl_orb_assn, scaled_rad_vel, scaled_tang_vel, scaled_radii, scaled_phys_vel
+    else:
+        return fnd_HIPIDs, scaled_rad_vel, scaled_tang_vel, scaled_radii
@@ -1,16 +1,41 @@
 import pickle
 import h5py 
 import os
+import json
+import fcntl
+import zlib
+import hashlib
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
+import mmap
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from itertools import islice
 import time
 import re
+import glob
+import shutil
+import pandas as pd
 import dask.dataframe as dd
 from pygadgetreader import readsnap, readheader
 from sparta_tools import sparta
 from functools import reduce
 
+from .calculation_functions import calc_orb_assn
+from .search_functions import default_tree_profile, calc_cell_idxs, get_sphere_cells, get_box_cells, in_periodic_box, get_cell_ptl_idxs
+
+# Use the fastest compression library that is installed for the cache, zlib is always available as a fallback
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 ##################################################################################################################
 # LOAD CONFIG PARAMETERS
 import configparser
@@ -22,6 +47,11 @@ pickled_path = config["PATHS"]["pickled_path"]
 
 curr_sparta_file = config["MISC"]["curr_sparta_file"]
 sim_cosmol = config["MISC"]["sim_cosmol"]
+ptl_mmap = config.getboolean("MISC","ptl_mmap")
+snap_read_threads = config.getint("MISC","snap_read_threads")
+roi_ncells = config.getint("MISC","roi_ncells")
+ptl_phys_f32 = config.getboolean("MISC","ptl_phys_f32")
+compress_cache = config.getboolean("MISC","compress_cache")
 
 reset_lvl = config.getint("SEARCH","reset")
 total_num_snaps = config.getint("SEARCH","total_num_snaps")
@@ -51,6 +81,25 @@ def timed(txt):
     
     print("Finished: %s time: %.5fs, %.2f min" % (txt, time_s, time_min))
 
+# Iterate over load_fn(item) for each item while the next depth items are already being loaded in background processes so that loading
+# overlaps with whatever is done with the current result. Processes are used instead of threads so that this process is never inside h5py
+# when it forks its multiprocessing pools (a child forked while another thread holds the HDF5 lock can deadlock), so load_fn and its results
+# have to be picklable. A depth of 0 loads each item only when it is reached
+def prefetch_iter(load_fn, items, depth = 1):
+    items = iter(items)
+    if depth <= 0:
+        for item in items:
+            yield load_fn(item)
+        return
+    
+    with ProcessPoolExecutor(max_workers=depth) as executor:
+        futures = deque(executor.submit(load_fn, item) for item in islice(items, depth))
+        while len(futures) > 0:
+            result = futures.popleft().result()
+            for item in islice(items, 1):
+                futures.append(executor.submit(load_fn, item))
+            yield result
+
 def clean_dir(path):
     try:
         files = os.listdir(path)
@@ -61,9 +110,11 @@ def clean_dir(path):
     except OSError:
         print("Error occurred while deleting files at location:",path)
 
+# Written to a temporary file and renamed so a run that is stopped part way through never leaves a partial pickle behind
 def save_pickle(data, path):
-    with open(path, "wb") as pickle_file:
+    with open(path + ".tmp", "wb") as pickle_file:
         pickle.dump(data, pickle_file)
+    os.replace(path + ".tmp", path)
 
 def load_pickle(path):
     if os.path.isfile(path):
@@ -72,43 +123,766 @@ def load_pickle(path):
     else:
         raise FileNotFoundError
 
-def load_ptl_param(sparta_name, param_name, snap, snap_path):
+# The size and modification time of each source file. Anything cached from these files is only reused if this still matches
+def get_src_fingerprint(src_paths):
+    fingerprint = []
+    for src_path in sorted(src_paths):
+        file_stat = os.stat(src_path)
+        fingerprint.append([os.path.basename(src_path), file_stat.st_size, file_stat.st_mtime_ns])
+    return fingerprint
+
+# All the files of a snapshot, (multi file GADGET snapshots are saved as snapshot_XXXX.0, snapshot_XXXX.1, ...)
+def get_snap_fingerprint(snap_path):
+    snap_files = get_gadget_files(snap_path)
+    if len(snap_files) == 0:
+        snap_files = glob.glob(glob.escape(snap_path) + "*")
+    return get_src_fingerprint(snap_files)
+
+def get_cache_codec():
+    if not compress_cache:
+        return "none"
+    elif zstandard is not None:
+        return "zstd"
+    elif lz4 is not None:
+        return "lz4"
+    return "zlib"
+
+def compress_bytes(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=1, threads=-1).compress(data)
+    elif codec == "lz4":
+        return lz4.frame.compress(data)
+    elif codec == "zlib":
+        return zlib.compress(data, 1)
+    return data
+
+# Raises ImportError if the codec's library isn't installed here and KeyError for a codec that isn't known
+def decompress_bytes(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("zstandard is needed to decompress this cache file")
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "lz4":
+        if lz4 is None:
+            raise ImportError("lz4 is needed to decompress this cache file")
+        return lz4.frame.decompress(data)
+    elif codec == "zlib":
+        return zlib.decompress(data)
+    elif codec == "none":
+        return data
+    raise KeyError(codec)
+
+cache_magic = b"MLOIS_CACHE\n"
+
+# Cache files are a short json header (codec, fingerprint of the source files, checksum) followed by the compressed pickle. 
+# They are written to a temporary file and renamed so a partially written cache file is never seen
+def save_cache(data, path, fingerprint):
+    codec = get_cache_codec()
+    payload = compress_bytes(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), codec)
+    header = json.dumps({"codec": codec, "fingerprint": fingerprint, "checksum": hashlib.blake2b(payload, digest_size=16).hexdigest()}).encode()
+    
+    with open(path + ".tmp", "wb") as file:
+        file.write(cache_magic)
+        file.write(len(header).to_bytes(8, "little"))
+        file.write(header)
+        file.write(payload)
+    os.replace(path + ".tmp", path)
+
+# Raises FileNotFoundError if the cache file doesn't exist or is stale (the source files changed) or corrupt so it is just rebuilt
+def load_cache(path, fingerprint):
+    if not os.path.isfile(path):
+        raise FileNotFoundError
+    
+    with open(path, "rb") as file:
+        if file.read(len(cache_magic)) != cache_magic:
+            raise FileNotFoundError
+        header_len = int.from_bytes(file.read(8), "little")
+        try:
+            header = json.loads(file.read(header_len))
+        except ValueError:
+            raise FileNotFoundError
+        if header["fingerprint"] != fingerprint:
+            raise FileNotFoundError
+        payload = file.read()
+    
+    if hashlib.blake2b(payload, digest_size=16).hexdigest() != header["checksum"]:
+        print("Corrupt cache file will be rebuilt:", path)
+        raise FileNotFoundError
+    try:
+        data = decompress_bytes(payload, header["codec"])
+    except (ImportError, KeyError):
+        print("Cache file written with a codec that isn't available here will be rebuilt:", path)
+        raise FileNotFoundError
+    return pickle.loads(data)
+
+# The manifest records the shape and dtype of every array in a snapshot's particle store. An array is only
+# trusted if it is in the manifest, so a store interrupted mid write is just rebuilt
+def load_ptl_manifest(store_path):
+    if os.path.isfile(store_path + "ptl_manifest.json"):
+        with open(store_path + "ptl_manifest.json", "r") as file:
+            return json.load(file)
+    return {}
+
+# The manifest is written to a temporary file (unique to the process) and renamed so it is never seen partially written
+def save_ptl_manifest(store_path, manifest):
+    tmp_path = store_path + "ptl_manifest.json." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, store_path + "ptl_manifest.json")
+
+# Anything that reads, changes and saves the manifest holds an exclusive lock on a file next to it so processes writing to the same
+# store at once don't lose each other's entries
+@contextmanager
+def lock_ptl_manifest(store_path):
+    with open(store_path + "ptl_manifest.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def add_to_ptl_manifest(store_path, param_name, shape, dtype, conv_factor = None, box_size = None):
+    with lock_ptl_manifest(store_path):
+        manifest = load_ptl_manifest(store_path)
+        manifest[param_name] = {"shape": list(shape), "dtype": np.dtype(dtype).str}
+        if conv_factor is not None:
+            manifest[param_name]["conv_factor"] = conv_factor
+        if box_size is not None:
+            manifest[param_name]["box_size"] = box_size
+        save_ptl_manifest(store_path, manifest)
+
+# A store is only valid for the files it was made from. If they have changed the manifest is
+# cleared so every array in the store (including ones derived from the particles) is rebuilt
+def check_store_source(store_path, fingerprint):
+    with lock_ptl_manifest(store_path):
+        if load_ptl_manifest(store_path).get("source") != fingerprint:
+            save_ptl_manifest(store_path, {"source": fingerprint})
+
+def check_ptl_store_source(store_path, snap_path):
+    check_store_source(store_path, get_snap_fingerprint(snap_path))
+
+def save_ptl_store(store_path, param_name, snap, ptl_param):
+    file_path = store_path + param_name + "_" + str(snap) + ".npy"
+    # Write to a temporary file and rename it so other processes never see a partial array
+    np.save(file_path + ".tmp.npy", ptl_param)
+    os.replace(file_path + ".tmp.npy", file_path)
+    add_to_ptl_manifest(store_path, param_name, ptl_param.shape, ptl_param.dtype)
+
+# Open an array from the particle store read only. As it is memory mapped every process that opens it shares the same OS pages
+def load_ptl_store(store_path, param_name, snap):
+    manifest = load_ptl_manifest(store_path)
+    file_path = store_path + param_name + "_" + str(snap) + ".npy"
+    if param_name not in manifest or not os.path.isfile(file_path):
+        raise FileNotFoundError
+    
+    ptl_param = np.load(file_path, mmap_mode="r")
+    if list(ptl_param.shape) != manifest[param_name]["shape"] or ptl_param.dtype.str != manifest[param_name]["dtype"]:
+        raise FileNotFoundError
+    return ptl_param
+
+# The tree build profile of a simulation chosen by bench_kdtree.py. If the simulation wasn't benchmarked the default profile is used
+def get_tree_profile_path(sparta_name):
+    return pickled_path + "tree_profile_" + sparta_name + ".json"
+
+def load_tree_profile(sparta_name):
+    if os.path.isfile(get_tree_profile_path(sparta_name)):
+        with open(get_tree_profile_path(sparta_name), "r") as file:
+            return json.load(file)["profile"]
+    return default_tree_profile
+
+def save_tree_profile(sparta_name, profile, bench_results):
+    with open(get_tree_profile_path(sparta_name) + ".tmp", "w") as file:
+        json.dump({"profile": profile, "bench_results": bench_results}, file, indent=4)
+    os.replace(get_tree_profile_path(sparta_name) + ".tmp", get_tree_profile_path(sparta_name))
+
+# Describe arrays so that pool workers can attach to them without them being pickled for every task. Arrays opened from the
+# particle store are described by their file and are memory mapped again by the workers. Other arrays are copied once into
+# shared memory if use_shm is set, otherwise they are passed as is, which is only free for forked workers (they inherit them).
+# Workers started with spawn or forkserver would each be sent a pickled copy so for them the arrays always go into shared memory.
+# Returns the created shared memory blocks (to be freed with free_shared_arrays) and the specs for attach_shared_arrays
+def share_arrays(arrays, use_shm = True):
+    use_shm = use_shm or mp.get_start_method() != "fork"
+    shms = []
+    specs = {}
+    for name, arr in arrays.items():
+        if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap):
+            specs[name] = ("mmap", arr.filename, arr.offset, arr.shape, arr.dtype.str)
+        elif use_shm and arr.nbytes > 0:
+            shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            shms.append(shm)
+            specs[name] = ("shm", shm.name, 0, arr.shape, arr.dtype.str)
+        else:
+            specs[name] = ("array", np.asarray(arr))
+    return shms, specs
+
+# Returns the arrays described by share_arrays and the shared memory blocks they use (which have to be kept while the arrays are used)
+def attach_shared_arrays(specs):
+    shms = []
+    arrays = {}
+    for name, spec in specs.items():
+        if spec[0] == "mmap":
+            arrays[name] = np.memmap(spec[1], dtype=spec[4], mode="r", offset=spec[2], shape=spec[3])
+        elif spec[0] == "shm":
+            # Only the process that created the block should unlink it (track is only an option from python 3.13)
+            try:
+                shm = shared_memory.SharedMemory(name=spec[1], track=False)
+            except TypeError:
+                shm = shared_memory.SharedMemory(name=spec[1])
+            shms.append(shm)
+            arrays[name] = np.ndarray(spec[3], dtype=spec[4], buffer=shm.buf)
+        else:
+            arrays[name] = spec[1]
+    return arrays, shms
+
+def free_shared_arrays(shms):
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+
+##################################################################################################################
+# GADGET binary snapshot reading
+# The first blocks of every GADGET (format 1 or 2) file are always the header, positions, velocities and ids
+# pos/vel/pid are the names used by pygadgetreader so they can be used interchangeably with readsnap
+gadget_blocks = ["pos", "vel", "pid"]
+gadget_block_ncomp = {"pos": 3, "vel": 3, "pid": 1}
+gadget_ptl_types = {"gas": 0, "dm": 1, "disk": 2, "bulge": 3, "star": 4, "bndry": 5}
+
+# A snapshot is either a single file or split into snapshot_xxx.0, snapshot_xxx.1, ...
+def get_gadget_files(snap_path):
+    if os.path.isfile(snap_path):
+        return [snap_path]
+    
+    all_files = []
+    while os.path.isfile(snap_path + "." + str(len(all_files))):
+        all_files.append(snap_path + "." + str(len(all_files)))
+    return all_files
+
+def read_gadget_header(file_path):
+    with open(file_path, "rb") as file:
+        marker = np.frombuffer(file.read(4), dtype=np.int32)[0]
+        # Format 2 files have an extra 8 byte record with the name of the block before every block
+        format2 = (marker == 8)
+        if format2:
+            file.seek(16)
+            marker = np.frombuffer(file.read(4), dtype=np.int32)[0]
+        if marker != 256:
+            raise ValueError("Not a GADGET binary snapshot: " + file_path)
+        header_bytes = file.read(256)
+        
+    header = {
+        "npart": np.frombuffer(header_bytes, dtype=np.int32, count=6, offset=0).astype(np.int64),
+        "mass": np.frombuffer(header_bytes, dtype=np.float64, count=6, offset=24),
+        "time": np.frombuffer(header_bytes, dtype=np.float64, count=1, offset=72)[0],
+        "redshift": np.frombuffer(header_bytes, dtype=np.float64, count=1, offset=80)[0],
+        "num_files": np.frombuffer(header_bytes, dtype=np.int32, count=1, offset=124)[0],
+        "boxsize": np.frombuffer(header_bytes, dtype=np.float64, count=1, offset=128)[0],
+        "format2": format2,
+    }
+    return header
+
+# Find where each of the position, velocity, and id blocks start in a file and how many bytes each particle takes up in them
+def get_gadget_block_info(file_path, header):
+    block_info = {}
+    tot_npart = header["npart"].sum()
+    with open(file_path, "rb") as file:
+        # skip the header block
+        file.seek((16 if header["format2"] else 0) + 4 + 256 + 4)
+        for block in gadget_blocks:
+            if header["format2"]:
+                file.seek(16, os.SEEK_CUR)
+            block_size = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+            block_info[block] = {"start": file.tell(), "ptl_bytes": block_size // tot_npart}
+            file.seek(block_size + 4, os.SEEK_CUR)
+    return block_info
+
+# Get the files, the number of particles of the requested type in each of them, and the shape and dtype of each block for a snapshot
+def read_gadget_layout(snap_path, ptl_type = "dm"):
+    all_files = get_gadget_files(snap_path)
+    if len(all_files) == 0:
+        raise ValueError("No GADGET binary files found for: " + snap_path)
+    all_headers = [read_gadget_header(file_path) for file_path in all_files]
+    
+    type_idx = gadget_ptl_types[ptl_type]
+    file_npart = np.array([header["npart"][type_idx] for header in all_headers])
+    file_offsets = np.insert(np.cumsum(file_npart), 0, 0)
+    
+    # the sizes of the blocks are the same for every file so only the first file with particles (of any type) is needed
+    has_ptls = [header["npart"].sum() > 0 for header in all_headers]
+    if not any(has_ptls):
+        raise ValueError("No particles in GADGET binary snapshot: " + snap_path)
+    block_info = get_gadget_block_info(all_files[np.argmax(has_ptls)], all_headers[np.argmax(has_ptls)])
+    # Shapes are python ints so they can be written in .npy headers and the particle store's manifest
+    tot_npart = int(file_offsets[-1])
+    shapes = {}
+    dtypes = {}
+    for block in gadget_blocks:
+        comp_bytes = block_info[block]["ptl_bytes"] // gadget_block_ncomp[block]
+        if block == "pid":
+            dtypes[block] = np.dtype(np.uint32) if comp_bytes == 4 else np.dtype(np.uint64)
+            shapes[block] = (tot_npart,)
+        else:
+            dtypes[block] = np.dtype(np.float32) if comp_bytes == 4 else np.dtype(np.float64)
+            shapes[block] = (tot_npart, gadget_block_ncomp[block])
+            
+    return all_files, all_headers, file_offsets, shapes, dtypes
+
+# Read all the requested blocks of one file straight into the output arrays at that file's offset
+def read_gadget_file(file_path, header, param_names, out_dict, offset, type_idx):
+    n_before = header["npart"][:type_idx].sum()
+    n_ptl = header["npart"][type_idx]
+    # Files without any of these particles (or none at all) have nothing to read
+    if n_ptl == 0:
+        return
+    
+    block_info = get_gadget_block_info(file_path, header)
+    with open(file_path, "rb") as file:
+        for param_name in param_names:
+            file.seek(block_info[param_name]["start"] + n_before * block_info[param_name]["ptl_bytes"])
+            out_view = memoryview(out_dict[param_name][offset:offset + n_ptl]).cast("B")
+            if file.readinto(out_view) != out_view.nbytes:
+                raise ValueError("Unexpected end of GADGET file: " + file_path)
+
+# Read the requested blocks for all the files of a snapshot. Each file is opened once and read by a pool of threads 
+# that write directly into preallocated arrays (which can be supplied with out_dict, for example as memmaps)
+def read_snap_blocks(snap_path, param_names, ptl_type = "dm", out_dict = None, num_threads = snap_read_threads):
+    all_files, all_headers, file_offsets, shapes, dtypes = read_gadget_layout(snap_path, ptl_type)
+    
+    if out_dict is None:
+        out_dict = {}
+    for param_name in param_names:
+        if param_name not in out_dict:
+            out_dict[param_name] = np.empty(shapes[param_name], dtype=dtypes[param_name])
+    
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(read_gadget_file, file_path, header, param_names, out_dict, file_offsets[i], gadget_ptl_types[ptl_type]) for i, (file_path, header) in enumerate(zip(all_files, all_headers))]
+        for future in futures:
+            future.result()
+    
+    return out_dict
+##################################################################################################################
+
+# Load several particle parameters of a snapshot at once. Anything that isn't already saved is read from the snapshot
+# in a single pass over its files. Returns the parameters in the same order as param_names
+def load_ptl_params(sparta_name, param_names, snap, snap_path):
     # save to folder containing pickled data to be accessed easily later
-    file_path = pickled_path + str(snap) + "_" + str(sparta_name) + "/" + param_name + "_" + str(snap) + ".pickle" 
-    create_directory(pickled_path + str(snap) +  "_" + str(sparta_name) + "/")
+    store_path = pickled_path + str(snap) + "_" + str(sparta_name) + "/"
+    create_directory(store_path)
+    snap_fingerprint = get_snap_fingerprint(snap_path)
+    if ptl_mmap:
+        check_ptl_store_source(store_path, snap_path)
     
-    # check if the file has already been pickled if so just load it
+    ptl_params = {}
+    missing_params = []
+    for param_name in param_names:
+        try:
+            if ptl_mmap:
+                ptl_params[param_name] = load_ptl_store(store_path, param_name, snap)
+            else:
+                ptl_params[param_name] = load_cache(store_path + param_name + "_" + str(snap) + ".cache", snap_fingerprint)
+        except FileNotFoundError:
+            missing_params.append(param_name)
+    
+    if len(missing_params) > 0:
+        try:
+            layout = read_gadget_layout(snap_path)
+        except ValueError:
+            layout = None
+            
+        # If the snapshot isn't a GADGET binary file fall back to pygadgetreader
+        if layout is None:
+            for param_name in missing_params:
+                ptl_param = readsnap(snap_path, param_name, 'dm')
+                if ptl_mmap:
+                    save_ptl_store(store_path, param_name, snap, ptl_param)
+                    ptl_param = load_ptl_store(store_path, param_name, snap)
+                else:
+                    save_cache(ptl_param, store_path + param_name + "_" + str(snap) + ".cache", snap_fingerprint)
+                ptl_params[param_name] = ptl_param
+        # With the memory mapped store the files are read directly into the (temporary) .npy files so no copy is held in memory
+        elif ptl_mmap:
+            out_dict = {}
+            for param_name in missing_params:
+                out_dict[param_name] = np.lib.format.open_memmap(store_path + param_name + "_" + str(snap) + ".npy.tmp.npy", mode="w+", dtype=layout[4][param_name], shape=layout[3][param_name])
+            read_snap_blocks(snap_path, missing_params, out_dict=out_dict)
+            for param_name in missing_params:
+                out_dict[param_name].flush()
+                del out_dict[param_name]
+                os.replace(store_path + param_name + "_" + str(snap) + ".npy.tmp.npy", store_path + param_name + "_" + str(snap) + ".npy")
+                add_to_ptl_manifest(store_path, param_name, layout[3][param_name], layout[4][param_name])
+                ptl_params[param_name] = load_ptl_store(store_path, param_name, snap)
+        else:
+            out_dict = read_snap_blocks(snap_path, missing_params)
+            for param_name in missing_params:
+                save_cache(out_dict[param_name], store_path + param_name + "_" + str(snap) + ".cache", snap_fingerprint)
+                ptl_params[param_name] = out_dict[param_name]
+
+    return tuple(ptl_params[param_name] for param_name in param_names)
+
+def load_ptl_param(sparta_name, param_name, snap, snap_path):
+    return load_ptl_params(sparta_name, [param_name], snap, snap_path)[0]
+
+# Wrap positions into a periodic box [0, box_size) and cast them to dtype. Rounding (to dtype or by np.mod itself) can give box_size
+# exactly, which a periodic tree doesn't accept, so positions are capped at the largest value of dtype below box_size
+def wrap_ptl_pos(ptl_pos, box_size, dtype = np.float32):
+    ptl_pos = np.mod(ptl_pos, box_size)
+    max_pos = np.dtype(dtype).type(box_size)
+    if max_pos >= box_size:
+        max_pos = np.nextafter(max_pos, np.dtype(dtype).type(0))
+    return np.minimum(ptl_pos, max_pos).astype(dtype, copy=False)
+
+# Copy a particle parameter into a float32 array multiplied by a conversion factor. This is done in chunks so only the (float32)
+# output and one float64 chunk are ever in memory instead of a full float64 copy of the parameter. Each chunk is multiplied in float64
+# and, if a box_size is given for positions, wrapped into the (converted) box before it is cast to float32
+def conv_ptl_param(in_param, out_param, conv_factor, box_size = None, chunk_size = 2**22):
+    for start in range(0, in_param.shape[0], chunk_size):
+        chunk = in_param[start:start + chunk_size].astype(np.float64) * conv_factor
+        if box_size is not None:
+            chunk = wrap_ptl_pos(chunk, box_size, out_param.dtype)
+        out_param[start:start + chunk_size] = chunk
+    return out_param
+
+# Load a snapshot's pids, velocities (km/s), and positions already converted to physical kpc/h with both velocities and positions as float32
+# The positions are wrapped into the physical box (box_size is in comoving Mpc/h). The converted arrays are saved in the same way as the
+# raw ones so they only need to be calculated once
+def load_phys_ptl_params(sparta_name, snap, snap_path, scale_factor, box_size):
+    store_path = pickled_path + str(snap) + "_" + str(sparta_name) + "/"
+    conv_factors = {"vel": 1.0, "pos": 10**3 * scale_factor} # pos: Mpc/h comoving -> kpc/h physical
+    conv_box_sizes = {"vel": None, "pos": box_size * 10**3 * scale_factor}
+    
+    ptls_pid, raw_ptls_vel, raw_ptls_pos = load_ptl_params(sparta_name, ["pid", "vel", "pos"], snap, snap_path)
+    ptl_params = {}
+    for param_name, raw_param in zip(["vel", "pos"], [raw_ptls_vel, raw_ptls_pos]):
+        conv_factor = conv_factors[param_name]
+        conv_box_size = conv_box_sizes[param_name]
+        # Nothing needs to be done if it is already in the right form
+        if raw_param.dtype == np.float32 and conv_factor == 1 and conv_box_size is None:
+            ptl_params[param_name] = raw_param
+            continue
+        
+        conv_name = param_name + "_phys"
+        file_path = store_path + conv_name + "_" + str(snap)
+        if ptl_mmap:
+            try:
+                ptl_param = load_ptl_store(store_path, conv_name, snap)
+                conv_info = load_ptl_manifest(store_path)[conv_name]
+                if conv_info.get("conv_factor") != conv_factor or conv_info.get("box_size") != conv_box_size:
+                    raise FileNotFoundError
+            except FileNotFoundError:
+                ptl_param = np.lib.format.open_memmap(file_path + ".npy.tmp.npy", mode="w+", dtype=np.float32, shape=raw_param.shape)
+                conv_ptl_param(raw_param, ptl_param, conv_factor, conv_box_size)
+                ptl_param.flush()
+                del ptl_param
+                os.replace(file_path + ".npy.tmp.npy", file_path + ".npy")
+                add_to_ptl_manifest(store_path, conv_name, raw_param.shape, np.float32, conv_factor, conv_box_size)
+                ptl_param = load_ptl_store(store_path, conv_name, snap)
+        else:
+            try:
+                ptl_param, saved_conv_factor, saved_box_size = load_cache(file_path + ".cache", get_snap_fingerprint(snap_path))
+                if saved_conv_factor != conv_factor or saved_box_size != conv_box_size:
+                    raise FileNotFoundError
+            except (FileNotFoundError, ValueError):
+                ptl_param = conv_ptl_param(raw_param, np.empty(raw_param.shape, dtype=np.float32), conv_factor, conv_box_size)
+                save_cache((ptl_param, conv_factor, conv_box_size), file_path + ".cache", get_snap_fingerprint(snap_path))
+        ptl_params[param_name] = ptl_param
+    
+    return ptls_pid, ptl_params["vel"], ptl_params["pos"]
+
+# A snapshot's pids, velocities and positions a part at a time: one GADGET file at a time or, if the snapshot can't be read directly, 
+# chunk_size particles at a time of the whole snapshot (which is only memory mapped with ptl_mmap)
+def iter_snap_chunks(sparta_name, snap, snap_path, chunk_size = 2**22):
     try:
-        ptl_param = load_pickle(file_path)
+        all_files, all_headers, file_offsets, shapes, dtypes = read_gadget_layout(snap_path)
+    except ValueError:
+        all_files = None
+    
+    if all_files is not None:
+        for i, (file_path, header) in enumerate(zip(all_files, all_headers)):
+            n_ptl = file_offsets[i+1] - file_offsets[i]
+            out_dict = {}
+            for param_name in gadget_blocks:
+                out_dict[param_name] = np.empty((n_ptl,) + shapes[param_name][1:], dtype=dtypes[param_name])
+            read_gadget_file(file_path, header, gadget_blocks, out_dict, 0, gadget_ptl_types["dm"])
+            yield out_dict["pid"], out_dict["vel"], out_dict["pos"]
+    else:
+        ptls_pid, ptls_vel, ptls_pos = load_ptl_params(sparta_name, ["pid", "vel", "pos"], snap, snap_path)
+        for start in range(0, ptls_pid.shape[0], chunk_size):
+            yield ptls_pid[start:start + chunk_size], ptls_vel[start:start + chunk_size], ptls_pos[start:start + chunk_size]
+
+# A copy of a snapshot's particles sorted by which cell of a grid they are in, and a table with where each cell starts.
+# Any region of the box can then be loaded by only reading the cells that overlap it. Positions are in the snapshot's units (comoving Mpc/h)
+# It is made without holding the snapshot in memory: the particles in each cell are counted in one pass over the snapshot (see iter_snap_chunks)
+# and in a second pass each part's particles are written to their cells in the memory mapped outputs. A part is one GADGET file so the largest
+# file (or the whole snapshot if it isn't a GADGET binary file and ptl_mmap is off) still has to fit in memory
+def load_cell_store(sparta_name, snap, snap_path, box_size, n_cells = roi_ncells):
+    store_path = pickled_path + str(snap) + "_" + str(sparta_name) + "/"
+    create_directory(store_path)
+    check_ptl_store_source(store_path, snap_path)
+    
+    try:
+        cell_offsets = load_ptl_store(store_path, "cell_offsets", snap)
+        if cell_offsets.shape[0] != n_cells**3 + 1:
+            raise FileNotFoundError
+        cell_pid = load_ptl_store(store_path, "cell_pid", snap)
+        cell_pos = load_ptl_store(store_path, "cell_pos", snap)
+        cell_vel = load_ptl_store(store_path, "cell_vel", snap)
     except FileNotFoundError:
-        ptl_param = readsnap(snap_path, param_name, 'dm')
-        save_pickle(ptl_param,file_path)
+        cell_counts = np.zeros(n_cells**3, dtype=np.int64)
+        for ptls_pid, ptls_vel, ptls_pos in iter_snap_chunks(sparta_name, snap, snap_path):
+            cell_counts += np.bincount(calc_cell_idxs(ptls_pos, box_size, n_cells), minlength=n_cells**3)
+            cell_specs = {"cell_pid": (ptls_pid.dtype, ptls_pid.shape[1:]), "cell_vel": (ptls_vel.dtype, ptls_vel.shape[1:]), "cell_pos": (ptls_pos.dtype, ptls_pos.shape[1:])}
+        cell_offsets = np.insert(np.cumsum(cell_counts), 0, 0)
+        
+        cell_params = {}
+        for param_name, (dtype, comp_shape) in cell_specs.items():
+            cell_params[param_name] = np.lib.format.open_memmap(store_path + param_name + "_" + str(snap) + ".npy.tmp.npy", mode="w+", dtype=dtype, shape=(int(cell_offsets[-1]),) + comp_shape)
+        
+        # Each part's particles go after the ones in the same cell from the parts before so they are in the same order as one stable sort
+        cell_fill = cell_offsets[:-1].copy()
+        for ptls_pid, ptls_vel, ptls_pos in iter_snap_chunks(sparta_name, snap, snap_path):
+            cell_idxs = calc_cell_idxs(ptls_pos, box_size, n_cells)
+            chunk_order = np.argsort(cell_idxs, kind="stable")
+            chunk_cells = cell_idxs[chunk_order]
+            chunk_counts = np.bincount(cell_idxs, minlength=n_cells**3)
+            chunk_dest = cell_fill[chunk_cells] + np.arange(chunk_cells.shape[0]) - (np.cumsum(chunk_counts) - chunk_counts)[chunk_cells]
+            for param_name, ptl_param in zip(["cell_pid", "cell_vel", "cell_pos"], [ptls_pid, ptls_vel, ptls_pos]):
+                cell_params[param_name][chunk_dest] = ptl_param[chunk_order]
+            cell_fill += chunk_counts
+            del cell_idxs, chunk_order, chunk_cells, chunk_dest
+        
+        for param_name in ["cell_pid", "cell_vel", "cell_pos"]:
+            cell_params[param_name].flush()
+            shape, dtype = cell_params[param_name].shape, cell_params[param_name].dtype
+            del cell_params[param_name]
+            os.replace(store_path + param_name + "_" + str(snap) + ".npy.tmp.npy", store_path + param_name + "_" + str(snap) + ".npy")
+            add_to_ptl_manifest(store_path, param_name, shape, dtype)
+        save_ptl_store(store_path, "cell_offsets", snap, cell_offsets)
+        
+        cell_offsets = load_ptl_store(store_path, "cell_offsets", snap)
+        cell_pid = load_ptl_store(store_path, "cell_pid", snap)
+        cell_pos = load_ptl_store(store_path, "cell_pos", snap)
+        cell_vel = load_ptl_store(store_path, "cell_vel", snap)
+        
+    cell_store = {
+        "pid": cell_pid,
+        "pos": cell_pos,
+        "vel": cell_vel,
+        "offsets": cell_offsets,
+        "n_cells": n_cells,
+        "box_size": box_size,
+    }
+    return cell_store
 
-    return ptl_param
+# Load only the particles within the inputted spheres (centres and radii in the cell store's units) with periodic boundaries
+# Returns lists of the pids, positions, and velocities of the particles in each sphere. Positions are not unwrapped across the box edge
+def load_ptls_in_spheres(cell_store, centres, radii):
+    box_size = cell_store["box_size"]
+    all_pid = []
+    all_pos = []
+    all_vel = []
+    
+    for centre, radius in zip(centres, radii):
+        cells = get_sphere_cells(centre, radius, box_size, cell_store["n_cells"])
+        ptl_idxs = get_cell_ptl_idxs(cells, cell_store["offsets"])
+        
+        curr_pos = cell_store["pos"][ptl_idxs]
+        coord_diff = curr_pos - centre
+        coord_diff = coord_diff - box_size * np.round(coord_diff / box_size)
+        in_sphere = np.where(np.sum(np.square(coord_diff), axis=1) <= radius**2)[0]
+        
+        all_pid.append(cell_store["pid"][ptl_idxs[in_sphere]])
+        all_pos.append(curr_pos[in_sphere])
+        all_vel.append(cell_store["vel"][ptl_idxs[in_sphere]])
+    
+    return all_pid, all_pos, all_vel
 
-def load_SPARTA_data(sparta_HDF5_path, param_path_list, sparta_name, snap):
+# Load only the particles of a snapshot within a region of the box from its cell store, so a domain of a simulation that doesn't fit in
+# memory can be loaded on its own. region has the corners "lo" and "hi" of the region and the "box_size" in comoving Mpc/h (the corners
+# can be outside the box as the region wraps around it). Returns the pids, velocities (km/s), and positions (physical kpc/h) in the same
+# form as load_ptl_params/load_phys_ptl_params
+def load_region_ptls(sparta_name, snap, snap_path, scale_factor, region):
+    cell_store = load_cell_store(sparta_name, snap, snap_path, region["box_size"])
+    cells = get_box_cells(region["lo"], region["hi"], region["box_size"], cell_store["n_cells"])
+    ptl_idxs = get_cell_ptl_idxs(cells, cell_store["offsets"])
+    ptl_idxs = ptl_idxs[in_periodic_box(cell_store["pos"][ptl_idxs], region["lo"], region["hi"], region["box_size"])]
+    
+    ptls_pid = cell_store["pid"][ptl_idxs]
+    ptls_vel = cell_store["vel"][ptl_idxs]
+    # Converted in float64 and wrapped into the physical box so rounding never puts a particle on the edge of the box
+    ptls_pos = wrap_ptl_pos(cell_store["pos"][ptl_idxs] * (10**3 * scale_factor), region["box_size"] * 10**3 * scale_factor, np.float32 if ptl_phys_f32 else np.float64)
+    if ptl_phys_f32:
+        ptls_vel = ptls_vel.astype(np.float32)
+    
+    return ptls_pid, ptls_vel, ptls_pos
+
+# Read one SPARTA parameter straight from the HDF5 file. If sparta_snap is given, datasets with a snapshot axis (their second 
+# dimension) only have that snapshot's column read. Raises KeyError if the parameter isn't stored as a dataset or attribute
+def read_SPARTA_param(sparta_file, param_path, sparta_snap = None):
+    grp_path = "/".join(map(str, param_path[:-1]))
+    param_name = param_path[-1]
+    grp = sparta_file[grp_path] if grp_path != "" else sparta_file
+    
+    if param_name in grp and isinstance(grp[param_name], h5py.Dataset):
+        dset = grp[param_name]
+        n_snaps = sparta_file["simulation"].attrs["snap_z"].shape[0]
+        if sparta_snap is not None and dset.ndim > 1 and dset.shape[1] == n_snaps:
+            return dset[:,sparta_snap]
+        return dset[()]
+    elif param_name in grp.attrs:
+        return grp.attrs[param_name]
+    raise KeyError("/".join(map(str, param_path)) + " not found in " + sparta_file.filename)
+
+# Load SPARTA parameters (given as paths like ["halos","R200m"]). Parameters are read directly from the HDF5 file and only
+# if something isn't stored there is the whole file loaded with sparta. If sparta_snap is given only that snapshot's column
+# is returned (and cached) for parameters with a snapshot axis, so halos/R200m is returned with shape (n_halo) instead of (n_halo, n_snap)
+def load_SPARTA_data(sparta_HDF5_path, param_path_list, sparta_name, snap, sparta_snap = None):
     create_directory(pickled_path + str(snap) +  "_" + str(sparta_name) + "/")
+    sparta_fingerprint = get_src_fingerprint([sparta_HDF5_path])
     
-    reload_sparta = False
+    sparta_output = None
     param_dict = {}
     all_save_names = []
     
     for param_path in param_path_list:
         save_name = "_".join(map(str, param_path))
         all_save_names.append(save_name)
+        cache_name = save_name
+        if sparta_snap is not None:
+            cache_name = save_name + "_snap" + str(sparta_snap)
         try:
-            param = load_pickle(pickled_path + str(snap) + "_" + str(sparta_name) + "/" + save_name + ".pickle")
+            param = load_cache(pickled_path + str(snap) + "_" + str(sparta_name) + "/" + cache_name + ".cache", sparta_fingerprint)
         except FileNotFoundError:
-            if not reload_sparta:
-                sparta_output = sparta.load(filename=sparta_HDF5_path, log_level= 0)
-        
-            param = reduce(lambda dct, key: dct[key], param_path, sparta_output)
-            save_pickle(param,pickled_path + str(snap) + "_" + str(sparta_name) +  "/" + save_name + ".pickle")
+            try:
+                with h5py.File(sparta_HDF5_path, "r") as sparta_file:
+                    param = read_SPARTA_param(sparta_file, param_path, sparta_snap)
+            except KeyError:
+                if sparta_output is None:
+                    sparta_output = sparta.load(filename=sparta_HDF5_path, log_level= 0)
+                param = reduce(lambda dct, key: dct[key], param_path, sparta_output)
+                if sparta_snap is not None and isinstance(param, np.ndarray) and param.ndim > 1 and param.shape[1] == sparta_output["simulation"]["snap_z"].shape[0]:
+                    param = param[:,sparta_snap]
+            save_cache(param,pickled_path + str(snap) + "_" + str(sparta_name) +  "/" + cache_name + ".cache", sparta_fingerprint)
         
         param_dict[save_name] = param
     
     return param_dict,all_save_names
 
+# Read SPARTA's tracer results for a batch of halos (indices into the SPARTA halos) without loading the rest of the file. Each halo's
+# results are a contiguous range of the result datasets (given by ptl_oct_first and ptl_oct_n) so ranges that touch or overlap are 
+# merged and every merged range is read with one h5py read. Returns a dict with each field as one flat array (halos in the order of
+# halo_idxs) and "offsets" where halo i's results are [offsets[i]:offsets[i+1]]
+def load_sparta_tracers(sparta_HDF5_path, halo_idxs, fields = ["tracer_id","n_pericenter","last_pericenter_snap","n_is_lower_limit"], tcr_type = "tcr_ptl", res_type = "res_oct"):
+    halo_idxs = np.asarray(halo_idxs)
+    with h5py.File(sparta_HDF5_path, "r") as sparta_file:
+        halo_first = sparta_file["halos"]["ptl_oct_first"][()][halo_idxs].astype(np.int64)
+        halo_n = np.maximum(sparta_file["halos"]["ptl_oct_n"][()][halo_idxs].astype(np.int64), 0)
+        offsets = np.insert(np.cumsum(halo_n), 0, 0)
+        
+        # Merge the ranges of the halos (sorted by where they start) into runs that can each be read at once
+        has_res = np.where(halo_n > 0)[0]
+        order = has_res[np.argsort(halo_first[has_res], kind="stable")]
+        starts = halo_first[order]
+        ends = starts + halo_n[order]
+        new_run = np.ones(order.shape[0], dtype=bool)
+        new_run[1:] = starts[1:] > np.maximum.accumulate(ends)[:-1]
+        run_idxs = np.where(new_run)[0]
+        run_starts = starts[run_idxs]
+        run_ends = np.maximum.reduceat(ends, run_idxs) if run_idxs.size > 0 else run_starts
+        
+        # Where each halo's results are in the concatenated runs and then which elements of those give the output order
+        run_buf_offsets = np.insert(np.cumsum(run_ends - run_starts), 0, 0)
+        halo_buf_first = np.zeros(halo_idxs.shape[0], dtype=np.int64)
+        halo_buf_first[order] = run_buf_offsets[np.cumsum(new_run) - 1] + (starts - np.repeat(run_starts, np.diff(np.append(run_idxs, order.shape[0]))))
+        gather_idxs = np.repeat(halo_buf_first - offsets[:-1], halo_n) + np.arange(offsets[-1])
+        
+        tracers = {}
+        res_grp = sparta_file[tcr_type][res_type]
+        for field in fields:
+            dset = res_grp[field]
+            if run_starts.size > 0:
+                run_buf = np.concatenate([dset[start:end] for start, end in zip(run_starts, run_ends)])
+            else:
+                run_buf = np.empty(0, dtype=dset.dtype)
+            tracers[field] = run_buf[gather_idxs]
+    
+    tracers["offsets"] = offsets
+    return tracers
+
+# SPARTA's orbiting(1)/infalling(0) label of every tracer of the inputted halos at a snapshot, evaluated once and cached per SPARTA file,
+# snapshot, and set of halos. The table is sorted by halo index and then tracer id (combined into one uint64 key) and the labels are
+# packed into bits, so the labels of any number of (halo, particle) pairs are found with one binary search by lookup_orb_labels
+def load_orb_label_table(sparta_HDF5_path, sparta_name, snap, halo_idxs, use_lower_lim = True, halos_per_read = 10000):
+    store_path = pickled_path + str(snap) + "_" + str(sparta_name) + "/"
+    create_directory(store_path)
+    halo_idxs = np.unique(halo_idxs).astype(np.int64)
+    halos_hash = hashlib.blake2b(halo_idxs.tobytes(), digest_size=8).hexdigest()
+    table_path = store_path + "orb_labels_" + halos_hash + "_" + str(int(use_lower_lim)) + ".cache"
+    sparta_fingerprint = get_src_fingerprint([sparta_HDF5_path])
+    
+    try:
+        return load_cache(table_path, sparta_fingerprint)
+    except FileNotFoundError:
+        all_tracer_ids = []
+        all_labels = []
+        all_halo_n = []
+        for start in range(0, halo_idxs.shape[0], halos_per_read):
+            tracers = load_sparta_tracers(sparta_HDF5_path, halo_idxs[start:start + halos_per_read])
+            all_tracer_ids.append(tracers["tracer_id"].astype(np.uint64))
+            all_labels.append(calc_orb_assn(tracers["last_pericenter_snap"], tracers["n_pericenter"], tracers["n_is_lower_limit"], snap, use_lower_lim))
+            all_halo_n.append(np.diff(tracers["offsets"]))
+            del tracers
+        
+        if len(all_tracer_ids) > 0:
+            tracer_ids = np.concatenate(all_tracer_ids)
+            labels = np.concatenate(all_labels)
+            halo_n = np.concatenate(all_halo_n)
+        else:
+            tracer_ids = np.empty(0, dtype=np.uint64)
+            labels = np.empty(0, dtype=np.int8)
+            halo_n = np.empty(0, dtype=np.int64)
+        del all_tracer_ids, all_labels
+        
+        key_stride = int(tracer_ids.max()) + 1 if tracer_ids.size > 0 else 1
+        keys = np.repeat(halo_idxs.astype(np.uint64), halo_n) * np.uint64(key_stride) + tracer_ids
+        del tracer_ids
+        key_order = np.argsort(keys, kind="stable")
+        
+        orb_table = {
+            "keys": keys[key_order],
+            "labels": np.packbits(labels[key_order].astype(bool)),
+            "key_stride": key_stride,
+        }
+        save_cache(orb_table, table_path, sparta_fingerprint)
+        return orb_table
+
+# Get the orbit label of each (halo index, particle id) pair from an orbit label table. halo_idxs can be one halo for all the 
+# particles or one per particle. Particles that aren't tracers of that halo are infalling (0) like when matching against SPARTA directly
+def lookup_orb_labels(orb_table, halo_idxs, pids):
+    pids = np.asarray(pids).astype(np.uint64)
+    if orb_table["keys"].size == 0:
+        return np.zeros(pids.shape[0], dtype=np.int8)
+    
+    keys = np.asarray(halo_idxs).astype(np.uint64) * np.uint64(orb_table["key_stride"]) + pids
+    locs = np.searchsorted(orb_table["keys"], keys)
+    locs[locs == orb_table["keys"].size] = 0
+    found = (orb_table["keys"][locs] == keys) & (pids < orb_table["key_stride"])
+    labels = (orb_table["labels"][locs >> 3] >> (7 - (locs & 7))) & 1
+    return np.where(found, labels, 0).astype(np.int8)
+
+# SPARTA's orbit labels of the inputted particles of a single halo. With use_table they come from an orbit label table of just that
+# halo, otherwise the halo's tracers are read and matched to the particles directly
+def load_halo_orb_labels(sparta_HDF5_path, sparta_name, snap, halo_idx, ptl_pids, use_table, use_lower_lim = True):
+    if use_table:
+        orb_table = load_orb_label_table(sparta_HDF5_path, sparta_name, snap, [halo_idx], use_lower_lim)
+        return lookup_orb_labels(orb_table, halo_idx, ptl_pids)
+
+    tracers = load_sparta_tracers(sparta_HDF5_path, [halo_idx])
+    sparta_orb_assn = calc_orb_assn(tracers["last_pericenter_snap"], tracers["n_pericenter"], tracers["n_is_lower_limit"], snap, use_lower_lim)
+    orb_assn = np.zeros(np.asarray(ptl_pids).shape[0], dtype=np.int8)
+    matched_ids = np.intersect1d(ptl_pids, tracers["tracer_id"], return_indices = True)
+    orb_assn[matched_ids[1]] = sparta_orb_assn[matched_ids[2]]
+    return orb_assn
+
 def split_dataset_by_mass(halo_first, halo_n, path_to_dataset, curr_dataset):
     with h5py.File((path_to_dataset), 'r') as all_ptl_properties:
         first_prop = True
@@ -131,6 +905,46 @@ def split_dataset_by_mass(halo_first, halo_n, path_to_dataset, curr_dataset):
                         curr_dataset = np.column_stack((curr_dataset,all_ptl_properties[key][halo_first:halo_first+halo_n]))
     return curr_dataset
 
+# Link src to dst (or copy it if it can't be linked, e.g. on another filesystem) so src stays where it is
+def link_or_copy(src, dst):
+    if os.path.isfile(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+# Put the Train and Test splits of every domain (in the order of domain_locs) into save_location's Train and Test folders one after another
+# as if they were made by one run. Halo_first is shifted by the particles of the domains before. The domains' ptl_info files are linked (or
+# copied) instead of moved so the domains keep their outputs and the merge can be run again
+def merge_domain_dsets(save_location, domain_locs):
+    for dst_name in ["Train", "Test"]:
+        create_directory(save_location + dst_name + "/halo_info/")
+        create_directory(save_location + dst_name + "/ptl_info/")
+        clean_dir(save_location + dst_name + "/halo_info/")
+        clean_dir(save_location + dst_name + "/ptl_info/")
+        split_num = 0
+        ptl_start = 0
+        for domain_loc in domain_locs:
+            domain_loc = domain_loc + dst_name + "/"
+            if not os.path.isdir(domain_loc + "ptl_info/"):
+                continue
+            domain_num_ptls = 0
+            for i in range(len(glob.glob(domain_loc + "ptl_info/ptl_*.h5"))):
+                halo_df = pd.read_hdf(domain_loc + "halo_info/halo_" + str(i) + ".h5")
+                domain_num_ptls += int(halo_df["Halo_n"].sum())
+                halo_df["Halo_first"] += ptl_start
+                halo_df.to_hdf(save_location + dst_name + "/halo_info/halo_" + str(split_num) + ".h5", key='data', mode='w',format='table')
+                link_or_copy(domain_loc + "ptl_info/ptl_" + str(i) + ".h5", save_location + dst_name + "/ptl_info/ptl_" + str(split_num) + ".h5")
+                split_num += 1
+            ptl_start += domain_num_ptls
+    
+    # Every domain has the same snapshot information
+    for domain_loc in domain_locs:
+        if os.path.isfile(domain_loc + "config.pickle"):
+            shutil.copyfile(domain_loc + "config.pickle", save_location + "config.pickle")
+            break
+
 def save_dict_to_hdf5(hdf5_group, dictionary):
     for key, value in dictionary.items():
         if isinstance(value, dict):  # Check if the value is a dictionary
@@ -183,32 +997,116 @@ def split_data_by_halo(client,frac, halo_props, ptl_data, return_halo=False):
     else:
         return ptl_1, ptl_2
     
+# The parameters of a colossus cosmology that its ages depend on (the name alone doesn't say if any were changed)
+def get_cosmology_params(cosmology):
+    return {param: getattr(cosmology, param) for param in ["flat", "Om0", "Ode0", "H0", "Tcmb0", "Neff", "relspecies", "de_model", "w0", "wa"] if hasattr(cosmology, param)}
+
+# Index of every snapshot of a simulation with its number, redshift, scale factor, cosmic age and whether it exists
+# Snapshots that don't exist have a value of -1000. The index is saved with the pickled data and is only rebuilt if 
+# the modification time of the snapshot directory changes (a snapshot was added or removed) so the headers are only read once
+def load_snap_index(snap_loc, snap_dir_format, snap_format, cosmology = None):
+    sim_name = os.path.basename(os.path.normpath(snap_loc))
+    index_path = pickled_path + "snap_index_" + sim_name + ".pickle"
+    snap_loc_mtime = os.path.getmtime(snap_loc)
+    
+    try:
+        snap_index = load_pickle(index_path)
+        if snap_index["mtime"] != snap_loc_mtime or snap_index["snap_dir_format"] != snap_dir_format or snap_index["snap_format"] != snap_format or snap_index["snap"].size != total_num_snaps:
+            raise FileNotFoundError
+    except FileNotFoundError:
+        all_z = np.ones(total_num_snaps) * -1000
+        exists = np.zeros(total_num_snaps, dtype=bool)
+        for i in range(total_num_snaps):
+            # Sometimes not all snaps exist
+            if os.path.isdir(snap_loc + "snapdir_" + snap_dir_format.format(i)):
+                all_z[i] = readheader(snap_loc + "snapdir_" + snap_dir_format.format(i) + "/snapshot_" + snap_format.format(i), 'redshift')
+                exists[i] = True
+        
+        all_scale_factors = np.ones(total_num_snaps) * -1000
+        all_scale_factors[exists] = 1/(1+all_z[exists])
+        
+        snap_index = {
+            "mtime": snap_loc_mtime,
+            "snap_dir_format": snap_dir_format,
+            "snap_format": snap_format,
+            "snap": np.arange(total_num_snaps),
+            "red_shift": all_z,
+            "scale_factor": all_scale_factors,
+            "age": None,
+            "cosmology": None,
+            "exists": exists,
+        }
+        create_directory(pickled_path)
+        save_pickle(snap_index, index_path)
+    
+    # The ages depend on the cosmology so they are (re)calculated if a cosmology with different parameters is used
+    if cosmology is not None and snap_index["cosmology"] != get_cosmology_params(cosmology):
+        all_ages = np.ones(total_num_snaps) * -1000
+        all_ages[snap_index["exists"]] = cosmology.age(snap_index["red_shift"][snap_index["exists"]])
+        snap_index["age"] = all_ages
+        snap_index["cosmology"] = get_cosmology_params(cosmology)
+        save_pickle(snap_index, index_path)
+        
+    return snap_index
+
 def find_closest_z(value,snap_loc,snap_dir_format,snap_format):
-    all_z = np.ones(total_num_snaps) * -1000
-    for i in range(total_num_snaps):
-        # Sometimes not all snaps exist
-        if os.path.isdir(snap_loc + "snapdir_" + snap_dir_format.format(i)):
-            all_z[i] = readheader(snap_loc + "snapdir_" + snap_dir_format.format(i) + "/snapshot_" + snap_format.format(i), 'redshift')
+    all_z = load_snap_index(snap_loc, snap_dir_format, snap_format)["red_shift"]
 
     idx = (np.abs(all_z - value)).argmin()
     return idx, all_z[idx]
 
 def find_closest_snap(value, cosmology, snap_loc, snap_dir_format, snap_format):
-    all_times = np.ones(total_num_snaps) * -1000
-    for i in range(total_num_snaps):
-        # Sometimes not all snaps exist
-        if os.path.isdir(snap_loc + "snapdir_" + snap_dir_format.format(i)):
-            all_times[i] = cosmology.age(readheader(snap_loc + "snapdir_" + snap_dir_format.format(i) + "/snapshot_" + snap_format.format(i), 'redshift'))
+    all_times = load_snap_index(snap_loc, snap_dir_format, snap_format, cosmology)["age"]
+    
     idx = (np.abs(all_times - value)).argmin()
     return idx
 
-def conv_halo_id_spid(my_halo_ids, sdata, snapshot):
-    sparta_idx = np.zeros(my_halo_ids.shape[0], dtype = np.int32)
-    for i, my_id in enumerate(my_halo_ids):
-        sparta_idx[i] = int(np.where(my_id == sdata['halos']['id'][:,snapshot])[0])
+# Get the index of each inputted halo id in the SPARTA output's halos at a snapshot. The SPARTA ids are sorted once and all the
+# inputted ids are found with one binary search. Raises a ValueError listing any ids that aren't found unless ret_missing is set
+# in which case those halos are given an index of -1 and the missing ids are also returned
+def conv_halo_id_spid(my_halo_ids, sdata, snapshot, ret_missing = False):
+    my_halo_ids = np.asarray(my_halo_ids)
+    sparta_ids = sdata['halos']['id'][:,snapshot]
+    id_sort_idxs = np.argsort(sparta_ids, kind="stable")
+    sorted_ids = sparta_ids[id_sort_idxs]
+    
+    # With no SPARTA halos every id is missing
+    if sorted_ids.shape[0] == 0:
+        found = np.zeros(my_halo_ids.shape, dtype=bool)
+        sparta_idx = np.full(my_halo_ids.shape, -1, dtype=np.int32)
+    else:
+        locs = np.searchsorted(sorted_ids, my_halo_ids)
+        locs[locs == sorted_ids.shape[0]] = 0
+        found = sorted_ids[locs] == my_halo_ids
+        sparta_idx = np.where(found, id_sort_idxs[locs], -1).astype(np.int32)
+    
+    missing_ids = my_halo_ids[~found]
+    if ret_missing:
+        return sparta_idx, missing_ids
+    elif missing_ids.shape[0] > 0:
+        raise ValueError("Halo ids not found in SPARTA output at snapshot " + str(snapshot) + ": " + str(missing_ids))
     return sparta_idx
 
-def get_comp_snap(t_dyn, t_dyn_step, snapshot_list, cosmol, p_red_shift, all_red_shifts, snap_dir_format, snap_format, snap_loc, sparta_HDF5_path):
+# Sort a snapshot's particle ids once so that the row of any particle id can be found with a binary search
+def create_pid_lookup(ptls_pid):
+    pid_sort_idxs = np.argsort(ptls_pid)
+    pid_lookup = {
+        "sorted_pids": ptls_pid[pid_sort_idxs],
+        "sort_idxs": pid_sort_idxs,
+    }
+    return pid_lookup
+
+# Get the row of each inputted particle id in the snapshot the lookup was made from. Ids that aren't present are given a row of -1
+def lookup_pid_rows(pid_lookup, pids):
+    sorted_pids = pid_lookup["sorted_pids"]
+    locs = np.searchsorted(sorted_pids, pids)
+    locs[locs >= sorted_pids.size] = 0
+    found = sorted_pids[locs] == pids
+    
+    return np.where(found, pid_lookup["sort_idxs"][locs], -1)
+
+# If ptl_region is given (see load_region_ptls) only the comparison snap's particles in that region are loaded
+def get_comp_snap(t_dyn, t_dyn_step, snapshot_list, cosmol, p_red_shift, all_red_shifts, snap_dir_format, snap_format, snap_loc, sparta_HDF5_path, box_size, ptl_region = None):
     # calculate one dynamical time ago and set that as the comparison snap
     curr_time = cosmol.age(p_red_shift)
     past_time = curr_time - (t_dyn_step * t_dyn)
@@ -218,8 +1116,8 @@ def get_comp_snap(t_dyn, t_dyn_step, snapshot_list, cosmol, p_red_shift, all_red
     # switch to comparison snap
     c_snap_path = snap_loc + "/snapdir_" + snap_dir_format.format(c_snap) + "/snapshot_" + snap_format.format(c_snap)
         
-    # get constants from pygadgetreader
-    c_red_shift = readheader(c_snap_path, 'redshift')
+    # get constants from the snapshot index
+    c_red_shift = load_snap_index(snap_loc, snap_dir_format, snap_format)["red_shift"][c_snap]
     c_sparta_snap = np.abs(all_red_shifts - c_red_shift).argmin()
     print("Complementary snapshot:", c_snap, "Complementary redshift:", c_red_shift)
     print("Corresponding SPARTA loc:", c_sparta_snap, "SPARTA redshift:",all_red_shifts[c_sparta_snap])
@@ -231,24 +1129,30 @@ def get_comp_snap(t_dyn, t_dyn_step, snapshot_list, cosmol, p_red_shift, all_red
     # c_box_size = c_box_size * 10**3 * c_scale_factor #convert to Kpc/h physical
     # c_box_size = c_box_size + 0.001 # NEED TO MAKE WORK FOR PARTICLES ON THE VERY EDGE
     
-    if reset_lvl == 3:
+    # A region is read from the cell store in the pickled data so it isn't removed
+    if reset_lvl == 3 and ptl_region is None:
         clean_dir(pickled_path + str(c_snap) + "_" + curr_sparta_file + "/")
     # load particle data and SPARTA data for the comparison snap
     with timed("c_snap ptl load"):
-        c_ptls_pid = load_ptl_param(curr_sparta_file, "pid", str(c_snap), c_snap_path) 
-        c_ptls_vel = load_ptl_param(curr_sparta_file, "vel", str(c_snap), c_snap_path) # km/s
-        c_ptls_pos = load_ptl_param(curr_sparta_file, "pos", str(c_snap), c_snap_path) * 10**3 * c_scale_factor # kpc/h
+        if ptl_region is not None:
+            c_ptls_pid, c_ptls_vel, c_ptls_pos = load_region_ptls(curr_sparta_file, str(c_snap), c_snap_path, c_scale_factor, ptl_region) # km/s, kpc/h
+        elif ptl_phys_f32:
+            c_ptls_pid, c_ptls_vel, c_ptls_pos = load_phys_ptl_params(curr_sparta_file, str(c_snap), c_snap_path, c_scale_factor, box_size) # km/s, kpc/h
+        else:
+            c_ptls_pid, c_ptls_vel, c_ptls_pos = load_ptl_params(curr_sparta_file, ["pid", "vel", "pos"], str(c_snap), c_snap_path) # vel: km/s
+            c_ptls_pos = c_ptls_pos * 10**3 * c_scale_factor # kpc/h
     with timed("c_snap SPARTA load"):
-        param_paths = [["halos","position"],["halos","R200m"],["halos","id"],["halos","status"],["halos","last_snap"]]
+        param_paths = [["halos","position"],["halos","R200m"],["halos","id"],["halos","status"],["halos","last_snap"],["halos","velocity"]]
             
-        c_sparta_params, c_sparta_param_names = load_SPARTA_data(sparta_HDF5_path, param_paths, curr_sparta_file, c_snap)
-        c_halos_pos = c_sparta_params[c_sparta_param_names[0]][:,c_sparta_snap,:] * 10**3 * c_scale_factor # convert to kpc/h
-        c_halos_r200m = c_sparta_params[c_sparta_param_names[1]][:,c_sparta_snap]
-        c_halos_ids = c_sparta_params[c_sparta_param_names[2]][:,c_sparta_snap]
-        c_halos_status = c_sparta_params[c_sparta_param_names[3]][:,c_sparta_snap]
+        c_sparta_params, c_sparta_param_names = load_SPARTA_data(sparta_HDF5_path, param_paths, curr_sparta_file, c_snap, c_sparta_snap)
+        c_halos_pos = c_sparta_params[c_sparta_param_names[0]] * 10**3 * c_scale_factor # convert to kpc/h
+        c_halos_r200m = c_sparta_params[c_sparta_param_names[1]]
+        c_halos_ids = c_sparta_params[c_sparta_param_names[2]]
+        c_halos_status = c_sparta_params[c_sparta_param_names[3]]
         c_halos_last_snap = c_sparta_params[c_sparta_param_names[4]][:]
+        c_halos_vel = c_sparta_params[c_sparta_param_names[5]]
 
-    return c_snap, c_sparta_snap, c_rho_m, c_red_shift, c_scale_factor, c_hubble_constant, c_ptls_pid, c_ptls_vel, c_ptls_pos, c_halos_pos, c_halos_r200m, c_halos_ids, c_halos_status, c_halos_last_snap
+    return c_snap, c_sparta_snap, c_rho_m, c_red_shift, c_scale_factor, c_hubble_constant, c_ptls_pid, c_ptls_vel, c_ptls_pos, c_halos_pos, c_halos_r200m, c_halos_ids, c_halos_status, c_halos_last_snap, c_halos_vel
 
 def split_orb_inf(data, labels):
     infall = data[np.where(labels == 0)[0]]
@@ -0,0 +1,278 @@
+import numpy as np
+import os
+from itertools import chain
+from scipy.spatial import cKDTree
+
+# How trees are built if there is no benchmarked build profile for the simulation (see bench_kdtree.py)
+default_tree_profile = {"leafsize": 3, "balanced_tree": False}
+
+# Build a (periodic) tree of the particle positions with the options of a build profile
+def build_tree(ptls_pos, box_size, tree_profile = default_tree_profile):
+    return cKDTree(data = ptls_pos, leafsize = tree_profile["leafsize"], balanced_tree = tree_profile["balanced_tree"], boxsize = box_size)
+
+# Neighbour searches are returned as a CSR style dict: "indices" holds the particle indices found around every halo one after
+# another and the particles of halo i are indices[offsets[i]:offsets[i+1]]
+
+# Search a tree around all the inputted centres at once with a radius for each centre. The searches are run with the tree's own
+# threads (workers=-1 uses every core) instead of a process pool so nothing is pickled between processes. Centres are searched in
+# batches so only one batch's python lists are ever held. Any centre with a radius <= 0 has no particles. If return_dists is set
+# the squared distance of every found particle to its centre (using the tree's periodic box) is also returned under "sq_dists"
+def batch_search(tree, centres, radii, workers = -1, batch_size = 4096, return_dists = False):
+    centres = np.asarray(centres)
+    radii = np.asarray(radii)
+    counts = np.zeros(centres.shape[0], dtype=np.int64)
+    all_indices = []
+    all_dists = []
+
+    for start in range(0, centres.shape[0], batch_size):
+        batch_radii = radii[start:start + batch_size]
+        has_rad = np.where(batch_radii > 0)[0]
+        if has_rad.size == 0:
+            continue
+
+        batch_centres = centres[start:start + batch_size][has_rad]
+        batch_nbrs = tree.query_ball_point(batch_centres, r = batch_radii[has_rad], workers = workers, return_sorted = False)
+        batch_counts = np.fromiter((len(nbrs) for nbrs in batch_nbrs), dtype=np.int64, count=has_rad.size)
+        counts[start + has_rad] = batch_counts
+        batch_indices = np.fromiter(chain.from_iterable(batch_nbrs), dtype=np.int64, count=int(batch_counts.sum()))
+        all_indices.append(batch_indices)
+        del batch_nbrs
+
+        if return_dists:
+            all_dists.append(calc_nbr_sq_dists(tree.data[batch_indices], np.repeat(batch_centres, batch_counts, axis=0), tree.boxsize))
+
+    nbrs = {
+        "offsets": np.insert(np.cumsum(counts), 0, 0),
+        "indices": np.concatenate(all_indices) if len(all_indices) > 0 else np.empty(0, dtype=np.int64),
+    }
+    if return_dists:
+        nbrs["sq_dists"] = np.concatenate(all_dists) if len(all_dists) > 0 else np.empty(0, dtype=np.float64)
+    return nbrs
+
+# Squared distance between each particle and the centre it was found around. With a periodic box the nearest image is used. These are
+# kept as float64 squared distances and compared with squared radii as the tree does, so counting within a radius gives the same
+# particles as searching the tree with that radius
+def calc_nbr_sq_dists(ptl_pos, centre_pos, box_size = None):
+    coord_diff = np.asarray(ptl_pos, dtype=np.float64) - centre_pos
+    if box_size is not None:
+        coord_diff -= box_size * np.round(coord_diff / box_size)
+    return np.sum(coord_diff**2, axis=1)
+
+# Only count how many particles are around each centre (same inputs as batch_search)
+def batch_count(tree, centres, radii, workers = -1):
+    centres = np.asarray(centres)
+    radii = np.asarray(radii)
+    counts = np.zeros(centres.shape[0], dtype=np.int64)
+
+    has_rad = np.where(radii > 0)[0]
+    if has_rad.size > 0:
+        counts[has_rad] = tree.query_ball_point(centres[has_rad], r = radii[has_rad], workers = workers, return_length = True)
+    return counts
+
+# Count how many of each centre's particles are within a (smaller) radius using the distances stored by batch_search
+def count_in_radius(nbrs, radii):
+    in_rad = nbrs["sq_dists"] <= np.repeat(np.asarray(radii, dtype=np.float64)**2, np.diff(nbrs["offsets"]))
+    cum_in_rad = np.insert(np.cumsum(in_rad, dtype=np.int64), 0, 0)
+    return cum_in_rad[nbrs["offsets"][1:]] - cum_in_rad[nbrs["offsets"][:-1]]
+
+# Only keep the particles within a (smaller) radius of each centre using the distances stored by batch_search
+def filter_nbrs(nbrs, radii):
+    in_rad = nbrs["sq_dists"] <= np.repeat(np.asarray(radii, dtype=np.float64)**2, np.diff(nbrs["offsets"]))
+    cum_in_rad = np.insert(np.cumsum(in_rad, dtype=np.int64), 0, 0)
+    filt_nbrs = {"offsets": cum_in_rad[nbrs["offsets"]]}
+    for key in nbrs:
+        if key != "offsets":
+            filt_nbrs[key] = nbrs[key][in_rad]
+    return filt_nbrs
+
+# Take the searches of only some of the centres (in the order of centre_locs) keeping everything stored per particle
+def subset_nbrs(nbrs, centre_locs):
+    counts = np.diff(nbrs["offsets"])[centre_locs]
+    new_offsets = np.insert(np.cumsum(counts), 0, 0)
+    # Position of each kept particle in the original arrays
+    ptl_locs = np.repeat(nbrs["offsets"][:-1][centre_locs] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    sub_nbrs = {"offsets": new_offsets}
+    for key in nbrs:
+        if key != "offsets":
+            sub_nbrs[key] = nbrs[key][ptl_locs]
+    return sub_nbrs
+
+# Make a neighbour list out of one array (or list) of particle indices per centre, for example the results of per halo searches
+def nbrs_from_lists(ptl_idx_lists):
+    counts = np.fromiter((len(ptl_idxs) for ptl_idxs in ptl_idx_lists), dtype=np.int64, count=len(ptl_idx_lists))
+    nbrs = {
+        "offsets": np.insert(np.cumsum(counts), 0, 0),
+        "indices": np.concatenate(ptl_idx_lists).astype(np.int64) if counts.sum() > 0 else np.empty(0, dtype=np.int64),
+    }
+    return nbrs
+
+# Store the indices as uint32 if there are few enough particles (halves the memory of the indices)
+def compact_nbrs(nbrs, num_ptls):
+    if num_ptls <= np.iinfo(np.uint32).max:
+        nbrs = dict(nbrs, indices = nbrs["indices"].astype(np.uint32, copy=False))
+    return nbrs
+
+# A particle parameter (pid, pos, vel, ...) of every found particle in one gather. The ones of centre i are [offsets[i]:offsets[i+1]]
+def gather_nbrs(nbrs, ptl_param):
+    return ptl_param[nbrs["indices"]]
+
+# Save every array of a neighbour list as a .npy file starting with path. The offsets are written last so a list is only loaded
+# if it was completely saved
+def save_nbrs(nbrs, path):
+    for key in sorted(nbrs, key = lambda key: key == "offsets"):
+        np.save(path + key + ".npy.tmp.npy", nbrs[key])
+        os.replace(path + key + ".npy.tmp.npy", path + key + ".npy")
+
+# Load a neighbour list saved with save_nbrs (memory mapped if mmap is set). Raises FileNotFoundError if it wasn't completely saved
+def load_nbrs(path, mmap = True):
+    if not os.path.isfile(path + "offsets.npy"):
+        raise FileNotFoundError
+    mmap_mode = "r" if mmap else None
+    nbrs = {"offsets": np.load(path + "offsets.npy", mmap_mode=mmap_mode), "indices": np.load(path + "indices.npy", mmap_mode=mmap_mode)}
+    if os.path.isfile(path + "sq_dists.npy"):
+        nbrs["sq_dists"] = np.load(path + "sq_dists.npy", mmap_mode=mmap_mode)
+    return nbrs
+
+# Get which cell of a n_cells x n_cells x n_cells grid each position is in. Cells are ordered with z changing fastest
+def calc_cell_idxs(pos, box_size, n_cells):
+    cell_coords = np.floor(pos / box_size * n_cells).astype(np.int64) % n_cells
+    return (cell_coords[:,0] * n_cells + cell_coords[:,1]) * n_cells + cell_coords[:,2]
+
+# Get the (sorted) cells of a grid that a box from the corner lo to the corner hi overlaps, wrapping around the box periodically
+# (lo and hi can be outside of the box)
+def get_box_cells(lo, hi, box_size, n_cells):
+    cell_size = box_size / n_cells
+    low_cells = np.floor(lo / cell_size).astype(np.int64)
+    high_cells = np.floor(hi / cell_size).astype(np.int64)
+    x_cells, y_cells, z_cells = [np.unique(np.arange(low_cells[i], high_cells[i] + 1) % n_cells) for i in range(3)]
+    
+    return ((x_cells[:,None,None] * n_cells + y_cells[None,:,None]) * n_cells + z_cells[None,None,:]).ravel()
+
+# Get the (sorted) cells of a grid that a sphere overlaps, wrapping around the box periodically
+def get_sphere_cells(centre, radius, box_size, n_cells):
+    return get_box_cells(centre - radius, centre + radius, box_size, n_cells)
+
+# Which positions are within the box from the corner lo to the corner hi, wrapping around the box periodically
+def in_periodic_box(pos, lo, hi, box_size):
+    in_box = np.ones(pos.shape[0], dtype=bool)
+    for i in range(3):
+        if hi[i] - lo[i] < box_size:
+            in_box &= np.mod(pos[:,i] - lo[i], box_size) < hi[i] - lo[i]
+    return in_box
+
+# Indices into a cell sorted array of all the particles in the inputted cells. Neighbouring cells are stored next to each other
+# so runs of consecutive cells are read as one contiguous slice
+def get_cell_ptl_idxs(cells, cell_offsets):
+    run_breaks = np.where(np.diff(cells) != 1)[0] + 1
+    run_starts = cell_offsets[cells[np.insert(run_breaks, 0, 0)]]
+    run_ends = cell_offsets[cells[np.append(run_breaks - 1, cells.size - 1)] + 1]
+    
+    return np.concatenate([np.arange(start, end) for start, end in zip(run_starts, run_ends)])
+
+# A periodic cell list: the particles' positions sorted by which cell of a n_cells^3 grid they are in ("pos"), the particle index of each
+# sorted particle ("order") and where each cell starts ("offsets"). It takes one pass over the particles to build and, unlike a tree, its
+# arrays can be saved and memory mapped so nothing has to be deserialized before the first search
+def build_cell_list(ptls_pos, box_size, n_cells):
+    cell_idxs = calc_cell_idxs(ptls_pos, box_size, n_cells)
+    cell_offsets = np.insert(np.cumsum(np.bincount(cell_idxs, minlength=n_cells**3)), 0, 0)
+    cell_order = np.argsort(cell_idxs, kind="stable")
+    del cell_idxs
+
+    cell_list = {
+        "pos": ptls_pos[cell_order],
+        "order": cell_order,
+        "offsets": cell_offsets,
+        "n_cells": n_cells,
+        "box_size": box_size,
+    }
+    return cell_list
+
+# The same search as batch_search but with a cell list. Only the particles of the cells a sphere overlaps (with periodic images) are
+# checked and the indices returned are of the original (unsorted) particles. Each batch of centres is searched at once: the cells of every
+# sphere and then the particles of every cell are listed with np.repeat and offset arithmetic and their distances are checked in one pass
+def cell_list_search(cell_list, centres, radii, return_dists = False, batch_size = 4096):
+    centres = np.asarray(centres)
+    radii = np.asarray(radii)
+    box_size = cell_list["box_size"]
+    n_cells = cell_list["n_cells"]
+    cell_offsets = cell_list["offsets"]
+    cell_size = box_size / n_cells
+    counts = np.zeros(centres.shape[0], dtype=np.int64)
+    all_indices = []
+    all_dists = []
+
+    search_idxs = np.where(radii > 0)[0]
+    for start in range(0, search_idxs.shape[0], batch_size):
+        batch_idxs = search_idxs[start:start + batch_size]
+        batch_centres = centres[batch_idxs]
+        batch_radii = radii[batch_idxs]
+        
+        # The first cell each sphere overlaps and how many cells it overlaps in each dimension (at most every cell once)
+        low_cells = np.floor((batch_centres - batch_radii[:,None]) / cell_size).astype(np.int64)
+        num_cells = np.minimum(np.floor((batch_centres + batch_radii[:,None]) / cell_size).astype(np.int64) - low_cells + 1, n_cells)
+        
+        # Every cell of every sphere, counted through with z changing fastest and wrapped around the box
+        sphere_num_cells = np.prod(num_cells, axis=1)
+        cell_spheres = np.repeat(np.arange(batch_idxs.shape[0]), sphere_num_cells)
+        cell_ranks = np.arange(cell_spheres.shape[0]) - np.repeat(np.cumsum(sphere_num_cells) - sphere_num_cells, sphere_num_cells)
+        num_yz_cells = num_cells[cell_spheres,1] * num_cells[cell_spheres,2]
+        x_cells = (low_cells[cell_spheres,0] + cell_ranks // num_yz_cells) % n_cells
+        y_cells = (low_cells[cell_spheres,1] + (cell_ranks % num_yz_cells) // num_cells[cell_spheres,2]) % n_cells
+        z_cells = (low_cells[cell_spheres,2] + cell_ranks % num_cells[cell_spheres,2]) % n_cells
+        cells = (x_cells * n_cells + y_cells) * n_cells + z_cells
+        del cell_ranks, num_yz_cells, x_cells, y_cells, z_cells
+        
+        # Every particle of those cells
+        cell_starts = cell_offsets[cells]
+        cell_num_ptls = cell_offsets[cells + 1] - cell_starts
+        ptl_spheres = np.repeat(cell_spheres, cell_num_ptls)
+        cell_ptls = np.repeat(cell_starts - (np.cumsum(cell_num_ptls) - cell_num_ptls), cell_num_ptls) + np.arange(ptl_spheres.shape[0])
+        
+        coord_diff = cell_list["pos"][cell_ptls] - batch_centres[ptl_spheres]
+        coord_diff -= box_size * np.round(coord_diff / box_size)
+        ptl_sq_dists = np.sum(coord_diff**2, axis=1)
+        in_sphere = np.where(ptl_sq_dists <= batch_radii[ptl_spheres]**2)[0]
+        del coord_diff
+
+        counts[batch_idxs] = np.bincount(ptl_spheres[in_sphere], minlength=batch_idxs.shape[0])
+        all_indices.append(cell_list["order"][cell_ptls[in_sphere]])
+        if return_dists:
+            all_dists.append(ptl_sq_dists[in_sphere])
+
+    nbrs = {
+        "offsets": np.insert(np.cumsum(counts), 0, 0),
+        "indices": np.concatenate(all_indices).astype(np.int64) if len(all_indices) > 0 else np.empty(0, dtype=np.int64),
+    }
+    if return_dists:
+        nbrs["sq_dists"] = np.concatenate(all_dists) if len(all_dists) > 0 else np.empty(0, dtype=np.float64)
+    return nbrs
+
+# Search with either a tree or a cell list (a dict from build_cell_list). If an order is given the centres are searched in that
+# order (for example calc_morton_order's) but the result is still in the order of the inputted centres
+def nbr_search(searcher, centres, radii, return_dists = False, order = None):
+    if order is not None:
+        nbrs = nbr_search(searcher, np.asarray(centres)[order], np.asarray(radii)[order], return_dists = return_dists)
+        return subset_nbrs(nbrs, np.argsort(order))
+    if isinstance(searcher, dict):
+        return cell_list_search(searcher, centres, radii, return_dists = return_dists)
+    return batch_search(searcher, centres, radii, return_dists = return_dists)
+
+def nbr_count(searcher, centres, radii):
+    if isinstance(searcher, dict):
+        return np.diff(cell_list_search(searcher, centres, radii)["offsets"])
+    return batch_count(searcher, centres, radii)
+
+# Spread the lowest 21 bits of each value out so there are two zero bits between each of them
+def spread_bits(vals):
+    vals = vals.astype(np.uint64) & np.uint64(0x1fffff)
+    for shift, mask in [(32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249)]:
+        vals = (vals | (vals << np.uint64(shift))) & np.uint64(mask)
+    return vals
+
+# The order of positions along a Morton (Z order) curve through the periodic box. Positions next to each other in this order are close
+# in space so searching (and gathering the particles of) centres in this order reuses the same parts of the tree and particle arrays
+def calc_morton_order(pos, box_size, bits = 21):
+    grid_coords = np.floor(np.mod(pos, box_size) / box_size * 2**bits).astype(np.int64)
+    grid_coords = np.minimum(grid_coords, 2**bits - 1)
+    morton_keys = spread_bits(grid_coords[:,0]) << np.uint64(2) | spread_bits(grid_coords[:,1]) << np.uint64(1) | spread_bits(grid_coords[:,2])
+    return np.argsort(morton_keys, kind="stable")
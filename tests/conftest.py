@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# The scripts are run from the repository root (config.ini is read from the working directory) with src on the path
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(repo_path)
+sys.path.insert(0, os.path.join(repo_path, "src"))
+
+# Write anything the utilities cache to a temporary directory instead of the configured pickled_path
+@pytest.fixture
+def pickled_path(tmp_path, monkeypatch):
+    from utils import data_and_loading_functions
+    monkeypatch.setattr(data_and_loading_functions, "pickled_path", str(tmp_path) + "/")
+    return str(tmp_path) + "/"
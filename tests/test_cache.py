@@ -0,0 +1,53 @@
+import json
+import pickle
+
+import numpy as np
+import pytest
+
+from utils import data_and_loading_functions
+from utils.data_and_loading_functions import save_cache, load_cache, cache_magic
+
+# Rewrite a cache file with another header (keeping the checksum of the payload)
+def rewrite_header(path, payload, **header_changes):
+    with open(path, "rb") as file:
+        file.read(len(cache_magic))
+        header = json.loads(file.read(int.from_bytes(file.read(8), "little")))
+        old_payload = file.read()
+    header.update(header_changes)
+    if payload is None:
+        payload = old_payload
+    else:
+        header["checksum"] = data_and_loading_functions.hashlib.blake2b(payload, digest_size=16).hexdigest()
+    header = json.dumps(header).encode()
+    with open(path, "wb") as file:
+        file.write(cache_magic + len(header).to_bytes(8, "little") + header + payload)
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_cache_round_trip(tmp_path, monkeypatch, compress):
+    monkeypatch.setattr(data_and_loading_functions, "compress_cache", compress)
+    data = (np.arange(1000, dtype=np.float32), 2.5)
+    save_cache(data, str(tmp_path) + "/a.cache", {"size": 1})
+    loaded = load_cache(str(tmp_path) + "/a.cache", {"size": 1})
+    assert np.array_equal(loaded[0], data[0]) and loaded[1] == data[1]
+    # A different source file or no file at all is rebuilt
+    with pytest.raises(FileNotFoundError):
+        load_cache(str(tmp_path) + "/a.cache", {"size": 2})
+    with pytest.raises(FileNotFoundError):
+        load_cache(str(tmp_path) + "/b.cache", {"size": 1})
+
+# Only a codec that can't be used here means the cache is rebuilt, anything else wrong with it is raised
+def test_cache_codecs(tmp_path, monkeypatch):
+    path = str(tmp_path) + "/a.cache"
+    save_cache([1, 2, 3], path, None)
+    rewrite_header(path, None, codec="brotli")
+    with pytest.raises(FileNotFoundError):
+        load_cache(path, None)
+
+    monkeypatch.setattr(data_and_loading_functions, "zstandard", None)
+    rewrite_header(path, b"x", codec="zstd")
+    with pytest.raises(FileNotFoundError):
+        load_cache(path, None)
+
+    rewrite_header(path, b"not a pickle", codec="none")
+    with pytest.raises(pickle.UnpicklingError):
+        load_cache(path, None)
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.data_and_loading_functions import merge_domain_dsets
+
+# Write the splits of a run's halos (halo_info with the halos' first particle and number of particles, ptl_info with their particles) as
+# gen_ML_dsets does, with Halo_first counted from the run's first particle. Every halo's particles only depend on its id
+def write_run(run_loc, dst_name, halo_ids, halos_n, splits):
+    os.makedirs(run_loc + dst_name + "/halo_info/")
+    os.makedirs(run_loc + dst_name + "/ptl_info/")
+    halo_first = np.insert(np.cumsum(halos_n), 0, 0)
+    for i, split in enumerate(splits):
+        halo_df = pd.DataFrame({"Halo_first": halo_first[split], "Halo_n": halos_n[split], "Halo_indices": halo_ids[split]})
+        ptl_df = pd.DataFrame({"HIPIDS": np.concatenate([np.full(halos_n[j], halo_ids[j]) for j in split]),
+                               "Scaled_radii": np.concatenate([np.sort(np.random.default_rng(halo_ids[j]).random(halos_n[j])) for j in split])})
+        halo_df.to_hdf(run_loc + dst_name + "/halo_info/halo_" + str(i) + ".h5", key='data', mode='w',format='table')
+        ptl_df.to_hdf(run_loc + dst_name + "/ptl_info/ptl_" + str(i) + ".h5", key='data', mode='w',format='table')
+    with open(run_loc + "config.pickle", "wb") as file:
+        file.write(b"config")
+
+def read_merged(save_location, dst_name):
+    num_splits = len(os.listdir(save_location + dst_name + "/ptl_info/"))
+    halo_df = pd.concat([pd.read_hdf(save_location + dst_name + "/halo_info/halo_" + str(i) + ".h5") for i in range(num_splits)], ignore_index=True)
+    ptl_df = pd.concat([pd.read_hdf(save_location + dst_name + "/ptl_info/ptl_" + str(i) + ".h5") for i in range(num_splits)], ignore_index=True)
+    return halo_df, ptl_df
+
+# The same halos are run as one domain and as two domains (the second with no test halos) and the particles of every halo are found at its
+# Halo_first in the merged datasets
+@pytest.fixture
+def domain_runs(tmp_path):
+    rng = np.random.default_rng(11)
+    halo_ids = {"Train": np.arange(12), "Test": np.arange(100, 105)}
+    halos_n = {"Train": rng.integers(0, 50, 12), "Test": rng.integers(0, 50, 5)}
+    halos_n["Train"][3] = 0
+    one_loc = str(tmp_path) + "/one/"
+    two_loc = str(tmp_path) + "/two/"
+    for dst_name, splits in [("Train", [[0, 1, 2, 3, 4], [5, 6], [7, 8, 9, 10, 11]]), ("Test", [[0, 1], [2, 3, 4]])]:
+        write_run(one_loc + "domain_0/", dst_name, halo_ids[dst_name], halos_n[dst_name], [np.array(split) for split in splits])
+    write_run(two_loc + "domain_0/", "Train", halo_ids["Train"][:7], halos_n["Train"][:7], [np.arange(5), np.array([5, 6])])
+    write_run(two_loc + "domain_0/", "Test", halo_ids["Test"], halos_n["Test"], [np.array([0, 1]), np.array([2, 3, 4])])
+    write_run(two_loc + "domain_1/", "Train", halo_ids["Train"][7:], halos_n["Train"][7:], [np.arange(5)])
+    return one_loc, two_loc
+
+def test_merge_domains(domain_runs):
+    one_loc, two_loc = domain_runs
+    merge_domain_dsets(one_loc, [one_loc + "domain_0/"])
+    merge_domain_dsets(two_loc, [two_loc + "domain_0/", two_loc + "domain_1/", two_loc + "domain_2/"])
+
+    for dst_name in ["Train", "Test"]:
+        one_halo_df, one_ptl_df = read_merged(one_loc, dst_name)
+        two_halo_df, two_ptl_df = read_merged(two_loc, dst_name)
+        assert np.array_equal(one_halo_df["Halo_first"], two_halo_df["Halo_first"])
+        assert np.array_equal(one_halo_df["Halo_n"], two_halo_df["Halo_n"])
+        assert one_halo_df.equals(two_halo_df) and one_ptl_df.equals(two_ptl_df)
+        for halo_id, halo_first, halo_n in zip(two_halo_df["Halo_indices"], two_halo_df["Halo_first"], two_halo_df["Halo_n"]):
+            assert np.all(two_ptl_df["HIPIDS"][halo_first:halo_first+halo_n] == halo_id)
+    assert open(two_loc + "config.pickle", "rb").read() == b"config"
+
+# The domains keep their outputs so merging again gives the same datasets
+def test_merge_domains_again(domain_runs):
+    one_loc, two_loc = domain_runs
+    domain_locs = [two_loc + "domain_0/", two_loc + "domain_1/"]
+    merge_domain_dsets(two_loc, domain_locs)
+    first_merge = [read_merged(two_loc, dst_name) for dst_name in ["Train", "Test"]]
+    assert os.path.isfile(two_loc + "domain_1/Train/ptl_info/ptl_0.h5")
+    merge_domain_dsets(two_loc, domain_locs)
+    for (halo_df, ptl_df), dst_name in zip(first_merge, ["Train", "Test"]):
+        again_halo_df, again_ptl_df = read_merged(two_loc, dst_name)
+        assert halo_df.equals(again_halo_df) and ptl_df.equals(again_ptl_df)
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from utils.data_and_loading_functions import read_gadget_layout, read_snap_blocks, iter_snap_chunks
+
+# Dividing by the number of particles of an empty file only warns with numpy integers
+pytestmark = pytest.mark.filterwarnings("error::RuntimeWarning")
+
+box_size = 100.0
+
+# Write one file of a GADGET snapshot. Every file has some gas particles before the dark matter (except for empty files which have no
+# particles at all). Format 2 files have a block name record before every block
+def write_gadget_file(path, num_files, gas_pos, pos, vel, pid, format2, float_dtype, id_dtype):
+    npart = np.zeros(6, dtype=np.int32)
+    npart[0] = gas_pos.shape[0]
+    npart[1] = pos.shape[0]
+    header = bytearray(256)
+    header[0:24] = npart.tobytes()
+    header[124:128] = np.int32(num_files).tobytes()
+    header[128:136] = np.float64(box_size).tobytes()
+    num_gas = gas_pos.shape[0]
+
+    with open(path, "wb") as file:
+        def write_block(name, data):
+            if format2:
+                file.write(np.int32(8).tobytes() + name.encode().ljust(4) + np.int32(len(data) + 8).tobytes() + np.int32(8).tobytes())
+            file.write(np.uint32(len(data)).tobytes() + data + np.uint32(len(data)).tobytes())
+        write_block("HEAD", bytes(header))
+        write_block("POS", np.concatenate([gas_pos, pos]).astype(float_dtype).tobytes())
+        write_block("VEL", np.concatenate([np.zeros((num_gas, 3)), vel]).astype(float_dtype).tobytes())
+        write_block("ID", np.concatenate([np.zeros(num_gas), pid]).astype(id_dtype).tobytes())
+
+@pytest.fixture(params = [(False, np.float32, np.uint32), (True, np.float32, np.uint32), (False, np.float64, np.uint64), (True, np.float64, np.uint64)])
+def gadget_snap(tmp_path, request):
+    format2, float_dtype, id_dtype = request.param
+    rng = np.random.default_rng(6)
+    # The second file has no particles at all and the fourth only has gas
+    file_npart = [500, 0, 731, 0, 64]
+    file_ngas = [3, 0, 2, 5, 1]
+    snap_path = str(tmp_path) + "/snapshot_050"
+    all_pos, all_vel, all_pid = [], [], []
+    for i, (n, n_gas) in enumerate(zip(file_npart, file_ngas)):
+        pos = (rng.random((n, 3)) * box_size).astype(float_dtype)
+        vel = rng.normal(0, 300, (n, 3)).astype(float_dtype)
+        pid = rng.choice(2**31, n, replace=False).astype(id_dtype)
+        write_gadget_file(snap_path + "." + str(i), len(file_npart), rng.random((n_gas, 3)) * box_size, pos, vel, pid, format2, float_dtype, id_dtype)
+        all_pos.append(pos)
+        all_vel.append(vel)
+        all_pid.append(pid)
+    return snap_path, file_npart, np.concatenate(all_pos), np.concatenate(all_vel), np.concatenate(all_pid)
+
+def test_read_snap_blocks(gadget_snap):
+    snap_path, file_npart, pos, vel, pid = gadget_snap
+    all_files, all_headers, file_offsets, shapes, dtypes = read_gadget_layout(snap_path)
+    assert len(all_files) == len(file_npart)
+    assert np.array_equal(np.diff(file_offsets), file_npart)
+    assert shapes["pos"] == pos.shape and dtypes["pos"] == pos.dtype and dtypes["pid"] == pid.dtype
+
+    blocks = read_snap_blocks(snap_path, ["pos", "vel", "pid"], num_threads = 3)
+    assert np.array_equal(blocks["pos"], pos)
+    assert np.array_equal(blocks["vel"], vel)
+    assert np.array_equal(blocks["pid"], pid)
+
+def test_iter_snap_chunks(gadget_snap):
+    snap_path, file_npart, pos, vel, pid = gadget_snap
+    chunks = list(iter_snap_chunks("test", "50", snap_path))
+    assert [chunk_pid.shape[0] for chunk_pid, chunk_vel, chunk_pos in chunks] == file_npart
+    assert np.array_equal(np.concatenate([chunk[0] for chunk in chunks]), pid)
+    assert np.array_equal(np.concatenate([chunk[1] for chunk in chunks]), vel)
+    assert np.array_equal(np.concatenate([chunk[2] for chunk in chunks]), pos)
+
+def test_snap_without_particles(tmp_path):
+    snap_path = str(tmp_path) + "/snapshot_050"
+    empty = np.empty((0, 3))
+    write_gadget_file(snap_path + ".0", 1, empty, empty, empty, np.empty(0), False, np.float32, np.uint32)
+    with pytest.raises(ValueError):
+        read_gadget_layout(snap_path)
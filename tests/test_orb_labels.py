@@ -0,0 +1,87 @@
+import h5py
+import numpy as np
+import pytest
+
+from utils.calculation_functions import calc_orb_assn
+from utils.data_and_loading_functions import load_orb_label_table, lookup_orb_labels, load_halo_orb_labels, conv_halo_id_spid
+
+snap = 50
+num_halos = 12
+
+# A SPARTA like file where every halo has its own tracer results (some halos have none) and tracer ids are shared between halos
+@pytest.fixture
+def sparta_file(tmp_path):
+    rng = np.random.default_rng(12)
+    halo_n = rng.integers(0, 300, num_halos)
+    halo_n[[3, 7]] = 0
+    halo_first = np.insert(np.cumsum(halo_n), 0, 0)[:-1]
+    tracer_id = np.concatenate([rng.choice(2000, n, replace=False) for n in halo_n]).astype(np.int64)
+    tot_n = tracer_id.shape[0]
+
+    path = str(tmp_path) + "/sparta.hdf5"
+    with h5py.File(path, "w") as f:
+        f["halos/ptl_oct_first"] = halo_first
+        f["halos/ptl_oct_n"] = halo_n
+        f["tcr_ptl/res_oct/tracer_id"] = tracer_id
+        f["tcr_ptl/res_oct/n_pericenter"] = rng.integers(0, 3, tot_n).astype(np.int16)
+        f["tcr_ptl/res_oct/last_pericenter_snap"] = rng.integers(snap - 20, snap + 20, tot_n).astype(np.int16)
+        f["tcr_ptl/res_oct/n_is_lower_limit"] = rng.integers(0, 2, tot_n).astype(np.int8)
+    return path
+
+# The labels of a halo's particles found by matching its SPARTA tracers directly
+def match_tracers(path, halo_idx, pids, use_lower_lim):
+    with h5py.File(path, "r") as f:
+        first = f["halos/ptl_oct_first"][halo_idx]
+        n = f["halos/ptl_oct_n"][halo_idx]
+        res = {key: f["tcr_ptl/res_oct/" + key][first:first + n] for key in ["tracer_id", "n_pericenter", "last_pericenter_snap", "n_is_lower_limit"]}
+    sparta_orb_assn = calc_orb_assn(res["last_pericenter_snap"], res["n_pericenter"], res["n_is_lower_limit"], snap, use_lower_lim)
+    orb_assn = np.zeros(pids.shape[0], dtype=np.int8)
+    matched_ids = np.intersect1d(pids, res["tracer_id"], return_indices = True)
+    orb_assn[matched_ids[1]] = sparta_orb_assn[matched_ids[2]]
+    return orb_assn
+
+@pytest.mark.parametrize("use_lower_lim", [True, False])
+def test_table_matches_tracers(sparta_file, pickled_path, use_lower_lim):
+    halo_idxs = np.array([9, 0, 3, 5, 11, 7, 2])
+    orb_table = load_orb_label_table(sparta_file, "test", snap, halo_idxs, use_lower_lim)
+    pids = np.random.default_rng(3).permutation(2500)[:1500]
+    for halo_idx in halo_idxs:
+        assert np.array_equal(lookup_orb_labels(orb_table, halo_idx, pids), match_tracers(sparta_file, halo_idx, pids, use_lower_lim))
+
+    # One halo per particle gives the same as looking up each halo separately
+    all_halo_idxs = np.repeat(halo_idxs, pids.shape[0])
+    all_pids = np.tile(pids, halo_idxs.shape[0])
+    expected = np.concatenate([match_tracers(sparta_file, halo_idx, pids, use_lower_lim) for halo_idx in halo_idxs])
+    assert np.array_equal(lookup_orb_labels(orb_table, all_halo_idxs, all_pids), expected)
+
+    # The cached table is the same as the one that was made
+    cached_table = load_orb_label_table(sparta_file, "test", snap, halo_idxs, use_lower_lim)
+    assert np.array_equal(cached_table["keys"], orb_table["keys"]) and np.array_equal(cached_table["labels"], orb_table["labels"])
+
+def test_halo_orb_labels(sparta_file, pickled_path):
+    pids = np.arange(2500)
+    for halo_idx in range(num_halos):
+        expected = match_tracers(sparta_file, halo_idx, pids, True)
+        assert np.array_equal(load_halo_orb_labels(sparta_file, "test", snap, halo_idx, pids, True), expected)
+        assert np.array_equal(load_halo_orb_labels(sparta_file, "test", snap, halo_idx, pids, False), expected)
+
+# SPARTA can return the requested halos in a different order so the halo index of each SPARTA row (as used by morb_cat.py) has to
+# give the same labels from the table as matching that row's tracers
+def test_table_matches_sparta_rows(sparta_file, pickled_path):
+    rng = np.random.default_rng(5)
+    use_indices = np.array([1, 4, 6, 8, 10, 11])
+    all_halo_ids = np.arange(num_halos) * 7 + 100
+    use_halo_ids = all_halo_ids[use_indices]
+    sparta_rows = rng.permutation(use_indices.shape[0])
+    sdata = {"halos": {"id": use_halo_ids[sparta_rows][:,None]}}
+
+    new_idxs = conv_halo_id_spid(use_halo_ids, sdata, 0)
+    use_halo_idxs = np.empty_like(use_indices)
+    use_halo_idxs[new_idxs] = use_indices
+
+    orb_table = load_orb_label_table(sparta_file, "test", snap, use_indices)
+    pids = np.arange(2500)
+    for row in range(use_indices.shape[0]):
+        row_halo_idx = use_indices[sparta_rows[row]]
+        assert use_halo_idxs[row] == row_halo_idx
+        assert np.array_equal(lookup_orb_labels(orb_table, use_halo_idxs[row], pids), match_tracers(sparta_file, row_halo_idx, pids, True))
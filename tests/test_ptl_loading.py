@@ -0,0 +1,42 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from utils.data_and_loading_functions import conv_ptl_param, wrap_ptl_pos
+
+# Comoving positions (Mpc/h) right at the edges of the box are converted to physical kpc/h without any landing on the box's edge
+def test_conv_ptl_param_stays_in_box():
+    rng = np.random.default_rng(4)
+    box_size = 62.5
+    scale_factor = 0.7391
+    conv_factor = 10**3 * scale_factor
+    phys_box_size = box_size * 10**3 * scale_factor
+
+    ptls_pos = rng.random((100000, 3)) * box_size
+    ptls_pos[:1000] = np.nextafter(box_size, 0)
+    ptls_pos[1000:2000] = box_size - rng.random((1000, 3)) * 1e-6
+    ptls_pos[2000:3000] = rng.random((1000, 3)) * 1e-9
+    ptls_pos[3000:3100] = -1e-12
+    for in_pos in [ptls_pos, ptls_pos.astype(np.float32)]:
+        conv_pos = conv_ptl_param(in_pos, np.empty(in_pos.shape, dtype=np.float32), conv_factor, phys_box_size, chunk_size = 30000)
+        assert conv_pos.dtype == np.float32
+        assert np.all((conv_pos >= 0) & (conv_pos < phys_box_size))
+        cKDTree(conv_pos, boxsize = phys_box_size)
+
+        # Apart from the wrapped particles the positions are the float64 conversion rounded once
+        expected = in_pos.astype(np.float64) * conv_factor
+        inside = (expected >= 0) & (expected < phys_box_size - 1)
+        assert np.array_equal(conv_pos[inside], expected[inside].astype(np.float32))
+        # and the wrapped ones are within a float32 rounding of the edges
+        wrap_dists = np.minimum(conv_pos[~inside], phys_box_size - conv_pos[~inside])
+        assert np.all(wrap_dists <= 1.0)
+
+def test_conv_ptl_param_without_box():
+    vel = np.random.default_rng(5).normal(0, 300, (1000, 3))
+    conv_vel = conv_ptl_param(vel, np.empty(vel.shape, dtype=np.float32), 1.0, chunk_size = 300)
+    assert np.array_equal(conv_vel, vel.astype(np.float32))
+
+def test_wrap_ptl_pos_float64():
+    box_size = 1000.0
+    wrapped = wrap_ptl_pos(np.array([-1e-30, 0.0, box_size, 2 * box_size + 1, -1.0]), box_size, np.float64)
+    assert np.all((wrapped >= 0) & (wrapped < box_size))
+    assert np.allclose(wrapped[2:], [0.0, 1.0, box_size - 1.0])
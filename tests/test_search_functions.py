@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from utils.search_functions import build_tree, batch_search, batch_count, count_in_radius, filter_nbrs, subset_nbrs, nbrs_from_lists, calc_nbr_sq_dists, build_cell_list, cell_list_search, nbr_search, nbr_count, calc_morton_order
+
+box_size = 1000.0
+
+@pytest.fixture
+def ptls_pos():
+    return np.random.default_rng(0).random((50000, 3)) * box_size
+
+# Centres spread through the box with some right at its edges so the searches wrap around
+@pytest.fixture
+def centres():
+    rng = np.random.default_rng(1)
+    centres = rng.random((500, 3)) * box_size
+    centres[:50,0] = rng.random(50) * 5
+    centres[50:100,1] = box_size - rng.random(50) * 5
+    return centres
+
+# Radii that are exactly the distance of one of each centre's particles, so particles sit right on every boundary
+def boundary_radii(nbrs, rng):
+    counts = np.diff(nbrs["offsets"])
+    picks = nbrs["offsets"][:-1] + (rng.random(counts.shape[0]) * counts).astype(np.int64)
+    return np.where(counts > 0, np.sqrt(nbrs["sq_dists"][np.minimum(picks, nbrs["sq_dists"].shape[0] - 1)]), 1.0)
+
+def test_count_in_radius_matches_tree(ptls_pos, centres):
+    rng = np.random.default_rng(2)
+    tree = build_tree(ptls_pos, box_size)
+    nbrs = batch_search(tree, centres, np.full(centres.shape[0], 40.0), return_dists = True)
+
+    for radii in [rng.random(centres.shape[0]) * 40, boundary_radii(nbrs, rng)]:
+        assert np.array_equal(count_in_radius(nbrs, radii), batch_count(tree, centres, radii))
+        filt_nbrs = filter_nbrs(nbrs, radii)
+        searched_nbrs = batch_search(tree, centres, radii)
+        assert np.array_equal(filt_nbrs["offsets"], searched_nbrs["offsets"])
+        for i in range(centres.shape[0]):
+            assert np.array_equal(np.sort(filt_nbrs["indices"][filt_nbrs["offsets"][i]:filt_nbrs["offsets"][i+1]]), np.sort(searched_nbrs["indices"][searched_nbrs["offsets"][i]:searched_nbrs["offsets"][i+1]]))
+
+def sorted_nbr_sets(nbrs):
+    return [np.sort(nbrs["indices"][nbrs["offsets"][i]:nbrs["offsets"][i+1]]) for i in range(nbrs["offsets"].shape[0] - 1)]
+
+def kdtree_nbr_sets(ptls_pos, centres, radii):
+    tree = build_tree(ptls_pos, box_size)
+    return [np.sort(np.array(idxs, dtype=np.int64)) for idxs in tree.query_ball_point(centres, radii)]
+
+# Radii smaller and larger than a cell (some centres have no radius) with a few cells, one cell and a fine grid
+@pytest.mark.parametrize("n_cells", [1, 2, 3, 7, 40])
+def test_cell_list_matches_kdtree(ptls_pos, centres, n_cells):
+    rng = np.random.default_rng(3)
+    # With only a few cells every particle is checked for every centre so fewer particles are used
+    ptls_pos = ptls_pos[:5000]
+    radii = rng.random(centres.shape[0]) * 1.5 * box_size / n_cells
+    radii[:20] = box_size / n_cells + rng.random(20) * 100
+    radii[20:25] = 0
+    radii = np.minimum(radii, 0.45 * box_size)
+    cell_list = build_cell_list(ptls_pos, box_size, n_cells)
+    expected = kdtree_nbr_sets(ptls_pos, centres, radii)
+
+    for order in [None, calc_morton_order(centres, box_size)]:
+        nbrs = nbr_search(cell_list, centres, radii, return_dists = True, order = order)
+        found = sorted_nbr_sets(nbrs)
+        assert all(np.array_equal(found_idxs, expected_idxs) for found_idxs, expected_idxs in zip(found, expected))
+        assert np.array_equal(nbr_count(cell_list, centres, radii), [idxs.shape[0] for idxs in expected])
+        # The stored squared distances are those of the found particles
+        sq_dists = calc_nbr_sq_dists(ptls_pos[nbrs["indices"]], np.repeat(centres, np.diff(nbrs["offsets"]), axis=0), box_size)
+        assert np.array_equal(nbrs["sq_dists"], sq_dists)
+
+    # Small batches give the same as one batch
+    assert all(np.array_equal(a, b) for a, b in zip(sorted_nbr_sets(cell_list_search(cell_list, centres, radii, batch_size = 7)), expected))
+
+# Searching in Morton order with a tree gives the same neighbour lists (in the inputted order) as searching in order
+def test_morton_order_search(ptls_pos, centres):
+    tree = build_tree(ptls_pos, box_size)
+    radii = np.random.default_rng(4).random(centres.shape[0]) * 30
+    order = calc_morton_order(centres, box_size)
+    assert np.array_equal(np.sort(order), np.arange(centres.shape[0]))
+    nbrs = nbr_search(tree, centres, radii, return_dists = True)
+    ordered_nbrs = nbr_search(tree, centres, radii, return_dists = True, order = order)
+    assert np.array_equal(nbrs["offsets"], ordered_nbrs["offsets"])
+    for a, b in zip(sorted_nbr_sets(nbrs), sorted_nbr_sets(ordered_nbrs)):
+        assert np.array_equal(a, b)
+
+def test_nbrs_from_lists():
+    ptl_idx_lists = [np.array([4, 2, 9]), [], np.array([], dtype=np.int64), [1], np.arange(5)]
+    nbrs = nbrs_from_lists(ptl_idx_lists)
+    assert np.array_equal(nbrs["offsets"], [0, 3, 3, 3, 4, 9])
+    assert np.array_equal(nbrs["indices"], [4, 2, 9, 1, 0, 1, 2, 3, 4])
+    assert nbrs["indices"].dtype == np.int64
+    empty_nbrs = nbrs_from_lists([[], []])
+    assert np.array_equal(empty_nbrs["offsets"], [0, 0, 0]) and empty_nbrs["indices"].shape == (0,)
+
+def test_subset_nbrs():
+    nbrs = nbrs_from_lists([np.array([4, 2, 9]), [], [1], np.arange(5)])
+    nbrs["sq_dists"] = np.arange(nbrs["indices"].shape[0], dtype=np.float64)
+    sub_nbrs = subset_nbrs(nbrs, np.array([3, 0, 1, 3]))
+    assert np.array_equal(sub_nbrs["offsets"], [0, 5, 8, 8, 13])
+    assert np.array_equal(sub_nbrs["indices"], [0, 1, 2, 3, 4, 4, 2, 9, 0, 1, 2, 3, 4])
+    assert np.array_equal(sub_nbrs["sq_dists"], [4, 5, 6, 7, 8, 0, 1, 2, 4, 5, 6, 7, 8])
+    assert np.array_equal(subset_nbrs(nbrs, np.array([], dtype=np.int64))["offsets"], [0])
+
+def test_filter_nbrs():
+    nbrs = nbrs_from_lists([np.array([4, 2, 9]), [], [1], np.arange(3)])
+    nbrs["sq_dists"] = np.array([1.0, 4.0, 9.0, 16.0, 0.0, 2.25, 6.25])
+    filt_nbrs = filter_nbrs(nbrs, np.array([2.0, 1.0, 3.0, 1.5]))
+    assert np.array_equal(filt_nbrs["offsets"], [0, 2, 2, 2, 4])
+    assert np.array_equal(filt_nbrs["indices"], [4, 2, 0, 1])
+    assert np.array_equal(filt_nbrs["sq_dists"], [1.0, 4.0, 0.0, 2.25])
+    assert np.array_equal(count_in_radius(nbrs, np.array([2.0, 1.0, 3.0, 1.5])), [2, 0, 0, 2])
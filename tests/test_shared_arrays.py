@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from utils import data_and_loading_functions
+from utils.data_and_loading_functions import share_arrays, attach_shared_arrays, free_shared_arrays
+
+@pytest.fixture
+def arrays(tmp_path):
+    rng = np.random.default_rng(9)
+    np.save(str(tmp_path) + "/pos.npy", rng.random((1000, 3)).astype(np.float32))
+    return {
+        "ptls_pid": rng.integers(0, 2**40, 1000),
+        "ptls_vel": rng.normal(0, 300, (1000, 3)),
+        "ptls_pos": np.load(str(tmp_path) + "/pos.npy", mmap_mode="r"),
+        "ptl_rows": np.empty(0, dtype=np.int64),
+    }
+
+# Workers that aren't forked are never sent the arrays themselves, only where to find them
+@pytest.mark.parametrize("start_method, use_shm", [("fork", False), ("fork", True), ("spawn", False), ("forkserver", False)])
+def test_share_arrays(arrays, monkeypatch, start_method, use_shm):
+    monkeypatch.setattr(data_and_loading_functions.mp, "get_start_method", lambda: start_method)
+    shms, specs = share_arrays(arrays, use_shm)
+    try:
+        assert specs["ptls_pos"][0] == "mmap"
+        in_shm = use_shm or start_method != "fork"
+        for name in ["ptls_pid", "ptls_vel"]:
+            assert specs[name][0] == ("shm" if in_shm else "array")
+        assert len(shms) == (2 if in_shm else 0)
+
+        shared, attached_shms = attach_shared_arrays(specs)
+        for name, arr in arrays.items():
+            assert np.array_equal(shared[name], arr) and shared[name].dtype == arr.dtype
+        del shared
+        for shm in attached_shms:
+            shm.close()
+    finally:
+        free_shared_arrays(shms)
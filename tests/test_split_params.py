@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from colossus.cosmology import cosmology
+
+from utils.calculation_functions import calc_halo_params, calc_split_params
+
+# A periodic box (physical kpc/h) with halos near its edges and in its middle. Some halos have no particles and the particles of the others
+# are scattered around them out to 2 R200m, wrapped around the box
+@pytest.fixture
+def split_snap():
+    cosmology.setCosmology("planck13")
+    rng = np.random.default_rng(8)
+    scale_factor = 0.8
+    snap_dict = {"snap": 190, "red_shift": 1 / scale_factor - 1, "scale_factor": scale_factor, "hubble_const": 0.09, "box_size": 62.5 * 10**3 * scale_factor, "h": 0.7}
+    box_size = snap_dict["box_size"]
+
+    num_halos = 9
+    halos_r200m = rng.uniform(200, 900, num_halos)
+    halos_pos = rng.random((num_halos, 3)) * box_size
+    halos_pos[0] = [0.1 * halos_r200m[0], 0.5 * box_size, box_size - 0.2 * halos_r200m[0]]
+    halos_pos[1] = [box_size - 0.05 * halos_r200m[1], 0.02 * halos_r200m[1], 0.5 * box_size]
+    halos_vel = rng.normal(0, 200, (num_halos, 3))
+    num_ptls = rng.integers(20, 400, num_halos)
+    num_ptls[[2, 5, 8]] = 0
+    ptl_offsets = np.insert(np.cumsum(num_ptls), 0, 0)
+    ptl_halos = np.repeat(np.arange(num_halos), num_ptls)
+
+    ptl_pos = (halos_pos[ptl_halos] + rng.uniform(-2, 2, (ptl_halos.shape[0], 3)) * halos_r200m[ptl_halos,None]) % box_size
+    ptl_vel = halos_vel[ptl_halos] + rng.normal(0, 300, (ptl_halos.shape[0], 3))
+    ptl_pids = rng.choice(10**6, ptl_halos.shape[0], replace=False)
+    ptl_orb_assn = rng.integers(0, 2, ptl_halos.shape[0]).astype(np.int8)
+    halo_idxs = rng.choice(10**4, num_halos, replace=False)
+    return snap_dict, halo_idxs, ptl_offsets, ptl_pids, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, ptl_orb_assn
+
+@pytest.mark.parametrize("comp_snap", [False, True])
+def test_split_params_match_halo_params(split_snap, comp_snap):
+    snap_dict, halo_idxs, ptl_offsets, ptl_pids, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, ptl_orb_assn = split_snap
+    split_res = calc_split_params(comp_snap, snap_dict, halo_idxs, ptl_offsets, ptl_pids, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m,
+                                  ptl_orb_assn = None if comp_snap else ptl_orb_assn)
+
+    # calc_halo_params takes the halo position in comoving Mpc/h and changes the particle positions it is given
+    halo_res = []
+    for i in np.where(np.diff(ptl_offsets) > 0)[0]:
+        ptls = slice(ptl_offsets[i], ptl_offsets[i+1])
+        halo_res.append(calc_halo_params(comp_snap, snap_dict, halo_idxs[i], ptl_pids[ptls], ptl_pos[ptls].copy(), ptl_vel[ptls],
+                                         halos_pos[i] / (10**3 * snap_dict["scale_factor"]), halos_vel[i], halos_r200m[i],
+                                         ptl_orb_assn = None if comp_snap else ptl_orb_assn[ptls]))
+
+    # calc_halo_params' direction to each particle (rhat) is float32 so the velocities only agree to float32 precision (as in check_numba_kernel)
+    assert len(split_res) == len(halo_res[0])
+    for split_param, halo_param in zip(split_res, zip(*halo_res)):
+        halo_param = np.concatenate(halo_param)
+        assert split_param.shape == halo_param.shape
+        assert np.allclose(split_param, halo_param, rtol=1e-5, atol=1e-6, equal_nan=True)
+
+    # Each halo's particles are in the same (radius) order, shown by the HIPIDs and orbit labels being identical
+    assert np.array_equal(split_res[0], np.concatenate([res[0] for res in halo_res]))
+    if not comp_snap:
+        assert np.array_equal(split_res[1], np.concatenate([res[1] for res in halo_res]))
+    scaled_radii = split_res[-1] if comp_snap else split_res[4]
+    for start, end in zip(ptl_offsets[:-1], ptl_offsets[1:]):
+        assert np.all(np.diff(scaled_radii[start:end]) >= 0)
+
+# Particles that wrap around the box are at their nearest image distance from the halo (all were placed within 2 * sqrt(3) R200m)
+def test_split_params_wrap(split_snap):
+    snap_dict, halo_idxs, ptl_offsets, ptl_pids, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, ptl_orb_assn = split_snap
+    scaled_radii = calc_split_params(True, snap_dict, halo_idxs, ptl_offsets, ptl_pids, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m)[-1]
+    assert np.all(scaled_radii <= 2 * np.sqrt(3))
+    assert scaled_radii.shape[0] == ptl_offsets[-1]
+
+def test_split_params_no_ptls(split_snap):
+    snap_dict, halo_idxs, ptl_offsets, ptl_pids, ptl_pos, ptl_vel, halos_pos, halos_vel, halos_r200m, ptl_orb_assn = split_snap
+    no_ptls = np.zeros(halo_idxs.shape[0] + 1, dtype=np.int64)
+    split_res = calc_split_params(False, snap_dict, halo_idxs, no_ptls, ptl_pids[:0], ptl_pos[:0], ptl_vel[:0], halos_pos, halos_vel, halos_r200m,
+                                  ptl_orb_assn = ptl_orb_assn[:0])
+    assert all(param.shape[0] == 0 for param in split_res)